@@ -0,0 +1,126 @@
+"""
+Benchmarks for :mod:`brennivin.logutils`.
+Run with ``python benchmarks/bench_logutils.py``.
+"""
+from __future__ import print_function
+
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from brennivin import logutils
+
+
+class OldMultiLineIndentFormatter(logging.Formatter):
+    """The original :class:`brennivin.logutils.MultiLineIndentFormatter`."""
+    def __init__(self, fmt=None, datefmt=None, sep=' '):
+        logging.Formatter.__init__(self, fmt, datefmt)
+        self.sep = sep
+
+    def format(self, record):
+        formattedRecord = logging.Formatter.format(self, record)
+        header, footer = formattedRecord.split(record.msg)
+        s = formattedRecord.replace('\n', '\n' + (self.sep * len(header)))
+        return s
+
+
+def timeit(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def make_records(msg, count):
+    return [logging.LogRecord('bench.logger', logging.INFO, __file__, 1,
+                              msg, (), None) for _ in range(count)]
+
+
+def bench_formatters(formatters, records, title):
+    print(title)
+    baseline = None
+    for name, fmtr in formatters:
+        def run():
+            for r in records:
+                fmtr.format(r)
+        elapsed = timeit(run)
+        baseline = baseline or elapsed
+        print('%-28s %10.0f rec/s  %5.2fx' % (
+            name, len(records) / elapsed, baseline / elapsed))
+
+
+def bench_multiline_indent(count=50000):
+    fmt = logutils.Fmt.NTLM
+    formatters = [
+        ('logging.Formatter', logging.Formatter(fmt)),
+        ('old MultiLineIndentFormatter', OldMultiLineIndentFormatter(fmt)),
+        ('MultiLineIndentFormatter', logutils.MultiLineIndentFormatter(fmt)),
+    ]
+    bench_formatters(formatters, make_records('a single line', count),
+                     'Single line messages')
+    bench_formatters(formatters, make_records('line one\nline two', count),
+                     'Two line messages')
+
+
+class NaiveJsonFormatter(logging.Formatter):
+    """What we would write without :class:`brennivin.logutils.JsonFormatter`.
+    """
+    def format(self, record):
+        d = dict((k, getattr(record, k))
+                 for k in ('created', 'name', 'levelname'))
+        d['message'] = record.getMessage()
+        return json.dumps(d)
+
+
+def bench_json(count=50000):
+    formatters = [
+        ('logging.Formatter', logging.Formatter(logutils.Fmt.NTLM)),
+        ('naive json.dumps', NaiveJsonFormatter()),
+        ('JsonFormatter', logutils.JsonFormatter()),
+    ]
+    bench_formatters(formatters, make_records('a single line', count),
+                     'JSON')
+
+
+def bench_timestamp(count=200000):
+    fmt = '%Y-%m-%d-%H-%M-%S'
+    now = time.time()
+    times = [now + i * 0.001 for i in range(count)]
+    cached = logutils.CachedTimestamp(fmt)
+    cases = [
+        ('time.strftime', lambda: [time.strftime(fmt, time.gmtime(t))
+                                   for t in times]),
+        ('CachedTimestamp', lambda: [cached(t) for t in times]),
+    ]
+    print('Timestamps')
+    baseline = None
+    for name, func in cases:
+        elapsed = timeit(func)
+        baseline = baseline or elapsed
+        print('%-28s %10.0f ts/s  %5.2fx' % (
+            name, count / elapsed, baseline / elapsed))
+    formatters = [
+        ('logging.Formatter', logging.Formatter(logutils.Fmt.NTLM)),
+        ('CachedTimeFormatter',
+         logutils.CachedTimeFormatter(logutils.Fmt.NTLM)),
+    ]
+    bench_formatters(formatters, make_records('a single line', count // 4),
+                     'asctime')
+
+
+def main():
+    bench_multiline_indent()
+    bench_json()
+    bench_timestamp()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmarks for :mod:`brennivin.osutils`.
+Run with ``python benchmarks/bench_osutils.py``.
+"""
+from __future__ import print_function
+
+import fnmatch
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from brennivin import osutils
+
+
+def walk_fnmatch(directory, pattern='*'):
+    """The original :func:`brennivin.osutils.iter_files`."""
+    for root, dirs, files in os.walk(directory):
+        for basename in files:
+            if fnmatch.fnmatch(basename, pattern):
+                yield os.path.join(root, basename)
+
+
+def make_tree(root, dirs=200, filesperdir=100):
+    for i in range(dirs):
+        d = osutils.makedirs(os.path.join(root, 'd%s' % (i % 10), 'd%s' % i))
+        for j in range(filesperdir):
+            ext = ('.png', '.txt', '.py')[j % 3]
+            open(os.path.join(d, 'f%s%s' % (j, ext)), 'w').close()
+
+
+def timeit(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_iter_files(root):
+    cases = [
+        ('os.walk + fnmatch', lambda: list(walk_fnmatch(root, '*.py'))),
+        ('scan_files', lambda: list(osutils.scan_files(root, '*.py'))),
+        ('scan_files, 2 patterns',
+         lambda: list(osutils.scan_files(root, ['*.py', '*.txt']))),
+        ('scan_files, 4 workers',
+         lambda: list(osutils.scan_files(root, '*.py', workers=4))),
+    ]
+    baseline = None
+    for name, func in cases:
+        elapsed = timeit(func)
+        baseline = baseline or elapsed
+        print('%-28s %8.4fs  %5.2fx' % (name, elapsed, baseline / elapsed))
+
+
+def bench_hash_files(root, count=1000, size=64 * 1024):
+    files = []
+    data = os.urandom(size)
+    hashroot = osutils.makedirs(os.path.join(root, 'hashme'))
+    for i in range(count):
+        files.append(os.path.join(hashroot, str(i)))
+        with open(files[-1], 'wb') as f:
+            f.write(data)
+    cache = osutils.HashCache()
+    cases = [
+        ('crc_from_filename loop',
+         lambda: [osutils.crc_from_filename(f) for f in files]),
+        ('hash_files, 8 workers', lambda: osutils.hash_files(files)),
+        ('hash_files, warm cache',
+         lambda: osutils.hash_files(files, cache=cache)),
+    ]
+    baseline = None
+    for name, func in cases:
+        elapsed = timeit(func)
+        baseline = baseline or elapsed
+        print('%-28s %8.4fs  %5.2fx' % (name, elapsed, baseline / elapsed))
+
+
+def bench_path_helpers(count=200000):
+    paths = ['/projects/game/art/c%s/d%s/f%s.%s' % (
+        i % 10, i % 500, i, ('png', 'txt', 'py')[i % 3])
+        for i in range(count)]
+    cases = [
+        ('path_components loop',
+         lambda: [osutils.path_components(p) for p in paths]),
+        ('path_components_many',
+         lambda: osutils.path_components_many(paths)),
+        ('split3 loop', lambda: [osutils.split3(p) for p in paths]),
+        ('split3_many', lambda: osutils.split3_many(paths)),
+        ('purename loop', lambda: [osutils.purename(p) for p in paths]),
+        ('purename_many', lambda: osutils.purename_many(paths)),
+        ('change_ext loop',
+         lambda: [osutils.change_ext(p, '.x') for p in paths]),
+        ('change_ext_many', lambda: osutils.change_ext_many(paths, '.x')),
+    ]
+    # Each batch function is compared to the loop before it.
+    baseline = None
+    for i, (name, func) in enumerate(cases):
+        elapsed = timeit(func)
+        if not i % 2:
+            baseline = elapsed
+        print('%-28s %8.4fs  %5.2fx' % (name, elapsed, baseline / elapsed))
+
+
+def main():
+    root = tempfile.mkdtemp()
+    try:
+        make_tree(root)
+        bench_iter_files(root)
+        bench_hash_files(root)
+        bench_path_helpers()
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
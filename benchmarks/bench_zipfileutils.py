@@ -0,0 +1,133 @@
+"""
+Benchmarks for :mod:`brennivin.zipfileutils`.
+Run with ``python benchmarks/bench_zipfileutils.py``.
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from brennivin import osutils, zipfileutils
+
+
+def make_tree(root, files=200, size=512 * 1024):
+    """Make files of somewhat compressible text."""
+    rand = random.Random(0)
+    words = [('%x' % rand.getrandbits(32)).encode('ascii')
+             for _ in range(2000)]
+    for i in range(files):
+        d = osutils.makedirs(os.path.join(root, 'd%s' % (i % 10)))
+        chunks = []
+        total = 0
+        while total < size:
+            word = rand.choice(words)
+            chunks.append(word)
+            total += len(word) + 1
+        with open(os.path.join(d, 'f%s.txt' % i), 'wb') as f:
+            f.write(b' '.join(chunks))
+
+
+def timeit(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_zip_dir(srcdir, outdir):
+    total = sum(os.path.getsize(f) for f in osutils.iter_files(srcdir))
+    outfile = os.path.join(outdir, 'out.zip')
+    workercounts = [0, 2, 4, 8, multiprocessing.cpu_count()]
+    baseline = None
+    print('%d cores' % multiprocessing.cpu_count())
+    for workers in sorted(set(workercounts)):
+        elapsed = timeit(
+            lambda: zipfileutils.zip_dir(srcdir, outfile, workers=workers))
+        baseline = baseline or elapsed
+        print('zip_dir, %2d workers %10.1f MB/s  %5.2fx' % (
+            workers, total / elapsed / 1e6, baseline / elapsed))
+
+
+def bench_update(srcdir, outdir, changes=5):
+    outfile = os.path.join(outdir, 'out.zip')
+    paths = list(osutils.iter_files(srcdir))
+    counter = [0]
+
+    def touch():
+        for path in paths[:changes]:
+            counter[0] += 1
+            with open(path, 'ab') as f:
+                f.write((' %d' % counter[0]).encode())
+
+    def rebuild():
+        touch()
+        zipfileutils.zip_dir(srcdir, outfile)
+
+    def update():
+        touch()
+        zipfileutils.update_zip(srcdir, outfile)
+
+    zipfileutils.zip_dir(srcdir, outfile)
+    baseline = None
+    for name, func in [('zip_dir', rebuild), ('update_zip', update)]:
+        elapsed = timeit(func)
+        baseline = baseline or elapsed
+        print('%d of %d files changed, %-10s %7.3f s  %6.2fx' % (
+            changes, len(paths), name, elapsed, baseline / elapsed))
+
+
+def make_media(root, files=50, size=512 * 1024):
+    """Make files of incompressible data, like images or archives."""
+    rand = random.Random(1)
+    d = osutils.makedirs(os.path.join(root, 'media'))
+    for i in range(files):
+        ext = ('.png', '.bin')[i % 2]
+        data = bytearray(rand.getrandbits(8) for _ in range(size))
+        with open(os.path.join(d, 'm%s%s' % (i, ext)), 'wb') as f:
+            f.write(bytes(data))
+
+
+def bench_policy(srcdir, outdir):
+    total = sum(os.path.getsize(f) for f in osutils.iter_files(srcdir))
+    outfile = os.path.join(outdir, 'out.zip')
+    cases = [
+        ('deflate everything', None),
+        ('CompressionPolicy', zipfileutils.CompressionPolicy()),
+    ]
+    baseline = None
+    for name, policy in cases:
+        elapsed = timeit(
+            lambda: zipfileutils.zip_dir(srcdir, outfile, policy=policy))
+        baseline = baseline or elapsed
+        print('%-20s %10.1f MB/s  %5.2fx  %5.1f MB' % (
+            name, total / elapsed / 1e6, baseline / elapsed,
+            os.path.getsize(outfile) / 1e6))
+
+
+def main():
+    srcdir = tempfile.mkdtemp()
+    outdir = tempfile.mkdtemp()
+    try:
+        make_tree(srcdir)
+        bench_zip_dir(srcdir, outdir)
+        bench_update(srcdir, outdir)
+        make_media(srcdir)
+        bench_policy(srcdir, outdir)
+    finally:
+        shutil.rmtree(srcdir)
+        shutil.rmtree(outdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,8 @@ if sys.version_info[0] > 2:
     xrange = range
 
     from io import StringIO
+
+    from queue import Queue
 else:
     PY3K = False
 
@@ -41,3 +43,20 @@ else:
     xrange = xrange
 
     from cStringIO import StringIO
+
+    # noinspection PyUnresolvedReferences
+    from Queue import Queue
+
+if sys.version_info >= (3, 5):
+    exec("""def throttle_coro(acquire_async, func):
+    async def throttled(*args, **kwargs):
+        await acquire_async()
+        return await func(*args, **kwargs)
+    return throttled
+
+async def await_then_return(awaitable, value):
+    await awaitable
+    return value""")
+else:
+    throttle_coro = None
+    await_then_return = None
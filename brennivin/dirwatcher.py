@@ -0,0 +1,430 @@
+"""
+Watches a directory tree for changes to files,
+so you don't need to poll it with
+:func:`brennivin.osutils.listdirex` or :func:`brennivin.osutils.iter_files`.
+
+Create a :class:`DirWatcher`, connect to its ``created``, ``modified``,
+and ``deleted`` signals (see :class:`brennivin.threadutils.Signal`),
+and call :meth:`DirWatcher.start`::
+
+    watcher = DirWatcher('/var/spool/jobs', '*.json', debounce=0.5)
+    watcher.created.connect(enqueue_job)
+    watcher.start()
+
+On Linux, changes are reported by the kernel through inotify
+(see :class:`InotifyBackend`), so watching costs nothing while
+nothing changes.
+Elsewhere, the tree is scanned periodically and compared to the previous
+scan (see :class:`SnapshotBackend`).
+
+Members
+=======
+"""
+
+import ctypes as _ctypes
+import ctypes.util as _ctypes_util
+import errno as _errno
+import fnmatch as _fnmatch
+import os as _os
+import select as _select
+import stat as _stat
+import struct as _struct
+import sys as _sys
+import threading as _threading
+import time as _time
+
+from . import osutils as _osutils, threadutils as _threadutils
+
+CREATED = 'created'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+
+
+class SnapshotBackend(object):
+    """Finds changes by scanning the tree with
+    :func:`brennivin.osutils.scan_files` and comparing each file's
+    size and mtime to the previous scan.
+
+    :param stopevent: :class:`threading.Event` that will be set when
+      the watcher is stopped, so :meth:`read` can return early.
+    """
+    def __init__(self, directory, pattern, recursive, stopevent):
+        self.directory = directory
+        self.pattern = pattern
+        self.maxdepth = None if recursive else 0
+        self.stopevent = stopevent
+        self._snapshot = self._scan()
+
+    @classmethod
+    def is_supported(cls):
+        return True
+
+    def _scan(self):
+        snapshot = {}
+        for entry in _osutils.scan_files(
+                self.directory, self.pattern, direntries=True,
+                maxdepth=self.maxdepth):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            snapshot[entry.path] = st.st_size, st.st_mtime
+        return snapshot
+
+    def read(self, timeout):
+        """Wait ``timeout`` seconds (or until the watcher is stopped),
+        then return a list of ``(kind, path)`` changes since the last call.
+        """
+        if timeout and self.stopevent.wait(timeout):
+            return []
+        old = self._snapshot
+        new = self._snapshot = self._scan()
+        events = []
+        for path, sig in new.items():
+            oldsig = old.get(path)
+            if oldsig is None:
+                events.append((CREATED, path))
+            elif oldsig != sig:
+                events.append((MODIFIED, path))
+        for path in old:
+            if path not in new:
+                events.append((DELETED, path))
+        return events
+
+    def close(self):
+        pass
+
+
+class InotifyBackend(object):
+    """Gets changes from the Linux kernel's inotify API, through ctypes.
+    Every directory in the tree is watched, and watches are added for
+    new directories as they are created.
+
+    If the kernel's event queue overflows, events are lost,
+    so the tree is rescanned and compared to the files the backend
+    knew about (see :meth:`_rescan`).
+
+    See :class:`SnapshotBackend` for parameters.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+    _EVENT_HEADER = _struct.Struct('iIII')
+    _libc = None
+
+    @classmethod
+    def _get_libc(cls):
+        if cls._libc is None:
+            libc = _ctypes.CDLL(
+                _ctypes_util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1.argtypes = [_ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [
+                _ctypes.c_int, _ctypes.c_char_p, _ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [_ctypes.c_int, _ctypes.c_int]
+            cls._libc = libc
+        return cls._libc
+
+    @classmethod
+    def is_supported(cls):
+        if not _sys.platform.startswith('linux'):
+            return False
+        try:
+            libc = cls._get_libc()
+        except OSError:
+            return False
+        return hasattr(libc, 'inotify_init1')
+
+    def __init__(self, directory, pattern, recursive, stopevent):
+        self.directory = directory
+        self.pattern = pattern
+        self.recursive = recursive
+        self.stopevent = stopevent
+        self._libc = self._get_libc()
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            self._raise_errno(directory)
+        self._dirs = {}
+        # Path of each file to its (size, mtime) when last scanned,
+        # or None if it changed since.
+        self._known = {}
+        try:
+            self._add_tree(directory, self._known)
+        except Exception:
+            self.close()
+            raise
+
+    @staticmethod
+    def _raise_errno(path):
+        err = _ctypes.get_errno()
+        raise OSError(err, _os.strerror(err), path)
+
+    def _add_watch(self, dirpath):
+        encoded = dirpath
+        if not isinstance(encoded, bytes):
+            encoded = encoded.encode(_sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(self._fd, encoded, self.WATCH_MASK)
+        if wd < 0:
+            self._raise_errno(dirpath)
+        self._dirs[wd] = dirpath
+
+    def _add_tree(self, dirpath, found):
+        """Watch ``dirpath`` (and its subdirectories if recursive).
+        Files already in them are added to the ``found`` dict
+        as path to ``(size, mtime)``."""
+        self._add_watch(dirpath)
+        try:
+            names = _os.listdir(dirpath)
+        except OSError:
+            return
+        for name in names:
+            path = _os.path.join(dirpath, name)
+            try:
+                st = _os.stat(path)
+            except OSError:
+                continue
+            if _stat.S_ISDIR(st.st_mode):
+                if self.recursive and not _os.path.islink(path):
+                    try:
+                        self._add_tree(path, found)
+                    except OSError:
+                        pass
+            elif _fnmatch.fnmatch(name, self.pattern):
+                found[path] = st.st_size, st.st_mtime
+
+    def _remove_tree(self, dirpath, events):
+        """Stop watching ``dirpath`` and its subdirectories,
+        which were moved out of the tree or deleted,
+        and append any files we knew about in them to ``events``
+        as deleted."""
+        prefix = _os.path.join(dirpath, '')
+        for wd, path in list(self._dirs.items()):
+            if path == dirpath or path.startswith(prefix):
+                # Fails harmlessly if the kernel already removed it.
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._dirs[wd]
+        for path in list(self._known):
+            if path.startswith(prefix):
+                del self._known[path]
+                events.append((DELETED, path))
+
+    def _rescan(self, events):
+        """Rescan the whole tree after the kernel's queue overflowed,
+        watching any directories created since,
+        and append the differences from the files we knew about
+        to ``events``."""
+        found = {}
+        self._add_tree(self.directory, found)
+        for path, sig in found.items():
+            if path not in self._known:
+                events.append((CREATED, path))
+            elif self._known[path] != sig:
+                # Also reported if it changed since it was last scanned,
+                # since it may have changed again.
+                events.append((MODIFIED, path))
+        for path in self._known:
+            if path not in found:
+                events.append((DELETED, path))
+        self._known = found
+
+    def _decode(self, name):
+        if isinstance(name, str):
+            return name
+        try:
+            return _os.fsdecode(name)
+        except AttributeError:
+            return name.decode(_sys.getfilesystemencoding())
+
+    def read(self, timeout):
+        """Wait up to ``timeout`` seconds for changes,
+        and return a list of ``(kind, path)`` changes."""
+        try:
+            ready, _, _ = _select.select([self._fd], [], [], timeout)
+        except (OSError, _select.error):
+            return []
+        if not ready:
+            return []
+        try:
+            data = _os.read(self._fd, 64 * 1024)
+        except OSError as ex:
+            if ex.errno in (_errno.EAGAIN, _errno.EINTR):
+                return []
+            raise
+        events = []
+        header = self._EVENT_HEADER
+        offset = 0
+        while offset + header.size <= len(data):
+            wd, mask, _, length = header.unpack_from(data, offset)
+            offset += header.size
+            name = self._decode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            self._handle(wd, mask, name, events)
+        return events
+
+    def _handle(self, wd, mask, name, events):
+        if mask & self.IN_Q_OVERFLOW:
+            self._rescan(events)
+            return
+        if mask & (self.IN_IGNORED | self.IN_DELETE_SELF):
+            self._dirs.pop(wd, None)
+            return
+        dirpath = self._dirs.get(wd)
+        if dirpath is None or not name:
+            return
+        path = _os.path.join(dirpath, name)
+        if mask & self.IN_ISDIR:
+            if mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                self._remove_tree(path, events)
+            elif self.recursive and mask & (self.IN_CREATE |
+                                            self.IN_MOVED_TO):
+                # Files may have been created before the watch was added.
+                found = {}
+                try:
+                    self._add_tree(path, found)
+                except OSError:
+                    pass
+                for filepath in found:
+                    events.append((CREATED, filepath))
+                self._known.update(found)
+            return
+        if not _fnmatch.fnmatch(name, self.pattern):
+            return
+        if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+            events.append((CREATED, path))
+            self._known[path] = None
+        elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+            events.append((DELETED, path))
+            self._known.pop(path, None)
+        elif mask & (self.IN_MODIFY | self.IN_CLOSE_WRITE):
+            events.append((MODIFIED, path))
+            self._known[path] = None
+
+    def close(self):
+        if self._fd >= 0:
+            _os.close(self._fd)
+            self._fd = -1
+
+
+def _coalesce(pending, kind, path):
+    """Merge the change ``kind`` to ``path`` into the ``pending`` dict
+    of path to kind, so a burst of changes is reported as one."""
+    old = pending.get(path)
+    if old is None:
+        pending[path] = kind
+    elif old == CREATED:
+        if kind == DELETED:
+            del pending[path]
+    elif old == DELETED:
+        if kind == CREATED:
+            pending[path] = MODIFIED
+    else:
+        pending[path] = kind
+
+
+class DirWatcher(object):
+    """Watches ``directory`` for files being created, modified, and deleted.
+
+    Changes are reported through the ``created``, ``modified``,
+    and ``deleted`` :class:`brennivin.threadutils.Signal` instances,
+    which are emitted with the path of the file.
+    Signals are emitted from the watcher's thread after :meth:`start`,
+    or from the calling thread of :meth:`poll`.
+
+    :param pattern: Only report files with a basename matching this glob.
+    :param recursive: If True, watch all subdirectories too.
+    :param debounce: If > 0, hold changes until no more have happened for
+      this many seconds, and report each file at most once.
+      For example, a file that is created and written to in several steps
+      is reported once as created. Useful for files that are written slowly.
+    :param interval: Seconds between scans when using
+      :class:`SnapshotBackend`.
+    :param backend: Backend class to use. Defaults to
+      :class:`InotifyBackend` where supported, else :class:`SnapshotBackend`.
+    :param clock: Function returning the current time in seconds.
+    """
+
+    @classmethod
+    def start_thread(cls, target, name):
+        thread = _threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def __init__(self, directory, pattern='*', recursive=True, debounce=0,
+                 interval=1.0, backend=None, clock=None):
+        self.directory = directory
+        self.debounce = debounce
+        self.interval = interval
+        self.clock = clock or _time.time
+        self.created = _threadutils.Signal('(path)')
+        self.modified = _threadutils.Signal('(path)')
+        self.deleted = _threadutils.Signal('(path)')
+        self._signals = {CREATED: self.created,
+                         MODIFIED: self.modified,
+                         DELETED: self.deleted}
+        self._stop = _threading.Event()
+        self._pending = {}
+        self._lastchange = None
+        self.thread = None
+        if backend is None:
+            backend = InotifyBackend
+            if not backend.is_supported():
+                backend = SnapshotBackend
+        self.backend = backend(directory, pattern, recursive, self._stop)
+
+    def poll(self, timeout=0):
+        """Wait up to ``timeout`` seconds for changes,
+        and emit any that are due to be reported."""
+        for kind, path in self.backend.read(timeout):
+            _coalesce(self._pending, kind, path)
+            self._lastchange = self.clock()
+        if not self._pending:
+            return
+        if (self.debounce and
+                self.clock() - self._lastchange < self.debounce):
+            return
+        pending = self._pending
+        self._pending = {}
+        for path in sorted(pending):
+            self._signals[pending[path]].emit(path)
+
+    def _run(self):
+        timeout = self.interval
+        if isinstance(self.backend, InotifyBackend):
+            timeout = min(self.interval, self.debounce or self.interval)
+        while not self._stop.is_set():
+            self.poll(timeout)
+
+    def start(self):
+        """Start watching on a background thread."""
+        if self.thread is not None:
+            raise RuntimeError('Watcher already started.')
+        self.thread = type(self).start_thread(self._run, 'DirWatcherThread')
+
+    def stop(self, timeout=None):
+        """Stop watching, and release the backend's resources.
+        Changes still being debounced are not reported."""
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.backend.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
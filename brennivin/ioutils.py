@@ -1,7 +1,13 @@
 """
 Contains utilities for working with IO,
 such as the :class:`retry` and :class:`timeout` decorators,
-and the :func:`is_local_port_open` function.
+the :func:`is_local_port_open` function,
+and the :class:`PortAllocator` for handing out many free local ports quickly.
+
+Calls to shared services can be throttled with the :class:`TokenBucket`
+and :class:`SlidingWindow` rate limiters,
+which can be used as decorators, context managers (including ``async with``),
+or by calling ``acquire`` directly.
 
 Also defines :class:`Timeout` which is used in IO-heavy areas of brennivin.
 
@@ -9,13 +15,22 @@ Members
 =======
 """
 
+import collections as _collections
+import functools as _functools
 import threading as _threading
 import time as _time
 import socket as _socket
 
+from . import compat as _compat
+
 
 EPHEMERAL_PORT_RANGE = 49152, 65535
 
+try:
+    _monotonic = _time.monotonic
+except AttributeError:
+    _monotonic = _time.time
+
 
 class Timeout(_socket.timeout, Exception):
     pass
@@ -129,3 +144,341 @@ def is_local_port_open(port):
     finally:
         sock.close()
     return not isBound
+
+
+class PortAllocator(object):
+    """Hands out free local ports by asking the OS for them
+    (binding to port 0), rather than probing ports one at a time
+    with :func:`is_local_port_open`.
+
+    Reserved ports are held open by a bound socket until they are handed
+    off through :meth:`release` (close the socket, caller binds the port)
+    or :meth:`take` (caller gets the bound socket itself, no race at all).
+    A port is not handed out again by the same allocator for ``grace``
+    seconds, so it is safe to share an instance between threads.
+
+    Can be used as a context manager, which will :meth:`close`
+    any still-reserved ports on exit.
+
+    :param host: Interface to bind to.
+    :param sockfactory: Callable that returns a new, unbound socket.
+      Defaults to :func:`socket.socket`.
+    :param grace: Seconds a handed off port is not handed out again,
+      to give the caller time to bind it.
+    :param maxhandedout: Most handed off ports to remember.
+      The oldest are forgotten first, even if their grace period
+      has not passed, so a long-lived allocator does not run out
+      of ports the OS will offer.
+    :param clock: Function returning the current time in seconds.
+    """
+    def __init__(self, host='127.0.0.1', sockfactory=None, grace=60,
+                 maxhandedout=4096, clock=None):
+        self.host = host
+        self.sockfactory = sockfactory or _socket.socket
+        self.grace = grace
+        self.maxhandedout = maxhandedout
+        self.clock = clock or _monotonic
+        self._lock = _threading.Lock()
+        self._reserved = {}
+        # Port to the time it was handed off, and the same in time order.
+        self._handedout = {}
+        self._handedorder = _collections.deque()
+
+    def _expire(self, now):
+        """Forget handed off ports that are past their grace period,
+        or beyond :attr:`maxhandedout`. Call with the lock held."""
+        order = self._handedorder
+        while order and (order[0][0] <= now - self.grace or
+                         len(self._handedout) > self.maxhandedout):
+            handedat, port = order.popleft()
+            if self._handedout.get(port) == handedat:
+                del self._handedout[port]
+
+    def reserve(self, count=1):
+        """Reserve ``count`` free ports, holding them until they are
+        handed off.
+
+        :return: List of the reserved port numbers.
+        """
+        if count < 0:
+            raise ValueError('count must be >= 0, got %s' % count)
+        ports = []
+        dupes = []
+        with self._lock:
+            self._expire(self.clock())
+            try:
+                while len(ports) < count:
+                    sock = self.sockfactory()
+                    try:
+                        sock.bind((self.host, 0))
+                    except _socket.error:
+                        sock.close()
+                        raise
+                    port = sock.getsockname()[1]
+                    if port in self._handedout or port in self._reserved:
+                        # The OS recycled a port we already handed out and
+                        # the caller may not have bound it yet.
+                        # Hold it until we are done so we get a new one.
+                        dupes.append(sock)
+                        continue
+                    self._reserved[port] = sock
+                    ports.append(port)
+            except _socket.error:
+                for port in ports:
+                    self._reserved.pop(port).close()
+                raise
+            finally:
+                for sock in dupes:
+                    sock.close()
+        return ports
+
+    def release(self, port):
+        """Close the socket holding ``port`` so the caller can bind it.
+
+        :return: ``port``
+        :raise KeyError: If ``port`` is not reserved.
+        """
+        self.take(port).close()
+        return port
+
+    def take(self, port):
+        """Hand off ``port`` by returning the socket bound to it.
+        The caller is responsible for closing the socket.
+
+        :raise KeyError: If ``port`` is not reserved.
+        """
+        with self._lock:
+            sock = self._reserved.pop(port)
+            now = self.clock()
+            self._handedout[port] = now
+            self._handedorder.append((now, port))
+            self._expire(now)
+        return sock
+
+    def reserved(self):
+        """Return a sorted list of ports currently reserved."""
+        with self._lock:
+            return sorted(self._reserved)
+
+    def close(self):
+        """Close all sockets for ports that are still reserved.
+        The ports are not considered handed out."""
+        with self._lock:
+            socks = list(self._reserved.values())
+            self._reserved.clear()
+        for sock in socks:
+            sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+_default_allocator = PortAllocator()
+
+
+def find_open_local_ports(count=1):
+    """Returns a list of ``count`` local ports that were open at the time
+    of the call, using a process-wide :class:`PortAllocator`,
+    so concurrent callers in the same process never get the same port.
+
+    Like :func:`is_local_port_open`, the ports may be bound by another
+    process before you bind them. Use :meth:`PortAllocator.take` if you
+    need to avoid that race entirely.
+    """
+    ports = _default_allocator.reserve(count)
+    for port in ports:
+        _default_allocator.release(port)
+    return ports
+
+
+class RateLimited(Exception):
+    """Raised by a rate limiter that would have to wait,
+    but is not allowed to block."""
+
+
+class _NoWait(object):
+    """Awaitable that completes immediately, without yielding to the
+    event loop."""
+    def __await__(self):
+        return iter(())
+    __iter__ = __await__
+
+_nowait = _NoWait()
+
+
+class _RateLimiter(object):
+    """Base class for rate limiters.
+    Subclasses implement :meth:`_reserve`, which is always called
+    with the lock held.
+    """
+
+    def __init__(self, block, clock, sleepfunc):
+        self.block = block
+        self.clock = clock or _monotonic
+        self.sleep = sleepfunc or _time.sleep
+        self._lock = _threading.Lock()
+
+    def _reserve(self, now, block):
+        """Take a permit at time ``now``.
+        Return the number of seconds the caller must wait before
+        proceeding (0 to go right away), or None if a permit is not
+        available and ``block`` is False.
+        """
+        raise NotImplementedError()
+
+    def _delay(self, blocking):
+        if blocking is None:
+            blocking = self.block
+        with self._lock:
+            delay = self._reserve(self.clock(), blocking)
+        if delay is None:
+            raise RateLimited('Rate limit exceeded for %r.' % self)
+        return delay
+
+    def acquire(self, blocking=None):
+        """Take a permit, sleeping until it is available.
+
+        :param blocking: If False, raise :class:`RateLimited` instead of
+          sleeping. If None, use the ``block`` value the limiter
+          was created with.
+        """
+        delay = self._delay(blocking)
+        if delay:
+            self.sleep(delay)
+
+    def try_acquire(self):
+        """Take a permit if one is available right now.
+        Return True if it was taken, False if not."""
+        with self._lock:
+            return self._reserve(self.clock(), False) is not None
+
+    def acquire_async(self, blocking=None):
+        """Like :meth:`acquire`, but return an awaitable for use in
+        :mod:`asyncio` code, which will sleep on the event loop
+        rather than blocking the thread.
+        """
+        delay = self._delay(blocking)
+        if not delay:
+            return _nowait
+        import asyncio
+        return asyncio.sleep(delay)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    def __aenter__(self):
+        return _compat.await_then_return(self.acquire_async(), self)
+
+    def __aexit__(self, *_):
+        return _nowait
+
+    def __call__(self, func):
+        """Decorate ``func`` so every call takes a permit first.
+        Coroutine functions are decorated with a coroutine function
+        that awaits :meth:`acquire_async` when it runs."""
+        if _compat.throttle_coro is not None:
+            import asyncio
+            if asyncio.iscoroutinefunction(func):
+                return _functools.wraps(func)(
+                    _compat.throttle_coro(self.acquire_async, func))
+
+        @_functools.wraps(func)
+        def throttled(*args, **kwargs):
+            self.acquire()
+            return func(*args, **kwargs)
+        return throttled
+
+
+class TokenBucket(_RateLimiter):
+    """Rate limiter allowing an average of ``rate`` calls per second,
+    with bursts of up to ``capacity`` calls.
+
+    Blocking callers reserve their token up front and sleep outside of
+    the lock, so waiting threads are served in the order they arrived.
+
+    :param rate: Tokens added to the bucket per second. Must be > 0.
+    :param capacity: Maximum tokens in the bucket (size of a burst).
+      Defaults to ``rate``, or 1 if ``rate`` is less than 1.
+    :param block: If True, :meth:`acquire` waits for a token.
+      If False, it raises :class:`RateLimited`.
+    :param clock: Function returning the current time in seconds.
+      Defaults to :func:`time.monotonic` where available.
+    :param sleepfunc: The function used to sleep.
+      Defaults to :func:`time.sleep`.
+    """
+    def __init__(self, rate, capacity=None, block=True, clock=None,
+                 sleepfunc=None):
+        if rate <= 0:
+            raise ValueError('rate must be > 0, got %s' % rate)
+        if capacity is None:
+            capacity = max(rate, 1)
+        if capacity < 1:
+            raise ValueError('capacity must be >= 1, got %s' % capacity)
+        _RateLimiter.__init__(self, block, clock, sleepfunc)
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last = self.clock()
+
+    def _reserve(self, now, block):
+        tokens = self._tokens + (now - self._last) * self.rate
+        if tokens > self.capacity:
+            tokens = self.capacity
+        self._last = now
+        if tokens >= 1:
+            self._tokens = tokens - 1
+            return 0
+        if not block:
+            self._tokens = tokens
+            return None
+        # Go into debt; the caller sleeps until the debt is paid off.
+        self._tokens = tokens - 1
+        return (1 - tokens) / self.rate
+
+    def __repr__(self):
+        return 'TokenBucket(rate=%s, capacity=%s)' % (self.rate, self.capacity)
+
+
+class SlidingWindow(_RateLimiter):
+    """Rate limiter allowing at most ``limit`` calls
+    in any ``period`` seconds.
+
+    See :class:`TokenBucket` for the other parameters.
+    """
+    def __init__(self, limit, period=1.0, block=True, clock=None,
+                 sleepfunc=None):
+        if limit < 1:
+            raise ValueError('limit must be >= 1, got %s' % limit)
+        if period <= 0:
+            raise ValueError('period must be > 0, got %s' % period)
+        _RateLimiter.__init__(self, block, clock, sleepfunc)
+        self.limit = limit
+        self.period = period
+        # Start times of the calls in the window.
+        # Appending to a full deque drops the oldest entry.
+        self._calls = _collections.deque(maxlen=limit)
+
+    def _reserve(self, now, block):
+        calls = self._calls
+        if len(calls) < self.limit:
+            calls.append(now)
+            return 0
+        starts = calls[0] + self.period
+        if starts <= now:
+            calls.append(now)
+            return 0
+        if not block:
+            return None
+        # Reserve the slot that frees up when the oldest call expires.
+        calls.append(starts)
+        return starts - now
+
+    def __repr__(self):
+        return 'SlidingWindow(limit=%s, period=%s)' % (self.limit, self.period)
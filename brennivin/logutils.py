@@ -12,15 +12,32 @@ There are various functions for working with timestamped log filenames
 Use :func:`get_filenames_from_loggers` to get all the logging filenames currently
 registered.
 
+Use a :class:`QueueHandler` with a :class:`BatchFileHandler` to log
+without making the logging thread wait on disk.
+
+Use a :class:`LogReader` to read only the records added to log files
+since they were last read.
+
 Members
 =======
 """
 
-import fnmatch as _fnmatch
+import collections as _collections
+import copy as _copy
+import errno as _errno
+import gzip as _gzip
+import heapq as _heapq
+import json as _json
 import logging as _logging
 import os as _os
+import re as _re
+import shutil as _shutil
+import threading as _threading
 import time as _time
 
+from . import (compat as _compat, ioutils as _ioutils, osutils as _osutils,
+               traceback2 as _traceback2)
+
 
 try:
     NullHandler = _logging.NullHandler
@@ -58,20 +75,609 @@ class Fmt(object):
     FMT_LM = _logging.Formatter(LM)
 
 
-class MultiLineIndentFormatter(_logging.Formatter):
+class CachedTimeFormatter(_logging.Formatter):
+    """:class:`logging.Formatter` that formats ``asctime`` through a
+    :class:`CachedTimestamp`, so the time is only formatted with
+    :func:`time.strftime` when the second changes,
+    and otherwise only the milliseconds are added.
+    Output is identical to :class:`logging.Formatter`.
+    """
+
+    def __init__(self, fmt=None, datefmt=None):
+        _logging.Formatter.__init__(self, fmt, datefmt)
+        self._timestamps = {}
+
+    def _get_timestamp(self, datefmt):
+        cached = self._timestamps.get(datefmt)
+        if cached is None:
+            cached = CachedTimestamp(datefmt, self.converter)
+            self._timestamps[datefmt] = cached
+        return cached
+
+    def formatTime(self, record, datefmt=None):
+        if datefmt:
+            return self._get_timestamp(datefmt)(record.created)
+        timefmt = getattr(self, 'default_time_format', '%Y-%m-%d %H:%M:%S')
+        msecfmt = getattr(self, 'default_msec_format', '%s,%03d')
+        s = self._get_timestamp(timefmt)(record.created)
+        if msecfmt:
+            s = msecfmt % (s, record.msecs)
+        return s
+
+
+class MultiLineIndentFormatter(CachedTimeFormatter):
     """Indents every newline character in a formatted logrecord to have
     the same indentation as the formatted record's header.
+
+    The header is the part of ``fmt`` before ``%(message)s``,
+    so records that only have a single line
+    cost no more than with a plain :class:`logging.Formatter`.
     """
     def __init__(self, fmt=None, datefmt=None, sep=' '):
-        _logging.Formatter.__init__(self, fmt, datefmt)
+        CachedTimeFormatter.__init__(self, fmt, datefmt)
         self.sep = sep
+        self._indents = {}
+        prefix = self._fmt.partition('%(message)s')[0]
+        if '%(' in prefix:
+            self._header = prefix
+            self._headerlen = None
+        else:
+            self._header = None
+            self._headerlen = len(prefix % {})
+
+    def _get_indent(self, headerlen):
+        indent = self._indents.get(headerlen)
+        if indent is None:
+            indent = self._indents[headerlen] = '\n' + self.sep * headerlen
+        return indent
 
     def format(self, record):
         formattedRecord = _logging.Formatter.format(self, record)
-        header, footer = formattedRecord.split(record.msg)
-        # noinspection PyTypeChecker
-        s = formattedRecord.replace('\n', '\n' + (self.sep * len(header)))
-        return s
+        if '\n' not in formattedRecord:
+            return formattedRecord
+        headerlen = self._headerlen
+        if headerlen is None:
+            headerlen = len(self._header % record.__dict__)
+        if not headerlen:
+            return formattedRecord
+        return formattedRecord.replace('\n', self._get_indent(headerlen))
+
+
+#: Default fields for :class:`JsonFormatter`.
+JSON_FIELDS = ('created', 'name', 'levelname', 'message')
+
+# Attributes every LogRecord has, so anything else came from ``extra``.
+_LOGRECORD_ATTRS = frozenset(
+    _logging.LogRecord('', 0, '', 0, '', (), None).__dict__).union(
+    ['message', 'asctime'])
+
+
+def _json_default(obj):
+    return repr(obj)
+
+
+class JsonFormatter(CachedTimeFormatter):
+    """Formats each record as a single line JSON object,
+    so a handler writes newline-delimited JSON (NDJSON)
+    that log aggregators can read without parsing text.
+
+    The field selection is worked out once, and a single
+    :class:`json.JSONEncoder` is reused, to keep formatting cheap.
+
+    :param fields: Sequence of :class:`logging.LogRecord` attribute names
+      to include, or ``(key, attribute)`` pairs to include an attribute
+      under a different key. ``'message'`` is the formatted message
+      and ``'asctime'`` is the time formatted with ``datefmt``.
+    :param extra: If True, include attributes added to the record
+      through the ``extra`` argument of the logging call.
+      Values that are not JSON serializable are included as their repr.
+    :param static: Dict of keys and values to include in every record,
+      such as the host or application name.
+    :param show_locals: Passed to
+      :func:`brennivin.traceback2.format_exception` when formatting
+      exceptions, which are included under the ``exc_info`` key.
+      The number of innermost frames to show locals for,
+      or -1 for all of them.
+    :param tbformat: Format to pass to
+      :func:`brennivin.traceback2.format_exception`.
+    """
+    def __init__(self, fields=JSON_FIELDS, extra=True, static=None,
+                 datefmt=None, show_locals=0,
+                 tbformat=_traceback2.FORMAT_NORMAL):
+        CachedTimeFormatter.__init__(self, None, datefmt)
+        pairs = []
+        for field in fields:
+            if isinstance(field, tuple):
+                pairs.append(field)
+            else:
+                pairs.append((field, field))
+        self.fields = tuple(pairs)
+        self._attrs = tuple(p for p in pairs
+                            if p[1] not in ('message', 'asctime'))
+        self._messagekey = self._asctimekey = None
+        for key, attr in pairs:
+            if attr == 'message':
+                self._messagekey = key
+            elif attr == 'asctime':
+                self._asctimekey = key
+        self.extra = extra
+        self.static = dict(static or ())
+        self.show_locals = show_locals
+        self.tbformat = tbformat
+        self._encode = _json.JSONEncoder(
+            separators=(',', ':'), default=_json_default).encode
+
+    def format(self, record):
+        d = self.static.copy()
+        for key, attr in self._attrs:
+            d[key] = getattr(record, attr, None)
+        if self._messagekey is not None:
+            d[self._messagekey] = record.getMessage()
+        if self._asctimekey is not None:
+            d[self._asctimekey] = self.formatTime(record, self.datefmt)
+        if self.extra:
+            for key, value in record.__dict__.items():
+                if key not in _LOGRECORD_ATTRS and key not in d:
+                    d[key] = value
+        if record.exc_info:
+            d['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            d['exc_info'] = record.exc_text
+        stack_info = getattr(record, 'stack_info', None)
+        if stack_info:
+            d['stack_info'] = self.formatStack(stack_info)
+        return self._encode(d)
+
+    def formatException(self, ei):
+        lines = _traceback2.format_exception(
+            ei[0], ei[1], ei[2], show_locals=self.show_locals,
+            format=self.tbformat)
+        return ''.join(lines).rstrip('\n')
+
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP = 'drop'
+
+
+class _BatchMixin(object):
+    """Adds :meth:`handle_batch` to a :class:`logging.StreamHandler`."""
+
+    def handle_batch(self, records):
+        """Filter and format ``records``,
+        then write them with a single write and flush."""
+        terminator = getattr(self, 'terminator', '\n')
+        msgs = []
+        for record in records:
+            if record.levelno < self.level or not self.filter(record):
+                continue
+            try:
+                msgs.append(self.format(record) + terminator)
+            except Exception:
+                self.handleError(record)
+        if not msgs:
+            return
+        self.acquire()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(''.join(msgs))
+            self.flush()
+        except Exception:
+            self.handleError(records[-1])
+        finally:
+            self.release()
+
+
+class BatchStreamHandler(_BatchMixin, _logging.StreamHandler):
+    """:class:`logging.StreamHandler` that can write many records at once.
+    For use with :class:`QueueHandler`."""
+
+
+class BatchFileHandler(_BatchMixin, _logging.FileHandler):
+    """:class:`logging.FileHandler` that can write many records at once.
+    For use with :class:`QueueHandler`."""
+
+
+class TimestampedRotatingFileHandler(BatchFileHandler):
+    """File handler that writes to a new file named like
+    :func:`get_timestamped_logfilename` does
+    whenever the current file reaches ``maxbytes``
+    or every ``interval`` seconds.
+
+    Each time a new file is started, old files are cleaned up on a
+    background thread according to ``maxfiles`` or ``retention``
+    (see :func:`get_timestamped_logfilename`),
+    so a rollover only costs opening one file and closing another.
+    ``maxfiles`` includes the file being written to.
+
+    When used with :class:`QueueHandler`, rollover is checked once per
+    batch, so a file may go over ``maxbytes`` by up to one batch.
+
+    :param folder: Folder to put log files into. Created if needed.
+    :param basename: See :func:`get_timestamped_logfilename`.
+    :param maxbytes: Roll over once the file has at least this many bytes.
+      If 0, do not roll over by size.
+    :param interval: Roll over every this many seconds.
+      If 0, do not roll over by time.
+    """
+    def __init__(self, folder, basename=None, ext='.log', maxbytes=0,
+                 interval=0, maxfiles=15, retention=None, encoding=None,
+                 delay=False):
+        self.folder = folder
+        self.basename = basename
+        self.ext = ext
+        self.maxbytes = maxbytes
+        self.interval = interval
+        self.maxfiles = maxfiles
+        self.retention = retention
+        _osutils.makedirs(folder)
+        BatchFileHandler.__init__(
+            self, self._next_filename(), 'a', encoding, delay)
+        self._remove_old_logs()
+        self.rolloverat = None
+        if interval:
+            self.rolloverat = _time.time() + interval
+
+    def _next_filename(self):
+        filename, self._pattern = _timestamped_logname(
+            self.folder, self.basename, self.ext, '%Y-%m-%d-%H-%M-%S', None,
+            _os.getpid)
+        # Rolling over more than once a second gives the same timestamp.
+        head, ext = _os.path.splitext(filename)
+        i = 1
+        while _os.path.exists(filename):
+            filename = '%s-%s%s' % (head, i, ext)
+            i += 1
+        return filename
+
+    def _remove_old_logs(self):
+        _remove_old_logs(self.folder, self._pattern, self.maxfiles, True,
+                         self.retention)
+
+    def should_rollover(self, record):
+        if self.rolloverat is not None and record.created >= self.rolloverat:
+            return True
+        if self.maxbytes and self.stream is not None:
+            return self.stream.tell() >= self.maxbytes
+        return False
+
+    def do_rollover(self, now=None):
+        """Close the current file and start a new one.
+        Should be called with the handler's lock held."""
+        if now is None:
+            now = _time.time()
+        stream = self.stream
+        self.baseFilename = _os.path.abspath(self._next_filename())
+        self.stream = self._open()
+        if self.interval:
+            self.rolloverat = now + self.interval
+        if stream is not None:
+            stream.close()
+        self._remove_old_logs()
+
+    def emit(self, record):
+        try:
+            if self.should_rollover(record):
+                self.do_rollover(record.created)
+        except Exception:
+            self.handleError(record)
+        BatchFileHandler.emit(self, record)
+
+    def handle_batch(self, records):
+        if not records:
+            return
+        self.acquire()
+        try:
+            if self.should_rollover(records[0]):
+                self.do_rollover(records[0].created)
+        except Exception:
+            self.handleError(records[0])
+        finally:
+            self.release()
+        BatchFileHandler.handle_batch(self, records)
+
+
+class QueueHandler(_logging.Handler):
+    """Handler that puts records on a queue and returns immediately,
+    so threads that log do not wait on disk.
+    A writer thread takes records off the queue and passes them,
+    in batches, to ``target``.
+
+    ``target`` should usually be a :class:`BatchFileHandler`
+    or :class:`BatchStreamHandler`, which write a whole batch with
+    a single write call. Any other handler is called per record.
+
+    Closing the handler (which :func:`logging.shutdown` does at exit)
+    writes any queued records and closes ``target``.
+
+    :param target: Handler that records are written to.
+    :param maxsize: Maximum number of records in the queue.
+    :param overflow: What to do when logging and the queue is full.
+      :data:`OVERFLOW_BLOCK` waits for the writer to make room,
+      :data:`OVERFLOW_DROP_OLDEST` discards the oldest queued record,
+      and :data:`OVERFLOW_DROP` discards the new record.
+      Discarded records are counted in :attr:`dropped`.
+    :param batchsize: Maximum number of records to write at once.
+    """
+
+    @classmethod
+    def start_thread(cls, target, name):
+        thread = _threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def __init__(self, target, maxsize=10000, overflow=OVERFLOW_BLOCK,
+                 batchsize=256, level=_logging.NOTSET):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST,
+                            OVERFLOW_DROP):
+            raise ValueError('Invalid overflow policy: %r' % overflow)
+        if maxsize < 1 or batchsize < 1:
+            raise ValueError('maxsize and batchsize must be >= 1.')
+        _logging.Handler.__init__(self, level)
+        self.target = target
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.batchsize = batchsize
+        #: Number of records discarded because the queue was full.
+        self.dropped = 0
+        #: Largest number of records that have been in the queue.
+        self.highwater = 0
+        self._records = _collections.deque()
+        self._writing = 0
+        self._closing = False
+        self._cond = _threading.Condition(_threading.Lock())
+        self.thread = type(self).start_thread(
+            self._run, 'QueueHandlerWriter')
+
+    def qsize(self):
+        """Return the number of records waiting to be written."""
+        return len(self._records)
+
+    def prepare(self, record):
+        """Return a copy of ``record`` with its args merged into its
+        message and its exception formatted into ``exc_text``,
+        so objects passed as args can change (or die) after logging.
+        The original record is not changed,
+        since other handlers may still see it."""
+        record = _copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                formatter = self.target.formatter or _logging._defaultFormatter
+                record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self._cond:
+            if self._closing:
+                return
+            while len(self._records) >= self.maxsize:
+                if self.overflow == OVERFLOW_BLOCK:
+                    self._cond.wait()
+                    if self._closing:
+                        return
+                    continue
+                self.dropped += 1
+                if self.overflow == OVERFLOW_DROP:
+                    return
+                self._records.popleft()
+            self._records.append(record)
+            self.highwater = max(self.highwater, len(self._records))
+            self._cond.notify_all()
+
+    def _run(self):
+        records = self._records
+        while True:
+            with self._cond:
+                while not records and not self._closing:
+                    self._cond.wait()
+                if not records:
+                    return
+                batch = [records.popleft()
+                         for _ in range(min(len(records), self.batchsize))]
+                self._writing = len(batch)
+                self._cond.notify_all()
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._writing = 0
+                    self._cond.notify_all()
+
+    def _write(self, batch):
+        handle_batch = getattr(self.target, 'handle_batch', None)
+        if handle_batch is not None:
+            handle_batch(batch)
+            return
+        for record in batch:
+            self.target.handle(record)
+
+    def flush(self, timeout=None):
+        """Wait until all queued records have been written,
+        or ``timeout`` seconds pass, then flush ``target``."""
+        deadline = None if timeout is None else _time.time() + timeout
+        with self._cond:
+            while self._records or self._writing:
+                if not self.thread.is_alive():
+                    break
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - _time.time()
+                    if remaining <= 0:
+                        break
+                self._cond.wait(remaining)
+        self.target.flush()
+
+    def close(self):
+        """Write all queued records, stop the writer thread,
+        and close ``target``."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self.thread is not _threading.current_thread():
+            self.thread.join()
+        self.target.close()
+        _logging.Handler.close(self)
+
+
+#: Message of the summary records logged by :class:`RateLimitFilter`.
+SUPPRESSED_MSG = 'Suppressed %s similar messages in %.0f seconds: %r'
+
+
+class _RateLimitState(object):
+    __slots__ = ('bucket', 'limited', 'suppressed', 'since', 'used')
+
+    def __init__(self, bucket, since):
+        self.bucket = bucket
+        # Records over the rate, including ones let through by sampling.
+        self.limited = 0
+        self.suppressed = 0
+        self.since = since
+        self.used = 0
+
+
+class RateLimitFilter(_logging.Filter):
+    """Filter that limits how often similar records are logged,
+    so one misbehaving loop cannot flood the logs.
+
+    Records are similar if they have the same logger name, level,
+    and message template (the ``msg`` before args are merged in).
+    Each kind of record gets its own :class:`brennivin.ioutils.TokenBucket`,
+    and records are dropped while their bucket is empty.
+
+    Every ``interval`` seconds, a kind of record that had records dropped
+    logs a summary record (with the :data:`SUPPRESSED_MSG` message)
+    through :meth:`emit_summary` when it is next seen.
+    Call :meth:`flush_summaries` to log any outstanding summaries,
+    such as at shutdown.
+
+    :param rate: Records of each kind allowed per second, on average.
+    :param capacity: Records of each kind allowed in a burst.
+      See :class:`brennivin.ioutils.TokenBucket`.
+    :param sample: If > 0, let through one of every ``sample``
+      rate limited records, so some detail survives a flood.
+    :param maxkeys: Maximum number of kinds of records to track.
+      The least recently seen kind is forgotten when this is exceeded.
+    :param interval: Minimum seconds between summaries for a kind.
+    :param clock: Function returning the current time in seconds.
+    """
+    def __init__(self, rate=10, capacity=None, sample=0, maxkeys=1000,
+                 interval=60, clock=None):
+        _logging.Filter.__init__(self)
+        self.rate = rate
+        self.capacity = capacity
+        self.sample = sample
+        self.maxkeys = maxkeys
+        self.interval = interval
+        self.clock = clock or _ioutils._monotonic
+        #: Total number of records dropped.
+        self.suppressed = 0
+        self._states = {}
+        # (key, use count) pairs, least recently used first.
+        # A pair is stale if the key has been used since,
+        # which is cheaper than moving the key (and works without
+        # OrderedDict, which 2.6 does not have).
+        self._order = _collections.deque()
+        self._uses = 0
+        self._lock = _threading.Lock()
+
+    def _get_state(self, key, now):
+        states = self._states
+        state = states.get(key)
+        if state is None:
+            state = _RateLimitState(_ioutils.TokenBucket(
+                self.rate, self.capacity, block=False, clock=self.clock), now)
+            while len(states) >= self.maxkeys:
+                self._forget_oldest()
+            states[key] = state
+        self._touch(key, state)
+        return state
+
+    def _touch(self, key, state):
+        # Mark key as most recently used.
+        self._uses += 1
+        state.used = self._uses
+        self._order.append((key, self._uses))
+        if len(self._order) > 2 * self.maxkeys + 16:
+            # Drop stale pairs, so the deque doesn't grow forever.
+            self._order = _collections.deque(sorted(
+                ((k, st.used) for k, st in self._states.items()),
+                key=lambda pair: pair[1]))
+
+    def _forget_oldest(self):
+        while True:
+            key, used = self._order.popleft()
+            state = self._states.get(key)
+            if state is not None and state.used == used:
+                del self._states[key]
+                return
+
+    def filter(self, record):
+        msg = record.msg
+        if msg is SUPPRESSED_MSG:
+            return True
+        try:
+            key = (record.name, record.levelno, msg)
+            hash(key)
+        except TypeError:
+            return True
+        summary = None
+        with self._lock:
+            now = self.clock()
+            state = self._get_state(key, now)
+            # Reserve directly, since we already hold a lock and the time.
+            allowed = state.bucket._reserve(now, False) is not None
+            if not allowed:
+                state.limited += 1
+                if self.sample and not state.limited % self.sample:
+                    allowed = True
+                else:
+                    state.suppressed += 1
+                    self.suppressed += 1
+            if state.suppressed and now - state.since >= self.interval:
+                summary = self._make_summary(record, state, now)
+        if summary is not None:
+            self.emit_summary(summary)
+        return allowed
+
+    def _make_summary(self, record, state, now):
+        summary = _logging.LogRecord(
+            record.name, record.levelno, record.pathname, record.lineno,
+            SUPPRESSED_MSG, (state.suppressed, now - state.since, record.msg),
+            None, record.funcName)
+        state.suppressed = 0
+        state.since = now
+        return summary
+
+    def emit_summary(self, record):
+        """Log the summary ``record``. By default, it is passed to
+        the logger the rate limited records were logged to.
+        Override to send it elsewhere, such as to a particular handler
+        if the filter is only on that handler."""
+        _logging.getLogger(record.name).handle(record)
+
+    def flush_summaries(self):
+        """Log a summary for every kind of record that has had
+        records dropped since its last summary."""
+        summaries = []
+        with self._lock:
+            now = self.clock()
+            for (name, levelno, msg), state in self._states.items():
+                if state.suppressed:
+                    record = _logging.LogRecord(
+                        name, levelno, '', 0, msg, None, None)
+                    summaries.append(self._make_summary(record, state, now))
+        for summary in summaries:
+            self.emit_summary(summary)
 
 
 def timestamped_filename(
@@ -97,37 +703,112 @@ def timestamped_filename(
 def timestamp(fmt, timestruct=None):
     """Return timestamp by calling ``time.strftime(fmt, timestruct())``.
 
+    If ``timestruct`` is None, the result for the current second
+    is cached (see :class:`CachedTimestamp`), so calling this often is cheap.
+
     :param fmt: format str, see
       http://docs.python.org/2/library/datetime.html?highlight=time.strftime#strftime-strptime-behavior
       for details
     :param timestruct: 9-tuple, see :py:func:`time.gmtime` for details.
     """
-    return _time.strftime(fmt, timestruct or _time.gmtime())
+    if timestruct is not None:
+        return _time.strftime(fmt, timestruct)
+    cached = _timestamps.get(fmt)
+    if cached is None:
+        if len(_timestamps) > 64:
+            _timestamps.clear()
+        cached = _timestamps[fmt] = CachedTimestamp(fmt)
+    return cached()
+
+
+class CachedTimestamp(object):
+    """Callable that returns the same as
+    ``time.strftime(fmt, converter(seconds))``,
+    but only calls :func:`time.strftime` when the second changes.
+
+    :param fmt: Format string for :func:`time.strftime`.
+    :param converter: Function to convert seconds since the epoch
+      to a time tuple, such as :func:`time.gmtime` (the default)
+      or :func:`time.localtime`.
+    """
+    def __init__(self, fmt, converter=_time.gmtime):
+        self.fmt = fmt
+        self.converter = converter
+        self._last = (None, None)
+
+    def __call__(self, seconds=None):
+        """Return the timestamp for ``seconds`` since the epoch,
+        or the current time if None."""
+        if seconds is None:
+            seconds = _time.time()
+        sec = int(seconds)
+        if sec > seconds:
+            sec -= 1
+        last = self._last
+        if last[0] == sec:
+            return last[1]
+        result = _time.strftime(self.fmt, self.converter(sec))
+        self._last = (sec, result)
+        return result
+
+
+_timestamps = {}
 
 
 def get_timestamped_logfilename(
         folder, basename=None, ext='.log',
         fmt='%Y-%m-%d-%H-%M-%S', timestruct=None,
+        maxfiles=15, background=False, retention=None,
         _getpid=_os.getpid):
     """Using default keyword arguments
     return filename ``<folder>/<basename>_<timestamp>_<pid>.log``
     in the app's folder in ccptechart prefs.
 
+    Old log files are cleaned up with :func:`remove_old_files`,
+    or with :func:`apply_retention` if ``retention`` is given.
+
     :param folder: Folder to put file into.
     :param basename: The prefix of the log filename.
       If None, use ``os.path.basename(folder)``.
+    :param maxfiles: Number of old log files to keep.
+    :param background: If True, clean up old log files on a background
+      thread, so a folder with many files does not delay startup.
+    :param retention: A :class:`RetentionPolicy` or sequence of them
+      to apply instead of ``maxfiles``.
+      Policies without a pattern apply to this log's files.
     """
+    logfilename, pattern = _timestamped_logname(
+        folder, basename, ext, fmt, timestruct, _getpid)
+    _remove_old_logs(folder, pattern, maxfiles, background, retention)
+    return logfilename
+
+
+def _timestamped_logname(folder, basename, ext, fmt, timestruct, getpid):
+    """Return a tuple of the filename for
+    :func:`get_timestamped_logfilename`, and a glob pattern that matches
+    the names of all such files."""
     if basename is None:
         basename = _os.path.basename(folder)
     timestamped = timestamp(fmt, timestruct)
-    pid = _getpid()
+    pid = getpid()
     logname = '{basename}_{timestamped}_pid{pid}{ext}'.format(**locals())
     logfilename = _os.path.join(folder, logname)
+    pattern = '*{basename}_*{ext}'.format(**locals())
+    return logfilename, pattern
+
+
+def _remove_old_logs(folder, pattern, maxfiles, background, retention):
     try:
-        remove_old_files(folder, '*{basename}_*{ext}'.format(**locals()), 15)
+        if retention is None:
+            remove_old_files(folder, pattern, maxfiles, background=background)
+        else:
+            if isinstance(retention, RetentionPolicy):
+                retention = [retention]
+            retention = [p.with_pattern(pattern) if p.pattern is None else p
+                         for p in retention]
+            apply_retention(folder, retention, background=background)
     except OSError:
         pass
-    return logfilename
 
 
 def get_filenames_from_loggers(loggers=None, _loggingmodule=None):
@@ -153,28 +834,394 @@ def get_filenames_from_loggers(loggers=None, _loggingmodule=None):
     return tuple(allfilenames)
 
 
-def remove_old_files(root, namepattern='*', maxfiles=1):
+#: A record read by :class:`LogReader`.
+#: ``offset`` is the byte offset of the record in the file,
+#: ``text`` is its lines joined by newlines,
+#: and ``fields`` is the match's ``groupdict()`` if the reader
+#: has a pattern, or None.
+LogEntry = _collections.namedtuple('LogEntry', 'path offset text fields')
+
+
+class LogReader(object):
+    """Reads the records added to log files since the last read,
+    so scanning logs periodically costs only the new data.
+
+    The reader remembers the byte offset it has read up to in each file,
+    and the file's inode. If a file is rotated (its inode changes),
+    the rest of the old file is read first if it is still
+    in the same directory under another name (such as ``app.log.1``),
+    and then the new file is read from the start.
+    Records in an old file that was removed, compressed,
+    or moved to another directory are lost.
+    A truncated file is read from the start.
+    Files are read in blocks of ``blocksize`` bytes
+    and records are yielded as they are found.
+
+    A record is a line plus any continuation lines after it.
+    By default, lines starting with whitespace are continuations,
+    which is what :class:`MultiLineIndentFormatter` writes.
+    If ``pattern`` is given, lines it matches start a new record,
+    and all other lines are continuations.
+    A line without a newline at the end of a file is not read
+    until it is finished.
+
+    :param statefile: If given, offsets are loaded from this file,
+      and :meth:`save` writes them to it,
+      so another process can continue where this one left off.
+    :param pattern: Regex (string or compiled) matching the first
+      line of a record. Its named groups are the record's ``fields``.
+    :param encoding: Encoding to decode lines with.
+      Undecodable bytes are replaced.
+    """
+    VERSION = 1
+
+    def __init__(self, statefile=None, pattern=None, encoding='utf-8',
+                 blocksize=1024 * 1024):
+        if isinstance(pattern, _compat.StringTypes):
+            pattern = _re.compile(pattern)
+        self.statefile = statefile
+        self.pattern = pattern
+        self.encoding = encoding
+        self.blocksize = blocksize
+        # Absolute path to [inode, offset]
+        self._offsets = {}
+        if statefile and _os.path.isfile(statefile):
+            self.load()
+
+    def read(self, filenames=None):
+        """Return a generator of :data:`LogEntry` instances for the
+        records added to ``filenames`` since they were last read.
+
+        Offsets are updated as records are yielded,
+        so if iteration stops early, the next read continues
+        after the last record that was yielded.
+
+        :param filenames: Files to read. Defaults to
+          :func:`get_filenames_from_loggers`.
+        """
+        if filenames is None:
+            filenames = get_filenames_from_loggers()
+        for filename in filenames:
+            for entry in self._read_file(_os.path.abspath(filename)):
+                yield entry
+
+    def _start_fields(self, text):
+        """Return a tuple of (whether ``text`` starts a record, fields)."""
+        if self.pattern is None:
+            return not text[:1].isspace(), None
+        match = self.pattern.match(text)
+        if match is None:
+            return False, None
+        return True, match.groupdict()
+
+    def _read_file(self, path):
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            self._offsets.pop(path, None)
+            return
+        with f:
+            st = _os.fstat(f.fileno())
+            pos = 0
+            last = self._offsets.get(path)
+            if last is not None and last[0] != st.st_ino:
+                for entry in self._read_rotated(path, last[0], last[1]):
+                    yield entry
+            elif last is not None and last[1] <= st.st_size:
+                pos = last[1]
+            for entry in self._read_from(f, path, path, st.st_ino, pos):
+                yield entry
+
+    def _read_rotated(self, path, ino, pos):
+        """Finish reading the file ``path`` was rotated away from,
+        which is the sibling of ``path`` whose inode is ``ino``.
+        Offsets stay keyed by ``path``,
+        so if iteration stops early, the next read resumes it."""
+        if not ino:
+            return
+        dirname = _os.path.dirname(path)
+        try:
+            names = _os.listdir(dirname)
+        except OSError:
+            return
+        for name in names:
+            sibling = _os.path.join(dirname, name)
+            if sibling == path:
+                continue
+            try:
+                st = _os.stat(sibling)
+            except OSError:
+                continue
+            if st.st_ino != ino or st.st_size < pos:
+                continue
+            try:
+                f = open(sibling, 'rb')
+            except (IOError, OSError):
+                return
+            with f:
+                for entry in self._read_from(f, path, sibling, ino, pos):
+                    yield entry
+            return
+
+    def _read_from(self, f, key, path, ino, pos):
+        """Yield the records in ``f`` after ``pos``,
+        recording offsets under ``key``."""
+        self._offsets[key] = [ino, pos]
+        f.seek(pos)
+        encoding = self.encoding
+        pending = None
+        buf = b''
+        while True:
+            block = f.read(self.blocksize)
+            if not block:
+                break
+            lines = (buf + block).split(b'\n')
+            buf = lines.pop()
+            for line in lines:
+                text = line.decode(encoding, 'replace').rstrip('\r')
+                starts, fields = self._start_fields(text)
+                if pending is not None and starts:
+                    self._offsets[key] = [ino, pos]
+                    yield LogEntry(path, pending[0], '\n'.join(pending[1]),
+                                   pending[2])
+                    pending = None
+                if pending is None:
+                    pending = pos, [text], fields
+                else:
+                    pending[1].append(text)
+                pos += len(line) + 1
+        if pending is not None:
+            self._offsets[key] = [ino, pos]
+            yield LogEntry(path, pending[0], '\n'.join(pending[1]),
+                           pending[2])
+
+    def forget(self, filename):
+        """Forget the offset for ``filename``,
+        so it is read from the start next time."""
+        self._offsets.pop(_os.path.abspath(filename), None)
+
+    def load(self):
+        """Load offsets from :attr:`statefile`.
+        If the file is missing or corrupt, offsets are cleared."""
+        try:
+            with open(self.statefile) as f:
+                data = _json.load(f)
+            if data['version'] != self.VERSION:
+                raise ValueError('Unsupported version.')
+            offsets = dict(data['offsets'])
+        except (ValueError, KeyError, TypeError, IOError, OSError):
+            offsets = {}
+        self._offsets = offsets
+
+    def save(self):
+        """Write offsets to :attr:`statefile`."""
+        data = {'version': self.VERSION, 'offsets': self._offsets}
+        with _osutils.atomic_write(self.statefile,
+                                   fsync=_osutils.FSYNC_NONE) as f:
+            _json.dump(data, f)
+
+
+def remove_old_files(root, namepattern='*', maxfiles=1, background=False):
     """Removes the oldest files that match ``namePattern`` inside of ``rootDir``,
     so that only ``maxfiles`` of those matches remain.
 
+    The directory is listed once with :func:`brennivin.osutils.scan_files`
+    and each file is only stat'ed once,
+    and the newest ``maxfiles`` are selected with a heap,
+    so this stays fast for directories with very many files.
+
     :param maxfiles: Number of files to keep. If 0, remove all files.
+    :param background: If True, do the work on a daemon thread and
+      return the thread. Errors are ignored.
     """
     if maxfiles < 0:
         raise ValueError('maxfiles must be >= 0, got %s' % maxfiles)
+    if background:
+        def cleanup():
+            try:
+                _remove_old_files(root, namepattern, maxfiles)
+            except OSError:
+                pass
+        thread = _threading.Thread(target=cleanup, name='RemoveOldFiles')
+        thread.daemon = True
+        thread.start()
+        return thread
+    _remove_old_files(root, namepattern, maxfiles)
+
 
-    lstFiles = []
-    for f in _os.listdir(root):
-        if _fnmatch.fnmatch(f, namepattern):
-            fileName = _os.path.join(root, f)
-            lstFiles.append(fileName)
-    lstFiles.sort(key=_os.path.getmtime, reverse=True)
-    for f in lstFiles[maxfiles:]:
+def _remove_old_files(root, namepattern, maxfiles):
+    if not _os.path.isdir(root):
+        raise OSError(_errno.ENOENT, _os.strerror(_errno.ENOENT), root)
+    # Min-heap of the newest (mtime, path) seen so far.
+    newest = []
+    toremove = []
+    for entry in _osutils.scan_files(root, namepattern, direntries=True,
+                                     maxdepth=0):
+        try:
+            item = entry.stat().st_mtime, entry.path
+        except OSError:
+            continue
+        if len(newest) < maxfiles:
+            _heapq.heappush(newest, item)
+        elif maxfiles:
+            toremove.append(_heapq.heappushpop(newest, item)[1])
+        else:
+            toremove.append(item[1])
+    for f in toremove:
         try:
             _os.remove(f)
         except (OSError, IOError):
             pass
 
 
+class RetentionPolicy(object):
+    """Limits on the files matching ``pattern`` in a directory,
+    applied by :func:`apply_retention`.
+    The oldest files (by modification time) are removed first.
+
+    :param pattern: Glob pattern for the basenames of files
+      the policy applies to. Gzipped files (with an added ``.gz``)
+      are included. If None, the policy applies to all files,
+      or for :func:`get_timestamped_logfilename`, to that log's files.
+    :param maxfiles: Number of files to keep.
+    :param maxbytes: Maximum total size of the files, in bytes.
+    :param maxage: Remove files not modified for this many seconds.
+    :param compress: If not None, gzip files not modified for
+      this many seconds. Use a value large enough that
+      files still being written to are not compressed.
+    """
+    def __init__(self, pattern=None, maxfiles=None, maxbytes=None,
+                 maxage=None, compress=None):
+        for name, value in [('maxfiles', maxfiles), ('maxbytes', maxbytes),
+                            ('maxage', maxage), ('compress', compress)]:
+            if value is not None and value < 0:
+                raise ValueError('%s must be >= 0, got %s' % (name, value))
+        self.pattern = pattern
+        self.maxfiles = maxfiles
+        self.maxbytes = maxbytes
+        self.maxage = maxage
+        self.compress = compress
+
+    def with_pattern(self, pattern):
+        """Return a copy of this policy for ``pattern``."""
+        return RetentionPolicy(pattern, self.maxfiles, self.maxbytes,
+                               self.maxage, self.compress)
+
+    def __repr__(self):
+        return 'RetentionPolicy(%r, maxfiles=%r, maxbytes=%r, maxage=%r, ' \
+               'compress=%r)' % (self.pattern, self.maxfiles, self.maxbytes,
+                                 self.maxage, self.compress)
+
+    def apply(self, files, now):
+        """Apply the policy to ``files``, a list of
+        ``[mtime, size, path]`` lists, newest first.
+        Return the paths of the files that were not removed."""
+        kept = []
+        for i, (mtime, size, path) in enumerate(files):
+            if ((self.maxfiles is not None and i >= self.maxfiles) or
+                    (self.maxage is not None and now - mtime > self.maxage)):
+                _remove_quietly(path)
+            else:
+                kept.append([mtime, size, path])
+        if self.compress is not None:
+            for item in kept:
+                mtime, _, path = item
+                if not path.endswith('.gz') and now - mtime > self.compress:
+                    try:
+                        item[2], item[1] = _gzip_file(path)
+                    except (OSError, IOError):
+                        pass
+        total = 0
+        result = []
+        for _, size, path in kept:
+            total += size
+            if self.maxbytes is not None and total > self.maxbytes:
+                _remove_quietly(path)
+            else:
+                result.append(path)
+        return result
+
+
+def _remove_quietly(path):
+    try:
+        _os.remove(path)
+    except (OSError, IOError):
+        pass
+
+
+def _gzip_file(path):
+    """Replace ``path`` with a gzipped ``path + '.gz'``,
+    with the same modification time.
+    Return the new path and its size."""
+    gzpath = path + '.gz'
+    st = _os.stat(path)
+    with _osutils.atomic_write(gzpath, 'wb', fsync=_osutils.FSYNC_NONE) as f:
+        dst = _gzip.GzipFile(_os.path.basename(path), 'wb',
+                             fileobj=f, mtime=st.st_mtime)
+        try:
+            with open(path, 'rb') as src:
+                _shutil.copyfileobj(src, dst, 1024 * 1024)
+        finally:
+            dst.close()
+    _os.utime(gzpath, (st.st_atime, st.st_mtime))
+    _os.remove(path)
+    return gzpath, _os.path.getsize(gzpath)
+
+
+def apply_retention(root, policies, background=False):
+    """Apply the :class:`RetentionPolicy` instances in ``policies``
+    to the files in directory ``root``.
+
+    The directory is listed once, and each file is handled by the first
+    policy with a matching pattern, so per-pattern quotas can be set up
+    with more specific patterns first.
+    Age limits use the current time.
+
+    :param background: If True, do the work on a daemon thread and
+      return the thread. Errors are ignored.
+      Useful since compressing can take a while.
+    :return: If not ``background``, a list of the paths that were kept.
+    """
+    if isinstance(policies, RetentionPolicy):
+        policies = [policies]
+    if background:
+        def cleanup():
+            try:
+                _apply_retention(root, policies)
+            except OSError:
+                pass
+        thread = _threading.Thread(target=cleanup, name='ApplyRetention')
+        thread.daemon = True
+        thread.start()
+        return thread
+    return _apply_retention(root, policies)
+
+
+def _apply_retention(root, policies):
+    if not _os.path.isdir(root):
+        raise OSError(_errno.ENOENT, _os.strerror(_errno.ENOENT), root)
+    matchers = []
+    for policy in policies:
+        pattern = policy.pattern or '*'
+        regex = _osutils._compile_globs([pattern, pattern + '.gz'])
+        matchers.append((regex.match, []))
+    for entry in _osutils.scan_files(root, direntries=True, maxdepth=0):
+        for match, files in matchers:
+            if match(entry.name):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    break
+                files.append([st.st_mtime, st.st_size, entry.path])
+                break
+    now = _time.time()
+    kept = []
+    for policy, (_, files) in zip(policies, matchers):
+        files.sort(reverse=True)
+        kept.extend(policy.apply(files, now))
+    return kept
+
+
 def wrap_line(s, maxlines, maxlen=254, pfx="- "):
     """
     :param s: input string
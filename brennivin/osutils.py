@@ -6,21 +6,79 @@ Members
 =======
 """
 
-import binascii as _binascii
 import contextlib as _contextlib
 import errno as _errno
 import fnmatch as _fnmatch
+import hashlib as _hashlib
+import json as _json
+from multiprocessing.pool import ThreadPool as _ThreadPool
 import ntpath
 import os as _os
+import posixpath as _posixpath
+import re as _re
 import shutil as _shutil
 import stat as _stat
+import sys as _sys
 import tempfile as _tempfile
 import threading as _threading
+import time as _time
+import zlib as _zlib
+
+from . import compat as _compat
 
 altsep = _os.altsep
 if altsep is None:
     altsep = _os.sep
 
+try:
+    _scandir = _os.scandir
+except AttributeError:
+    try:
+        # noinspection PyUnresolvedReferences,PyPackageRequirements
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+if hasattr(_os, 'replace'):
+    _replace = _os.replace
+elif _sys.platform == 'win32':
+    _MOVEFILE_REPLACE_EXISTING = 0x1
+
+    def _replace(src, dst):
+        """:func:`os.replace` for Python 2 on Windows,
+        where :func:`os.rename` fails if ``dst`` exists."""
+        import ctypes
+        paths = []
+        for path in src, dst:
+            if isinstance(path, bytes):
+                path = path.decode(_sys.getfilesystemencoding())
+            paths.append(path)
+        if not ctypes.windll.kernel32.MoveFileExW(
+                paths[0], paths[1], _MOVEFILE_REPLACE_EXISTING):
+            raise ctypes.WinError()
+else:
+    _replace = _os.rename
+
+
+def _get_memoryview():
+    """Return ``memoryview`` if checksums and hashes accept it,
+    else None. Python 2.6 does not have memoryview,
+    and on 2.7 zlib and hashlib reject it."""
+    try:
+        view = memoryview(b'')
+        _zlib.crc32(view)
+        _zlib.adler32(view)
+        _hashlib.md5(view)
+    except (NameError, TypeError):
+        return None
+    return memoryview
+
+_memoryview = _get_memoryview()
+
+# Temporary files used for atomic writes and copies are named like this.
+_PARTIAL_PREFIX = '.brennivin-'
+_PARTIAL_SUFFIX = '.partial'
+
 
 def abspathex(path, relative_to, _ignore_this=False):
     """Returns a normalized absoluted version of the pathname ``path``,
@@ -29,18 +87,22 @@ def abspathex(path, relative_to, _ignore_this=False):
 
     :param path: The relative path to make absolute.
     :param relative_to: The filename to make path absolute to.
-      This path will be made absolute before using it.
+      This path will be made absolute before using it,
+      and symlinks in it are resolved.
     :param _ignore_this: For internal use only.
+    :raise OSError: If ``relative_to`` is not a directory.
 
-    NOTE: This actually works by changing the cwd temporarily,
-    but will always set it back.
-    That said, there could be some side effects so use with care.
+    This used to work by changing the cwd temporarily,
+    but is now done purely with paths,
+    so it is thread safe and does not affect the cwd.
     """
-    absRelativeTo = _os.path.abspath(relative_to)
-    with change_cwd(absRelativeTo):
-        if _ignore_this:
-            raise ArithmeticError
-        return _os.path.abspath(path)
+    absRelativeTo = _os.path.realpath(relative_to)
+    if not _os.path.isdir(absRelativeTo):
+        err = _errno.ENOTDIR if _os.path.exists(absRelativeTo) else _errno.ENOENT
+        raise OSError(err, _os.strerror(err), relative_to)
+    if _ignore_this:
+        raise ArithmeticError
+    return _os.path.normpath(_os.path.join(absRelativeTo, path))
 
 
 _changecwd_lock = _threading.Lock()
@@ -50,6 +112,10 @@ _changecwd_lock = _threading.Lock()
 def change_cwd(cwd):
     """Context manager for temporarily changing the cwd.
 
+    The cwd is process-wide, so calls are serialized with a lock,
+    and other threads will see the changed cwd.
+    Prefer :class:`WorkingDir` where possible.
+
     :param cwd: The directory to use as the cwd.
     """
     orig = None
@@ -64,6 +130,179 @@ def change_cwd(cwd):
         _changecwd_lock.release()
 
 
+class WorkingDir(object):
+    """A cwd-independent alternative to :func:`change_cwd`.
+    Rather than changing the process's cwd,
+    relative paths are resolved against :attr:`path`,
+    and it is passed as ``cwd`` to :mod:`subprocess` calls.
+    Instances are immutable so they can be shared between threads.
+
+    Can be used as a context manager, so::
+
+        with osutils.change_cwd(d):
+            subprocess.check_call(['make'])
+            data = open('out.txt').read()
+
+    becomes::
+
+        with osutils.WorkingDir(d) as wd:
+            wd.check_call(['make'])
+            data = wd.open('out.txt').read()
+
+    :param path: The directory to use as the working directory.
+      Made absolute against the current cwd.
+    """
+    def __init__(self, path):
+        self.path = _os.path.abspath(path)
+
+    def abspath(self, path):
+        """Like ``os.path.abspath(path)`` if :attr:`path` were the cwd."""
+        return _os.path.normpath(_os.path.join(self.path, path))
+
+    def sub(self, path):
+        """Return a new instance for ``path``
+        relative to this working directory."""
+        return type(self)(self.abspath(path))
+
+    def exists(self, path):
+        return _os.path.exists(self.abspath(path))
+
+    def isdir(self, path):
+        return _os.path.isdir(self.abspath(path))
+
+    def isfile(self, path):
+        return _os.path.isfile(self.abspath(path))
+
+    def listdir(self, path='.'):
+        return _os.listdir(self.abspath(path))
+
+    def open(self, path, *args, **kwargs):
+        """Like the builtin ``open``."""
+        return open(self.abspath(path), *args, **kwargs)
+
+    def _subprocess(self, funcname, args, kwargs):
+        import subprocess
+        kwargs.setdefault('cwd', self.path)
+        return getattr(subprocess, funcname)(args, **kwargs)
+
+    def popen(self, args, **kwargs):
+        """Like :class:`subprocess.Popen`, with ``cwd`` defaulting to
+        :attr:`path`."""
+        return self._subprocess('Popen', args, kwargs)
+
+    def call(self, args, **kwargs):
+        """Like :func:`subprocess.call`, see :meth:`popen`."""
+        return self._subprocess('call', args, kwargs)
+
+    def check_call(self, args, **kwargs):
+        """Like :func:`subprocess.check_call`, see :meth:`popen`."""
+        return self._subprocess('check_call', args, kwargs)
+
+    def check_output(self, args, **kwargs):
+        """Like :func:`subprocess.check_output`, see :meth:`popen`."""
+        return self._subprocess('check_output', args, kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    def __repr__(self):
+        return 'WorkingDir(%r)' % self.path
+
+
+FSYNC_NONE = 'none'
+FSYNC_FILE = 'file'
+FSYNC_DIR = 'dir'
+
+
+def _make_partial(dirname):
+    """Create an empty temporary file in ``dirname`` for an atomic write,
+    and return its path.
+    Unlike :func:`mktemp`, the file gets the normal permissions
+    for the process's current umask."""
+    flags = _os.O_WRONLY | _os.O_CREAT | _os.O_EXCL
+    while True:
+        name = ''.join('%02x' % b for b in bytearray(_os.urandom(8)))
+        path = _os.path.join(
+            dirname, _PARTIAL_PREFIX + name + _PARTIAL_SUFFIX)
+        try:
+            fd = _os.open(path, flags, 0o666)
+        except OSError as ex:
+            if ex.errno == _errno.EEXIST:
+                continue
+            raise
+        _os.close(fd)
+        return path
+
+
+def _fsync_dir(dirname):
+    """fsync a directory, so a rename inside it is durable.
+    Not possible on all platforms (such as Windows), so errors are ignored.
+    """
+    try:
+        fd = _os.open(dirname, _os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        _os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        _os.close(fd)
+
+
+@_contextlib.contextmanager
+def atomic_write(filename, mode='w', fsync=FSYNC_FILE):
+    """Context manager that yields a file object for writing to
+    ``filename`` atomically.
+    The data is written to a temporary file in the same directory,
+    which is renamed over ``filename`` on exit.
+    If an error is raised, ``filename`` is left untouched.
+
+    An existing file's permission bits are kept,
+    new files get the normal permissions for the process's umask.
+    If ``filename`` is a symlink, the file it points to is replaced.
+
+    :param mode: Mode to open the file with, ``'w'`` or ``'wb'``.
+    :param fsync: How durable the write must be when the context exits.
+      :data:`FSYNC_NONE` does not fsync at all,
+      so data may be lost on a system crash (but the file will
+      never be truncated). :data:`FSYNC_FILE` fsyncs the file's
+      data before the rename. :data:`FSYNC_DIR` also fsyncs the directory
+      after the rename, so the rename itself survives a crash.
+    """
+    if not mode.startswith('w'):
+        raise ValueError('mode must be a write mode, got %r' % mode)
+    if fsync not in (FSYNC_NONE, FSYNC_FILE, FSYNC_DIR):
+        raise ValueError('Invalid fsync policy: %r' % fsync)
+    filename = _os.path.realpath(filename)
+    dirname = _os.path.dirname(filename)
+    tmp = _make_partial(dirname)
+    done = False
+    try:
+        with open(tmp, mode) as f:
+            yield f
+            f.flush()
+            if fsync != FSYNC_NONE:
+                _os.fsync(f.fileno())
+        try:
+            _shutil.copymode(filename, tmp)
+        except (IOError, OSError):
+            pass
+        _replace(tmp, filename)
+        done = True
+    finally:
+        if not done:
+            try:
+                _os.remove(tmp)
+            except OSError:
+                pass
+    if fsync == FSYNC_DIR:
+        _fsync_dir(dirname)
+
+
 @_contextlib.contextmanager
 def change_environ(key, newvalue):
     """Context manager for temporarily changing an os.environ entry.
@@ -95,6 +334,32 @@ def change_ext(path, ext):
     return root + ext_
 
 
+def change_ext_many(paths, ext):
+    """Returns a list of ``paths`` with their extension changed to ``ext``.
+    Same as calling :func:`change_ext` on each path, but faster."""
+    paths = list(paths)
+    if _os.path is _posixpath:
+        try:
+            return _change_ext_posix(paths, ext)
+        except (TypeError, AttributeError):
+            pass
+    splitext = _os.path.splitext
+    return [splitext(p)[0] + ext for p in paths]
+
+
+def _change_ext_posix(paths, ext):
+    # posixpath.splitext, inlined. Raises TypeError for bytes.
+    result = []
+    append = result.append
+    for p in paths:
+        sepidx = p.rfind('/')
+        dotidx = p.rfind('.')
+        if dotidx > sepidx and p[sepidx + 1:dotidx].lstrip('.'):
+            p = p[:dotidx]
+        append(p + ext)
+    return result
+
+
 def copy(src, dst):
     """Copies src to dst,
     recursively making directories for dst if they do not exist.
@@ -107,21 +372,753 @@ def copy(src, dst):
     _shutil.copy(src, dst)
 
 
+class CopyStats(object):
+    """Results of a bulk copy, such as from :func:`copy_files`.
+
+    :ivar files: Number of files copied.
+    :ivar bytes: Number of bytes copied.
+    :ivar skipped: Number of files skipped because they were unchanged.
+    :ivar elapsed: Wall time of the copy, in seconds.
+    """
+    def __init__(self, files=0, bytes=0, skipped=0, elapsed=0.0):
+        self.files = files
+        self.bytes = bytes
+        self.skipped = skipped
+        self.elapsed = elapsed
+
+    @property
+    def files_per_sec(self):
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return ('CopyStats(files=%s, bytes=%s, skipped=%s, elapsed=%.3f, '
+                'files_per_sec=%.1f, bytes_per_sec=%.1f)' % (
+                    self.files, self.bytes, self.skipped, self.elapsed,
+                    self.files_per_sec, self.bytes_per_sec))
+
+
+_copy_file_range = getattr(_os, 'copy_file_range', None)
+_sendfile = getattr(_os, 'sendfile', None)
+if not _sys.platform.startswith('linux'):
+    # Only Linux supports sendfile to a regular file.
+    _sendfile = None
+# Errors meaning a zero-copy call isn't supported for these files,
+# so we should fall back to a regular copy.
+_ZEROCOPY_ERRNOS = set(getattr(_errno, name) for name in (
+    'EXDEV', 'ENOSYS', 'EINVAL', 'ENOTSUP', 'EOPNOTSUPP', 'EBADF', 'EPERM')
+    if hasattr(_errno, name))
+
+
+def _zerocopy(func, infd, outfd, size):
+    """Copy with ``func`` (``os.copy_file_range`` or ``os.sendfile``).
+    Return False if nothing was copied because the call isn't supported."""
+    offset = 0
+    blocksize = min(max(size, 8 * 1024 * 1024), 1024 * 1024 * 1024)
+    while True:
+        try:
+            if func is _sendfile:
+                sent = func(outfd, infd, offset, blocksize)
+            else:
+                sent = func(infd, outfd, blocksize)
+        except OSError as ex:
+            if offset == 0 and ex.errno in _ZEROCOPY_ERRNOS:
+                return False
+            raise
+        if not sent:
+            return True
+        offset += sent
+
+
+def _copyfile(src, dst):
+    """Copy the contents of ``src`` to ``dst`` using the kernel's zero-copy
+    calls where available, then copy over permission bits and times.
+    Return the number of bytes copied."""
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            infd, outfd = fsrc.fileno(), fdst.fileno()
+            size = _os.fstat(infd).st_size
+            copied = False
+            for func in (_copy_file_range, _sendfile):
+                if func is not None and size:
+                    copied = _zerocopy(func, infd, outfd, size)
+                    if copied:
+                        break
+            if not copied:
+                _shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    _shutil.copystat(src, dst)
+    return size
+
+
+def _copyfile_atomic(src, dst):
+    """Like :func:`_copyfile`, but copy to a temporary file next to ``dst``
+    and then move it over ``dst``, so ``dst`` is never partially written."""
+    tmp = mktemp(prefix=_PARTIAL_PREFIX, suffix=_PARTIAL_SUFFIX,
+                 dir=_os.path.dirname(dst) or '.')
+    done = False
+    try:
+        size = _copyfile(src, tmp)
+        _replace(tmp, dst)
+        done = True
+    finally:
+        if not done:
+            try:
+                _os.remove(tmp)
+            except OSError:
+                pass
+    return size
+
+
+# Timestamp precisions (in nanoseconds) of common filesystems,
+# coarsest first: FAT, whole seconds, milliseconds, microseconds, NTFS.
+_MTIME_STEPS = (2 * 10 ** 9, 10 ** 9, 10 ** 6, 10 ** 3, 100)
+
+
+def _same_mtime(srcstat, dststat):
+    """Return True if the stat results have the same mtime,
+    to the precision that copying the time to the destination keeps.
+
+    The destination's precision is guessed from its mtime,
+    so a copy on a filesystem that stores coarse times (like FAT or SMB)
+    is not seen as changed. Without ``st_mtime_ns`` (Python 2),
+    times are only set and read to the microsecond.
+    """
+    src = _mtime_ns(srcstat)
+    dst = _mtime_ns(dststat)
+    if src == dst:
+        return True
+    tolerance = 1
+    if not hasattr(dststat, 'st_mtime_ns'):
+        tolerance = 2000
+    for step in _MTIME_STEPS:
+        if not dst % step:
+            tolerance = max(tolerance, step)
+            break
+    return abs(src - dst) < tolerance
+
+
+def _is_unchanged(srcstat, dst):
+    """Return True if ``dst`` has the same size and mtime
+    (see :func:`_same_mtime`) as the stat result ``srcstat``."""
+    try:
+        dststat = _os.stat(dst)
+    except OSError:
+        return False
+    return (dststat.st_size == srcstat.st_size and
+            _same_mtime(srcstat, dststat))
+
+
+def copy_files(pairs, workers=8, skip_unchanged=True, atomic=False):
+    """Copy many files in parallel.
+
+    Each destination directory is created once up front,
+    and contents are copied using ``os.copy_file_range`` or ``os.sendfile``
+    where available, so data does not pass through Python.
+    Unlike :func:`copy`, times are copied along with permission bits,
+    so unchanged files can be detected on the next copy.
+
+    :param pairs: Iterable of ``(src, dst)`` filenames.
+    :param workers: Number of threads to copy on.
+      If 1 or less, copy on the calling thread.
+    :param skip_unchanged: If True, do not copy files where ``dst``
+      has the same size and mtime as ``src``.
+    :param atomic: If True, copy to a temporary file next to ``dst``
+      and move it into place,
+      so an interrupted copy never leaves a partial ``dst``.
+    :rtype: CopyStats
+    """
+    start = _time.time()
+    copyfile = _copyfile_atomic if atomic else _copyfile
+    pairs = list(pairs)
+    created = set()
+    for dirname in sorted(set(_os.path.dirname(dst) for _, dst in pairs)):
+        if dirname and dirname not in created:
+            makedirs(dirname)
+            created.add(dirname)
+
+    def copyone(pair):
+        src, dst = pair
+        if skip_unchanged and _is_unchanged(_os.stat(src), dst):
+            return None
+        return copyfile(src, dst)
+
+    stats = CopyStats()
+    if workers <= 1:
+        results = map(copyone, pairs)
+        pool = None
+    else:
+        pool = _ThreadPool(workers)
+        results = pool.imap_unordered(copyone, pairs, 16)
+    try:
+        for copied in results:
+            if copied is None:
+                stats.skipped += 1
+            else:
+                stats.files += 1
+                stats.bytes += copied
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    stats.elapsed = _time.time() - start
+    return stats
+
+
+def copy_tree(srcdir, dstdir, pattern='*', workers=8, skip_unchanged=True,
+              **kwargs):
+    """Copy all files under ``srcdir`` that match ``pattern``
+    to the same relative paths under ``dstdir``.
+    See :func:`copy_files` for how files are copied.
+
+    :param kwargs: Passed to :func:`scan_files`,
+      such as to exclude files or prune directories.
+    :rtype: CopyStats
+    """
+    pairs = []
+    for src in scan_files(srcdir, pattern, **kwargs):
+        relpath = _os.path.relpath(src, srcdir)
+        pairs.append((src, _os.path.join(dstdir, relpath)))
+    return copy_files(pairs, workers, skip_unchanged)
+
+
+class SyncPlan(object):
+    """The changes :func:`sync_tree` makes (or would make, on a dry run).
+
+    :ivar copies: List of ``(src, dst)`` pairs of new or changed files.
+    :ivar touches: List of ``(src, dst)`` pairs whose contents are the
+      same but whose times differ (only when syncing by checksum).
+    :ivar deletes: List of files in the destination to delete.
+    :ivar unchanged: Number of files already up to date.
+    :ivar stats: :class:`CopyStats` of the copy,
+      or None if the plan was not executed.
+    """
+    def __init__(self):
+        self.copies = []
+        self.touches = []
+        self.deletes = []
+        self.unchanged = 0
+        self.stats = None
+
+    def __repr__(self):
+        return 'SyncPlan(copies=%s, touches=%s, deletes=%s, unchanged=%s)' % (
+            len(self.copies), len(self.touches), len(self.deletes),
+            self.unchanged)
+
+
+def _scan_relative(directory, workers, kwargs):
+    """Return a dict of relpath to DirEntry for files under ``directory``,
+    along with any partial files left from an interrupted sync."""
+    entries = {}
+    partials = []
+    for entry in scan_files(directory, workers=workers, direntries=True,
+                            **kwargs):
+        name = entry.name
+        if name.startswith(_PARTIAL_PREFIX) and name.endswith(_PARTIAL_SUFFIX):
+            partials.append(entry.path)
+        else:
+            entries[_os.path.relpath(entry.path, directory)] = entry
+    return entries, partials
+
+
+def _remove_empty_dirs(path, root):
+    """Remove ``path`` and its parents, up to but excluding ``root``,
+    while they are empty."""
+    root = _os.path.abspath(root)
+    path = _os.path.abspath(path)
+    while path != root and path.startswith(root):
+        try:
+            _os.rmdir(path)
+        except OSError:
+            return
+        path = _os.path.dirname(path)
+
+
+def sync_tree(srcdir, dstdir, delete=False, checksum=False, dry_run=False,
+              workers=8, **kwargs):
+    """Mirror the files under ``srcdir`` to ``dstdir``,
+    only copying files that are new or changed.
+
+    Both trees are scanned (in parallel) and compared by file size and mtime,
+    so the time spent copying scales with the size of the change.
+    Files are copied with :func:`copy_files` atomically,
+    so a sync that is interrupted can simply be run again.
+    Partial files left over from an interrupted sync are removed.
+
+    :param delete: If True, delete files in ``dstdir`` that are not in
+      ``srcdir``, along with directories that become empty.
+    :param checksum: If True, files with the same size but different mtimes
+      are compared by their contents (see :func:`hash_files`).
+      Files with the same contents only have their times updated.
+    :param dry_run: If True, do not change anything,
+      just return the plan.
+    :param workers: Number of threads to scan, hash, and copy on.
+    :param kwargs: Passed to :func:`scan_files` for both trees,
+      such as to exclude files or prune directories.
+    :rtype: SyncPlan
+    """
+    plan = SyncPlan()
+    srcentries, _ = _scan_relative(srcdir, workers, kwargs)
+    dstentries, partials = _scan_relative(dstdir, workers, kwargs)
+    tocompare = []
+    for relpath, srcentry in srcentries.items():
+        dstentry = dstentries.get(relpath)
+        pair = srcentry.path, _os.path.join(dstdir, relpath)
+        if dstentry is None:
+            plan.copies.append(pair)
+            continue
+        srcstat, dststat = srcentry.stat(), dstentry.stat()
+        if srcstat.st_size != dststat.st_size:
+            plan.copies.append(pair)
+        elif _same_mtime(srcstat, dststat):
+            plan.unchanged += 1
+        elif checksum:
+            tocompare.append(pair)
+        else:
+            plan.copies.append(pair)
+    if tocompare:
+        digests = hash_files(
+            [p for pair in tocompare for p in pair], workers=workers)
+        for pair in tocompare:
+            if digests[pair[0]] == digests[pair[1]]:
+                plan.touches.append(pair)
+            else:
+                plan.copies.append(pair)
+    if delete:
+        plan.deletes = sorted(
+            entry.path for relpath, entry in dstentries.items()
+            if relpath not in srcentries)
+    plan.copies.sort()
+    plan.touches.sort()
+    if dry_run:
+        return plan
+
+    for partial in partials:
+        try:
+            _os.remove(partial)
+        except OSError:
+            pass
+    plan.stats = copy_files(plan.copies, workers, False, atomic=True)
+    for src, dst in plan.touches:
+        _shutil.copystat(src, dst)
+    for path in plan.deletes:
+        _os.remove(path)
+        _remove_empty_dirs(_os.path.dirname(path), dstdir)
+    return plan
+
+
 def crc_from_filename(filename):
-    """Returns the 32-bit crc for the file at filename."""
+    """Returns the 32-bit crc for the file at filename.
+    The file is read in chunks, see :func:`hash_filename`."""
+    return hash_filename(filename, 'crc32')
+
+
+class _Checksum(object):
+    """:mod:`hashlib`-like interface for :mod:`zlib`'s running checksums.
+    :meth:`digest` returns an unsigned int."""
+    def __init__(self, name, func, start):
+        self.name = name
+        self._func = func
+        self._value = start
+
+    def update(self, data):
+        self._value = self._func(data, self._value)
+
+    def digest(self):
+        # See python docs for reason for &
+        return self._value & 0xffffffff
+
+HASH_ALGORITHMS = ('crc32', 'adler32', 'md5', 'sha1', 'sha256', 'blake2')
+
+
+def new_hasher(algorithm):
+    """Return a new hash object for ``algorithm``,
+    which can be any name in :data:`HASH_ALGORITHMS`
+    or supported by :func:`hashlib.new`.
+    ``'blake2'`` is an alias for ``'blake2b'``.
+
+    Checksum algorithms (crc32 and adler32) return unsigned ints
+    from ``digest()``. Other algorithms are :mod:`hashlib` objects.
+    """
+    if algorithm == 'crc32':
+        return _Checksum(algorithm, _zlib.crc32, 0)
+    if algorithm == 'adler32':
+        return _Checksum(algorithm, _zlib.adler32, 1)
+    if algorithm == 'blake2':
+        algorithm = 'blake2b'
+    return _hashlib.new(algorithm)
+
+
+def _hexdigest(hasher):
+    if isinstance(hasher, _Checksum):
+        return hasher.digest()
+    return hasher.hexdigest()
+
+
+_hashbuffers = _threading.local()
+
+
+def _hashbuffer(bufsize):
+    """Return a buffer of ``bufsize`` for the calling thread,
+    so hashing many files does not allocate a buffer for each."""
+    buf = getattr(_hashbuffers, 'buf', None)
+    if buf is None or len(buf) != bufsize:
+        buf = _hashbuffers.buf = bytearray(bufsize)
+    return buf
+
+
+def hash_filename(filename, algorithms='crc32', bufsize=1024 * 1024):
+    """Hash the contents of ``filename``,
+    streaming it through a reusable buffer
+    so memory use does not depend on the file size.
+
+    :param algorithms: Name of an algorithm, or sequence of names,
+      see :func:`new_hasher`.
+      All algorithms are computed in a single pass over the file.
+    :param bufsize: Number of bytes to read at a time.
+    :return: If ``algorithms`` is a string, the digest for that algorithm:
+      an int for checksums like crc32, a hex string otherwise.
+      If it is a sequence, a dict of algorithm name to digest.
+    """
+    single = isinstance(algorithms, _compat.StringTypes)
+    if single:
+        algorithms = [algorithms]
+    hashers = [new_hasher(a) for a in algorithms]
+    buf = _hashbuffer(bufsize)
+    view = None if _memoryview is None else _memoryview(buf)
     with open(filename, 'rb') as f:
-        data = f.read()
-    # See python docs for reason for &
-    return _binascii.crc32(data) & 0xffffffff
+        while True:
+            read = f.readinto(buf)
+            if not read:
+                break
+            if view is None:
+                chunk = bytes(buf[:read])
+            else:
+                chunk = view[:read]
+            for h in hashers:
+                h.update(chunk)
+    if single:
+        return _hexdigest(hashers[0])
+    return dict((a, _hexdigest(h)) for a, h in zip(algorithms, hashers))
+
+
+def _mtime_ns(st):
+    try:
+        return st.st_mtime_ns
+    except AttributeError:
+        return int(st.st_mtime * 1e9)
+
+
+class HashCache(object):
+    """Remembers file digests calculated by :func:`hash_files`,
+    keyed on the file's absolute path, size, mtime (in nanoseconds),
+    and inode, so unchanged files never need to be read again.
+
+    The cache can be persisted to a json file between runs.
+    It is safe to use from multiple threads.
+
+    :param filename: If provided, load entries from this file,
+      and :meth:`save` will write to it.
+      A missing or corrupt file is treated as an empty cache.
+    :param algorithm: The algorithm the digests are for,
+      see :func:`new_hasher`.
+      Entries saved for a different algorithm are discarded on load.
+    """
+    VERSION = 1
+
+    def __init__(self, filename=None, algorithm='crc32'):
+        self.filename = filename
+        self.algorithm = algorithm
+        self._entries = {}
+        self._lock = _threading.Lock()
+        if filename and _os.path.isfile(filename):
+            self.load()
+
+    @staticmethod
+    def _key(st):
+        return [st.st_size, _mtime_ns(st), st.st_ino]
+
+    def get(self, path, st):
+        """Return the digest for ``path`` if it is cached and
+        ``st`` (the result of ``os.stat(path)``) has not changed,
+        otherwise None."""
+        entry = self._entries.get(_os.path.abspath(path))
+        if entry is not None and entry[:3] == self._key(st):
+            return entry[3]
+        return None
+
+    def set(self, path, st, digest):
+        """Cache ``digest`` for ``path`` with stat result ``st``."""
+        entry = self._key(st) + [digest]
+        with self._lock:
+            self._entries[_os.path.abspath(path)] = entry
+
+    def discard(self, path):
+        """Remove any entry for ``path``."""
+        with self._lock:
+            self._entries.pop(_os.path.abspath(path), None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """Replace the entries with those in :attr:`filename`."""
+        try:
+            with open(self.filename) as f:
+                data = _json.load(f)
+            if (data['version'] != self.VERSION or
+                    data['algorithm'] != self.algorithm):
+                data['entries'] = {}
+            entries = dict(data['entries'])
+        except (ValueError, KeyError, TypeError, IOError, OSError):
+            entries = {}
+        with self._lock:
+            self._entries = entries
+
+    def save(self):
+        """Write the entries to :attr:`filename`."""
+        with self._lock:
+            data = {'version': self.VERSION,
+                    'algorithm': self.algorithm,
+                    'entries': dict(self._entries)}
+        dirname = _os.path.dirname(self.filename)
+        if dirname:
+            makedirs(dirname)
+        # The cache is easily rebuilt, so do not pay for durability.
+        with atomic_write(self.filename, fsync=FSYNC_NONE) as f:
+            _json.dump(data, f)
+
+
+def hash_files(filenames, algorithm='crc32', workers=8, cache=None,
+               bufsize=1024 * 1024):
+    """Hash many files in parallel, see :func:`hash_filename`.
+
+    :param filenames: Iterable of file paths.
+    :param algorithm: Name of the algorithm to use.
+    :param workers: Number of threads to hash on.
+      If 1 or less, hash on the calling thread.
+    :param cache: A :class:`HashCache` to look up and store digests.
+      Files whose size, mtime, and inode match the cache are not read.
+      You are responsible for calling :meth:`HashCache.save`.
+    :return: Dict of filename to digest.
+    """
+    if cache is not None and cache.algorithm != algorithm:
+        raise ValueError('cache is for %s, not %s.'
+                         % (cache.algorithm, algorithm))
+
+    def hashone(path):
+        st = _os.stat(path)
+        digest = None
+        if cache is not None:
+            digest = cache.get(path, st)
+        if digest is None:
+            digest = hash_filename(path, algorithm, bufsize)
+            if cache is not None:
+                cache.set(path, st, digest)
+        return path, digest
+
+    if workers <= 1:
+        return dict(hashone(f) for f in filenames)
+    pool = _ThreadPool(workers)
+    try:
+        return dict(pool.imap_unordered(hashone, filenames, 16))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iter_files(directory, pattern='*', **kwargs):
+    """Returns a generator of files under directory that match pattern.
+
+    :param kwargs: Passed to :func:`scan_files`, such as to exclude files
+      or prune directories.
+    """
+    return scan_files(directory, pattern, **kwargs)
+
+
+class DirIndex(object):
+    """In-memory index of the files under ``root``,
+    for answering many :func:`listdirex` and :func:`iter_files`
+    style queries without listing the disk each time.
+
+    Each directory is listed once and remembered along with its mtime.
+    Before answering a query, directories are re-listed
+    only if their mtime changed (adding, removing, or renaming an entry
+    changes it), which costs one ``stat`` per directory.
+    Directories modified within ``RACY_SECS`` of being listed
+    are always re-listed, since a change in the same clock tick
+    would not change their mtime.
+
+    :param root: Directory to index.
+    :param snapshotfile: If provided, the index is loaded from this file
+      (if it exists and is for the same root),
+      so a process can start warm. Call :meth:`save` to write it.
+    """
+    VERSION = 1
+    RACY_SECS = 2
+
+    def __init__(self, root, snapshotfile=None):
+        self.root = _os.path.abspath(root)
+        self.snapshotfile = snapshotfile
+        self._lock = _threading.Lock()
+        # Directory path to [mtime_ns, stale, file names, subdir names]
+        self._dirs = {}
+        if snapshotfile and _os.path.isfile(snapshotfile):
+            self.load()
+
+    def _list(self, dirpath):
+        """List ``dirpath`` from disk. Return None if it is not a dir."""
+        try:
+            st = _os.stat(dirpath)
+            entries = list(_scandir(dirpath)) if _scandir else \
+                _listdir_entries(dirpath)
+        except OSError:
+            return None
+        files = []
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir() and not entry.is_symlink():
+                    subdirs.append(entry.name)
+                    continue
+            except OSError:
+                pass
+            files.append(entry.name)
+        files.sort()
+        subdirs.sort()
+        mtime = _mtime_ns(st)
+        stale = _time.time() - st.st_mtime < self.RACY_SECS
+        return [mtime, stale, files, subdirs]
+
+    def _forget(self, dirpath):
+        info = self._dirs.pop(dirpath, None)
+        if info is not None:
+            for sub in info[3]:
+                self._forget(_os.path.join(dirpath, sub))
+
+    def _validate(self, dirpath):
+        """Make sure the listing of ``dirpath`` is current,
+        and return it, or None if ``dirpath`` does not exist."""
+        info = self._dirs.get(dirpath)
+        if info is not None and not info[1]:
+            try:
+                if _mtime_ns(_os.stat(dirpath)) == info[0]:
+                    return info
+            except OSError:
+                pass
+        newinfo = self._list(dirpath)
+        if info is not None:
+            gone = set(info[3]).difference(newinfo[3] if newinfo else ())
+            for sub in gone:
+                self._forget(_os.path.join(dirpath, sub))
+        if newinfo is None:
+            self._dirs.pop(dirpath, None)
+        else:
+            self._dirs[dirpath] = newinfo
+        return newinfo
+
+    def _walk(self, directory, recursive):
+        """Yield ``(dirpath, filenames)`` for valid listings."""
+        with self._lock:
+            listings = []
+            stack = [directory]
+            while stack:
+                dirpath = stack.pop()
+                info = self._validate(dirpath)
+                if info is None:
+                    continue
+                listings.append((dirpath, info[2]))
+                if recursive:
+                    stack.extend(reversed(
+                        [_os.path.join(dirpath, d) for d in info[3]]))
+        return listings
+
+    def _dirpath(self, directory):
+        if directory is None:
+            return self.root
+        return _os.path.join(self.root, directory)
+
+    def files(self, pattern='*', directory=None, recursive=True):
+        """Return paths of files with a basename matching ``pattern``,
+        like :func:`iter_files`.
+
+        :param pattern: Glob pattern, or sequence of glob patterns.
+        :param directory: Only return files under this directory
+          (relative to, or under, :attr:`root`).
+          Defaults to :attr:`root`.
+        :param recursive: If False, only return files
+          directly in ``directory``, like :func:`listdirex`.
+        """
+        return self.match(_compile_globs(pattern), directory, recursive)
+
+    def match(self, regex, directory=None, recursive=True):
+        """Like :meth:`files` but return files with a basename
+        matching ``regex`` (a string or compiled regex)."""
+        if isinstance(regex, _compat.StringTypes):
+            regex = _re.compile(regex)
+        match = regex.match
+        result = []
+        for dirpath, names in self._walk(self._dirpath(directory), recursive):
+            result.extend(_os.path.join(dirpath, n) for n in names if match(n))
+        return result
+
+    def with_ext(self, exts, directory=None, recursive=True):
+        """Like :meth:`files` but return files whose extension
+        (including the dot, such as ``'.py'``) is in ``exts``.
+        Comparison is case insensitive."""
+        if isinstance(exts, _compat.StringTypes):
+            exts = [exts]
+        exts = set(e.lower() for e in exts)
+        result = []
+        for dirpath, names in self._walk(self._dirpath(directory), recursive):
+            result.extend(_os.path.join(dirpath, n) for n in names
+                          if _os.path.splitext(n)[1].lower() in exts)
+        return result
+
+    def listdir(self, path, pattern='*.*'):
+        """Like :func:`listdirex`, but from the index.
+        Returns both files and subdirectories matching ``pattern``.
+        Raises OSError if ``path`` does not exist."""
+        dirpath = self._dirpath(path)
+        with self._lock:
+            info = self._validate(dirpath)
+        if info is None:
+            raise OSError(_errno.ENOENT, _os.strerror(_errno.ENOENT), path)
+        match = _compile_globs(pattern).match
+        return [_os.path.join(dirpath, n) for n in sorted(info[2] + info[3])
+                if match(n)]
+
+    def invalidate(self, directory=None):
+        """Forget the listing for ``directory`` and everything under it,
+        so it is re-listed on the next query."""
+        with self._lock:
+            self._forget(self._dirpath(directory))
 
+    def load(self):
+        """Load the index from :attr:`snapshotfile`.
+        If the file is missing or corrupt, or for another root,
+        the index is left empty."""
+        try:
+            with open(self.snapshotfile) as f:
+                data = _json.load(f)
+            if data['version'] != self.VERSION or data['root'] != self.root:
+                data['dirs'] = {}
+            dirs = dict(data['dirs'])
+        except (ValueError, KeyError, TypeError, IOError, OSError):
+            dirs = {}
+        with self._lock:
+            self._dirs = dirs
 
-def iter_files(directory, pattern='*'):
-    """Returns a generator of files under directory that match pattern."""
-    for root, dirs, files in _os.walk(directory):
-        for basename in files:
-            if _fnmatch.fnmatch(basename, pattern):
-                filename = _os.path.join(root, basename)
-                yield filename
+    def save(self):
+        """Write the index to :attr:`snapshotfile`."""
+        with self._lock:
+            data = {'version': self.VERSION,
+                    'root': self.root,
+                    'dirs': dict(self._dirs)}
+        with atomic_write(self.snapshotfile, fsync=FSYNC_NONE) as f:
+            _json.dump(data, f)
 
 
 def listdirex(path, pattern='*.*'):
@@ -169,6 +1166,42 @@ def path_components(path):
     return parts
 
 
+def path_components_many(paths):
+    """Returns a list of tuples of the components of each of ``paths``,
+    as :func:`path_components` would.
+
+    Directories are only split once however many paths share them,
+    and equal components are the same string object,
+    so the results of millions of paths from a few trees are cheap
+    to compute and hold in memory.
+    """
+    split = ntpath.split
+    strings = {}
+    dirs = {}
+
+    def components(path):
+        # Returns the interned component tuple for a directory.
+        result = dirs.get(path)
+        if result is None:
+            head, tail = split(path)
+            if head == path:
+                result = (strings.setdefault(path, path),) if path else ()
+            else:
+                result = components(head) + (strings.setdefault(tail, tail),)
+            dirs[path] = result
+        return result
+
+    result = []
+    append = result.append
+    for path in paths:
+        head, tail = split(path)
+        if head == path:
+            append((path,) if path else ())
+        else:
+            append(components(head) + (strings.setdefault(tail, tail),))
+    return result
+
+
 def purename(filename):
     """Returns the basename of a path without the extension."""
     if filename is None:
@@ -177,6 +1210,361 @@ def purename(filename):
     return _os.path.splitext(f)[0]
 
 
+def purename_many(filenames):
+    """Returns a list of the result of :func:`purename` for each of
+    ``filenames``, but faster."""
+    filenames = list(filenames)
+    if _os.path is _posixpath:
+        try:
+            return _purename_posix(filenames)
+        except (TypeError, AttributeError):
+            pass
+    basename = _os.path.basename
+    splitext = _os.path.splitext
+    result = []
+    append = result.append
+    for f in filenames:
+        if f is None:
+            raise TypeError('filename cannot be None.')
+        append(splitext(basename(f))[0])
+    return result
+
+
+def _purename_posix(filenames):
+    # posixpath.basename and splitext, inlined.
+    # Raises TypeError for bytes and AttributeError for None.
+    result = []
+    append = result.append
+    for f in filenames:
+        name = f[f.rfind('/') + 1:]
+        dotidx = name.rfind('.')
+        if dotidx > 0 and name[:dotidx].lstrip('.'):
+            name = name[:dotidx]
+        append(name)
+    return result
+
+
+class _ListDirEntry(object):
+    """Stand-in for :class:`os.DirEntry` where ``scandir`` is unavailable.
+    Results are stat'ed lazily and cached, like the real thing."""
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = _os.path.join(dirpath, name)
+        self._stat = None
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks:
+            if self._lstat is None:
+                self._lstat = _os.lstat(self.path)
+            return self._lstat
+        if self._stat is None:
+            self._stat = _os.stat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return _stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return _stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        try:
+            return _stat.S_ISLNK(self.stat(False).st_mode)
+        except OSError:
+            return False
+
+    def __repr__(self):
+        return '<_ListDirEntry %r>' % self.name
+
+
+def _listdir_entries(path):
+    return [_ListDirEntry(path, name) for name in _os.listdir(path)]
+
+
+def _compile_globs(patterns):
+    """Return a compiled regex matching any of the glob ``patterns``
+    (a string or sequence of strings), with the same case sensitivity
+    as :func:`fnmatch.fnmatch`."""
+    if isinstance(patterns, _compat.StringTypes):
+        patterns = [patterns]
+    flags = 0
+    if _os.path.normcase('A') == 'a':
+        flags = _re.IGNORECASE
+    regex = '|'.join('(?:%s)' % _fnmatch.translate(p) for p in patterns)
+    return _re.compile(regex or '(?!)', flags)
+
+
+class GitIgnore(object):
+    """Matches paths against gitignore-style rules.
+
+    Supported are comments, ``!`` negation, trailing ``/`` to only match
+    directories, leading or inner ``/`` to anchor a rule to the root,
+    and ``*``, ``?``, ``[...]`` and ``**`` wildcards.
+    As with git, the last matching rule wins.
+
+    Paths are matched individually and relative to the root,
+    using ``/`` as a separator.
+    When walking with :func:`scan_files`,
+    ignored directories are pruned so nothing beneath them is listed.
+    Nested ignore files are not read.
+
+    :param lines: Iterable of rule strings, such as the lines of a
+      ``.gitignore`` file.
+    """
+    def __init__(self, lines):
+        self.rules = []
+        for line in lines:
+            rule = self._compile(line)
+            if rule is not None:
+                self.rules.append(rule)
+        self.rules.reverse()
+
+    @classmethod
+    def from_file(cls, filename):
+        """Create an instance from the rules in ``filename``."""
+        with open(filename) as f:
+            return cls(f.read().splitlines())
+
+    @staticmethod
+    def _compile(line):
+        line = line.rstrip('\n\r')
+        if not line.endswith('\\ '):
+            line = line.rstrip(' ')
+        if not line or line.startswith('#'):
+            return None
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        elif line.startswith('\\'):
+            line = line[1:]
+        dironly = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            return None
+        if '/' in line:
+            regex = _gitglob_to_regex(line.lstrip('/'))
+        else:
+            regex = '(?:.*/)?' + _gitglob_to_regex(line)
+        return _re.compile(regex + '$'), negate, dironly
+
+    def match(self, relpath, isdir=False):
+        """Return True if ``relpath`` is ignored.
+
+        :param relpath: Path relative to the root of the rules,
+          with ``/`` separators.
+        :param isdir: True if ``relpath`` is a directory.
+        """
+        for regex, negate, dironly in self.rules:
+            if dironly and not isdir:
+                continue
+            if regex.match(relpath):
+                return not negate
+        return False
+
+
+def _gitglob_to_regex(pattern):
+    parts = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        else:
+            c = pattern[i]
+            i += 1
+            if c == '\\' and i < n:
+                parts.append(_re.escape(pattern[i]))
+                i += 1
+            elif c == '*':
+                parts.append('[^/]*')
+            elif c == '?':
+                parts.append('[^/]')
+            elif c == '[':
+                end = pattern.find(']', i + 1)
+                if end < 0:
+                    parts.append('\\[')
+                else:
+                    chars = pattern[i:end].replace('\\', '\\\\')
+                    if chars.startswith('!'):
+                        chars = '^' + chars[1:]
+                    parts.append('[%s]' % chars)
+                    i = end + 1
+            else:
+                parts.append(_re.escape(c))
+    return ''.join(parts)
+
+
+class _ScanFilter(object):
+    """Compiled filtering options for :func:`scan_files`."""
+    def __init__(self, pattern, exclude, prune, maxdepth, ignore):
+        self.match = _compile_globs(pattern).match
+        self.exclude = exclude and _compile_globs(exclude).match
+        self.prune = prune and _compile_globs(prune).match
+        self.maxdepth = maxdepth
+        if ignore is not None and not isinstance(ignore, GitIgnore):
+            ignore = GitIgnore(ignore)
+        self.ignore = ignore
+
+    def scan_dir(self, path, reldir, depth):
+        """List ``path``, returning a tuple of
+        (entries of files to yield,
+        ``(path, reldir, depth)`` tuples of subdirectories to walk).
+        Like :func:`os.walk`, errors listing a directory are ignored
+        and symlinks to directories are not followed.
+
+        :param reldir: The path of the directory relative to the root
+          of the walk, ending in ``/`` unless it is the root.
+        :param depth: Depth of the directory, where the root is 0.
+        """
+        files = []
+        subdirs = []
+        try:
+            if _scandir is None:
+                entries = _listdir_entries(path)
+            else:
+                entries = list(_scandir(path))
+        except OSError:
+            return files, subdirs
+        descend = self.maxdepth is None or depth < self.maxdepth
+        match, exclude, prune, ignore = (
+            self.match, self.exclude, self.prune, self.ignore)
+        for entry in entries:
+            name = entry.name
+            try:
+                isdir = entry.is_dir()
+            except OSError:
+                isdir = False
+            if isdir:
+                if not descend or (prune and prune(name)):
+                    continue
+                try:
+                    if entry.is_symlink():
+                        continue
+                except OSError:
+                    pass
+                relpath = reldir + name
+                if ignore is not None and ignore.match(relpath, True):
+                    continue
+                subdirs.append((entry.path, relpath + '/', depth + 1))
+            elif match(name):
+                if exclude and exclude(name):
+                    continue
+                if ignore is not None and ignore.match(reldir + name):
+                    continue
+                files.append(entry)
+        return files, subdirs
+
+
+def scan_files(directory, pattern='*', workers=0, direntries=False,
+               exclude=None, prune=None, maxdepth=None, ignore=None):
+    """Returns a generator of files under ``directory``
+    with a basename that matches ``pattern``.
+
+    This is :func:`iter_files` with more options.
+    Directories are listed with :func:`os.scandir`,
+    so files and directories are told apart without extra ``stat`` calls,
+    and all patterns are matched with a single compiled regex.
+    Pruned and ignored directories are never listed,
+    so the walk only costs as much as the part of the tree you want.
+
+    :param pattern: Glob pattern, or sequence of glob patterns.
+    :param workers: If greater than 1, list directories in parallel
+      on this many threads. Files are then yielded in no particular order.
+    :param direntries: If True, yield :class:`os.DirEntry` instances
+      rather than paths, so callers can reuse their cached stat results.
+    :param exclude: Glob pattern(s) for basenames of files to skip.
+    :param prune: Glob pattern(s) for basenames of directories
+      to not descend into, such as ``['.git', 'node_modules']``.
+    :param maxdepth: If not None, do not descend more than this many
+      directories below ``directory``. 0 only yields files
+      directly inside ``directory``.
+    :param ignore: A :class:`GitIgnore`, or a sequence of gitignore-style
+      rules, matched against paths relative to ``directory``.
+    """
+    filt = _ScanFilter(pattern, exclude, prune, maxdepth, ignore)
+    if workers > 1:
+        scanner = _scan_parallel(directory, filt, workers)
+    else:
+        scanner = _scan_serial(directory, filt)
+    for files in scanner:
+        for entry in files:
+            if direntries:
+                yield entry
+            else:
+                yield entry.path
+
+
+def _scan_serial(directory, filt):
+    stack = [(directory, '', 0)]
+    while stack:
+        files, subdirs = filt.scan_dir(*stack.pop())
+        yield files
+        # Reverse so we walk in the same order as os.walk.
+        subdirs.reverse()
+        stack.extend(subdirs)
+
+
+def _scan_parallel(directory, filt, workers):
+    todo = _compat.Queue()
+    results = _compat.Queue()
+    stop = _threading.Event()
+    lock = _threading.Lock()
+    pending = [1]
+    done = object()
+
+    def work():
+        while True:
+            item = todo.get()
+            if item is None:
+                return
+            if stop.is_set():
+                continue
+            files, subdirs = filt.scan_dir(*item)
+            # Account for and queue up subdirectories, and report our files,
+            # before marking this directory as finished,
+            # so the walk can't be considered complete too early.
+            with lock:
+                pending[0] += len(subdirs)
+            for subdir in subdirs:
+                todo.put(subdir)
+            if files:
+                results.put(files)
+            with lock:
+                pending[0] -= 1
+                finished = not pending[0]
+            if finished:
+                results.put(done)
+
+    threads = []
+    for _ in range(workers):
+        t = _threading.Thread(target=work, name='ScanFilesWorker')
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    todo.put((directory, '', 0))
+    try:
+        while True:
+            files = results.get()
+            if files is done:
+                break
+            yield files
+    finally:
+        stop.set()
+        for _ in threads:
+            todo.put(None)
+
+
 def set_readonly(path, state):
     mode = _stat.S_IREAD if state else _stat.S_IWRITE
     _os.chmod(path, mode)
@@ -187,3 +1575,50 @@ def split3(path):
     dirname, filename = _os.path.split(path)
     filename, ext = _os.path.splitext(filename)
     return dirname, filename, ext
+
+
+def split3_many(paths):
+    """Returns a list of the ``(dirname, filename without ext, ext)``
+    tuples of :func:`split3` for each of ``paths``, but faster.
+    Equal directory names and extensions are the same string object,
+    to save memory when holding results for many paths.
+    """
+    paths = list(paths)
+    if _os.path is _posixpath:
+        try:
+            return _split3_posix(paths)
+        except (TypeError, AttributeError):
+            pass
+    split = _os.path.split
+    splitext = _os.path.splitext
+    strings = {}
+    intern = strings.setdefault
+    result = []
+    append = result.append
+    for path in paths:
+        dirname, filename = split(path)
+        filename, ext = splitext(filename)
+        append((intern(dirname, dirname), filename, intern(ext, ext)))
+    return result
+
+
+def _split3_posix(paths):
+    # posixpath.split and splitext, inlined. Raises TypeError for bytes.
+    strings = {}
+    intern = strings.setdefault
+    result = []
+    append = result.append
+    for path in paths:
+        sepidx = path.rfind('/') + 1
+        dirname = path[:sepidx]
+        filename = path[sepidx:]
+        if dirname and dirname != '/' * len(dirname):
+            dirname = dirname.rstrip('/')
+        dotidx = filename.rfind('.')
+        if dotidx > 0 and filename[:dotidx].lstrip('.'):
+            ext = filename[dotidx:]
+            filename = filename[:dotidx]
+        else:
+            ext = ''
+        append((intern(dirname, dirname), filename, intern(ext, ext)))
+    return result
@@ -13,6 +13,8 @@ import os
 import sys
 import traceback
 
+from . import osutils
+
 
 logger = logging.getLogger(__name__)
 
@@ -30,12 +32,14 @@ class Preferences(object):
     :param onloaderror: If provided, invoke this function in the case
       of an error on Load. If None, just log out that an error occured.
       Errors on Save will still be raised, of course.
+    :param fsync: fsync policy for :meth:`save`,
+      see :func:`brennivin.osutils.atomic_write`.
 
     Override the :meth:`loader`, :meth:`dumper`, and :meth:`openmode`
     methods to use a serializaer other than json.
     """
 
-    def __init__(self, filename, onloaderror=None):
+    def __init__(self, filename, onloaderror=None, fsync=osutils.FSYNC_FILE):
 
         directory = os.path.dirname(filename)
         if not os.path.exists(directory):
@@ -44,6 +48,7 @@ class Preferences(object):
         self.prefs = {}
         self.filename = filename
         self.onloaderror = onloaderror
+        self.fsync = fsync
         self.load()
 
     def loader(self, fp):
@@ -94,8 +99,11 @@ class Preferences(object):
         return result
 
     def save(self):
-        """Save the internal data in a pickle file."""
-        with open(self.filename, 'w' + self.openmode()) as f:
+        """Save the internal data in a pickle file.
+        The file is replaced atomically, so a crash during a save
+        will not leave a corrupt file."""
+        with osutils.atomic_write(
+                self.filename, 'w' + self.openmode(), self.fsync) as f:
             self.dumper(self.prefs, f)
 
     def load(self):
@@ -62,6 +62,8 @@ Members
 
 import yaml as _yaml
 
+from . import osutils as _osutils
+
 
 __all__ = ['dumps', 'dumpfile', 'dump', 'loads', 'loadfile', 'load', 'PyIO']
 
@@ -75,8 +77,10 @@ class PyIO(object):
     def dumps(self, obj, **kwargs):
         return self.dump(obj, None, **kwargs)
 
-    def dumpfile(self, obj, path, **kwargs):
-        with open(path, 'w') as f:
+    def dumpfile(self, obj, path, fsync=_osutils.FSYNC_FILE, **kwargs):
+        """Dump ``obj`` to the file at ``path``, which is replaced atomically.
+        See :func:`brennivin.osutils.atomic_write` for ``fsync``."""
+        with _osutils.atomic_write(path, 'w', fsync) as f:
             self.dump(obj, f, **kwargs)
 
     def dump(self, obj, stream, **kwargs):
@@ -117,8 +121,8 @@ def dumps(obj, **kwargs):
     return _preferred().dumps(obj, **kwargs)
 
 
-def dumpfile(obj, path, **kwargs):
-    return _preferred().dumpfile(obj, path, **kwargs)
+def dumpfile(obj, path, fsync=_osutils.FSYNC_FILE, **kwargs):
+    return _preferred().dumpfile(obj, path, fsync, **kwargs)
 
 
 def dump(obj, stream, **kwargs):
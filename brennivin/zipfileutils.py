@@ -11,9 +11,13 @@ Members
 
 """
 
+import collections as _collections
+from multiprocessing.pool import ThreadPool as _ThreadPool
 import os as _os
+import struct as _struct
 import zipfile as _zipfile
 from zipfile import ZipFile
+import zlib as _zlib
 
 if not hasattr(ZipFile, '__enter__'):
     # Patch for 2.6 ZipFile not being a ctxmgr
@@ -36,8 +40,87 @@ ALL = dochelpers.pretty_func(lambda _: True, 'ALL')
 NONE = dochelpers.pretty_func(lambda _: False, 'NONE')
 
 
+#: Files larger than this are not compressed in parallel,
+#: since they would have to be held in memory.
+PARALLEL_MAX_FILE_SIZE = 64 * 1024 * 1024
+
+#: Extensions of files that are usually already compressed.
+COMPRESSED_EXTENSIONS = frozenset([
+    '.7z', '.bz2', '.docx', '.flac', '.gif', '.gz', '.jar', '.jpeg', '.jpg',
+    '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.png', '.rar', '.tgz',
+    '.webm', '.webp', '.whl', '.xlsx', '.xz', '.zip'])
+
+
+class CompressionPolicy(object):
+    """Chooses how to compress each file added to an archive,
+    so time isn't wasted compressing files that won't get smaller.
+
+    Rules are checked in order:
+
+    1. The file's extension in ``extensions``.
+    2. Files with an extension in ``stored_extensions`` are stored.
+    3. Files smaller than ``minsize`` bytes are stored.
+    4. If ``trialsize`` is not 0, the first ``trialsize`` bytes are
+       compressed with the fastest :mod:`zlib` level,
+       and the file is stored if that does not shrink the data
+       to ``trialratio`` or less of its size.
+    5. Otherwise, use ``compression`` and ``level``.
+
+    :param compression: Default compression type, such as
+      ``zipfile.ZIP_DEFLATED``, ``ZIP_BZIP2``, or ``ZIP_LZMA``.
+    :param level: Default compression level,
+      or None for the compression type's default.
+    :param extensions: Dict of lowercase extensions (like ``'.txt'``)
+      to a compression type or ``(compression type, level)`` tuple.
+    """
+    def __init__(self, compression=_zipfile.ZIP_DEFLATED, level=None,
+                 extensions=None, stored_extensions=COMPRESSED_EXTENSIONS,
+                 minsize=64, trialsize=64 * 1024, trialratio=0.95):
+        self.compression = compression
+        self.level = level
+        self.extensions = {}
+        for ext, rule in (extensions or {}).items():
+            if not isinstance(rule, tuple):
+                rule = rule, None
+            self.extensions[ext.lower()] = rule
+        self.stored_extensions = frozenset(stored_extensions)
+        self.minsize = minsize
+        self.trialsize = trialsize
+        self.trialratio = trialratio
+
+    def choose(self, filename, size, head=None):
+        """Return a tuple of ``(compression type, level)`` for a file.
+
+        :param filename: Name of the file.
+        :param size: Size of the file in bytes.
+        :param head: The first :attr:`trialsize` (or more) bytes of the file,
+          or None to skip the trial compression.
+        """
+        ext = _os.path.splitext(filename)[1].lower()
+        rule = self.extensions.get(ext)
+        if rule is not None:
+            return rule
+        if ext in self.stored_extensions or size < self.minsize:
+            return _zipfile.ZIP_STORED, None
+        if head and self.trialsize:
+            head = head[:self.trialsize]
+            compressed = _zlib.compress(head, 1)
+            if len(compressed) > len(head) * self.trialratio:
+                return _zipfile.ZIP_STORED, None
+        return self.compression, self.level
+
+    def choose_for_file(self, path, arcname=None):
+        """Like :meth:`choose`, reading the file at ``path`` as needed."""
+        size = _os.path.getsize(path)
+        head = None
+        if self.trialsize and size >= self.minsize:
+            with open(path, 'rb') as f:
+                head = f.read(self.trialsize)
+        return self.choose(arcname or path, size, head)
+
+
 def write_files(fullpaths, zfile, include=ALL, exclude=NONE,
-                subdir=None, rootpath=None):
+                subdir=None, rootpath=None, workers=0, policy=None):
     """
     Zip files to a zip stream.
     See :func:`zip_dir` for arguments.
@@ -52,6 +135,30 @@ def write_files(fullpaths, zfile, include=ALL, exclude=NONE,
       to the branch root.
     :type zfile: zipfile.ZipFile
     """
+    members = _iter_members(fullpaths, include, exclude, subdir, rootpath)
+    _write_members(members, zfile, workers, policy)
+
+
+def _write_members(members, zfile, workers, policy, reuse=None):
+    """Write ``(path, arcname)`` members to ``zfile``.
+
+    :param reuse: If given, a function that takes a path and returns
+      a ``(zinfo, chunks)`` tuple to write with :func:`_write_raw`
+      instead of compressing the file, or None.
+    """
+    if workers > 1 and _supports_raw(zfile):
+        _write_parallel(members, zfile, workers, policy, reuse)
+        return
+    for path, arcname in members:
+        reused = reuse and reuse(path)
+        if reused is None:
+            _write_file(zfile, path, arcname, policy)
+        else:
+            _write_raw(zfile, *reused)
+
+
+def _iter_members(fullpaths, include, exclude, subdir, rootpath):
+    """Yield ``(path, arcname)`` tuples for :func:`write_files`."""
     for path in fullpaths:
         if include(path) and not exclude(path):
             arcname = None
@@ -59,21 +166,146 @@ def write_files(fullpaths, zfile, include=ALL, exclude=NONE,
                 arcname = _os.path.relpath(path, rootpath)
                 if subdir:
                     arcname = _os.path.join(subdir, arcname)
-            zfile.write(path, arcname)
+            yield path, arcname
+
 
+def _write_file(zfile, path, arcname, policy):
+    """Write ``path`` with :meth:`zipfile.ZipFile.write`,
+    compressed as ``policy`` chooses."""
+    if policy is None:
+        zfile.write(path, arcname)
+        return
+    compression, level = policy.choose_for_file(path, arcname)
+    if level is None:
+        zfile.write(path, arcname, compression)
+    else:
+        zfile.write(path, arcname, compression, level)
 
-def write_dir(rootpath, zfile, include=ALL, exclude=NONE, subdir=None):
+
+def _supports_raw(zfile):
+    """Return True if :func:`_write_raw` and :func:`_compress_file`
+    work with this version of :mod:`zipfile`."""
+    return (hasattr(_zipfile.ZipInfo, 'from_file') and
+            hasattr(_zipfile, '_get_compressor') and
+            all(hasattr(zfile, a) for a in (
+                '_lock', 'start_dir', '_writecheck', 'filelist',
+                'NameToInfo')))
+
+
+def _write_raw(zfile, zinfo, chunks):
+    """Add a member to ``zfile`` whose data is already compressed.
+    This does what :meth:`zipfile.ZipFile.write` does after compressing,
+    so relies on :mod:`zipfile` internals (see :func:`_supports_raw`).
+
+    :param zinfo: :class:`zipfile.ZipInfo` with ``compress_type``,
+      ``CRC``, ``file_size``, and ``compress_size`` set.
+    :param chunks: Iterable of the compressed bytes.
+    """
+    with zfile._lock:
+        if getattr(zfile, '_writing', False):
+            raise ValueError("Can't write to ZIP archive while an open "
+                             "writing handle exists.")
+        zfile._writecheck(zinfo)
+        zfile._didModify = True
+        if getattr(zfile, '_seekable', True):
+            zfile.fp.seek(zfile.start_dir)
+        zinfo.header_offset = zfile.fp.tell()
+        # Sizes are known up front, so no data descriptor is needed.
+        zinfo.flag_bits &= ~0x08
+        zip64 = (zinfo.file_size > _zipfile.ZIP64_LIMIT or
+                 zinfo.compress_size > _zipfile.ZIP64_LIMIT)
+        if zip64 and not zfile._allowZip64:
+            raise _zipfile.LargeZipFile(
+                'Filesize would require ZIP64 extensions')
+        zfile.fp.write(zinfo.FileHeader(zip64))
+        for chunk in chunks:
+            zfile.fp.write(chunk)
+        zfile.filelist.append(zinfo)
+        zfile.NameToInfo[zinfo.filename] = zinfo
+        zfile.start_dir = zfile.fp.tell()
+
+
+def _compress_file(path, arcname, compression, level, policy):
+    """Return a tuple of a :class:`zipfile.ZipInfo` for ``path``
+    and its compressed contents,
+    or None for the contents if the file should be written normally.
+    If ``policy`` is given, it overrides ``compression`` and ``level``."""
+    zinfo = _zipfile.ZipInfo.from_file(path, arcname)
+    if zinfo.filename.endswith('/') or (
+            zinfo.file_size > PARALLEL_MAX_FILE_SIZE):
+        return zinfo, None
+    with open(path, 'rb') as f:
+        data = f.read()
+    if policy is not None:
+        compression, level = policy.choose(zinfo.filename, len(data), data)
+    compressor = _zipfile._get_compressor(compression, level)
+    if compressor is None:
+        compressed = data
+    else:
+        compressed = compressor.compress(data) + compressor.flush()
+    zinfo.compress_type = compression
+    if compression == _zipfile.ZIP_LZMA:
+        # The LZMA stream has an end of stream marker.
+        zinfo.flag_bits |= 0x02
+    zinfo.file_size = len(data)
+    zinfo.CRC = _zlib.crc32(data) & 0xffffffff
+    zinfo.compress_size = len(compressed)
+    return zinfo, compressed
+
+
+def _write_parallel(members, zfile, workers, policy, reuse):
+    """Compress ``members`` on a pool of ``workers`` threads
+    (the compression libraries release the GIL)
+    and write them to ``zfile`` in order.
+    Only a few files per worker are held in memory at a time."""
+    compression = zfile.compression
+    level = getattr(zfile, 'compresslevel', None)
+    pool = _ThreadPool(workers)
+    pending = _collections.deque()
+
+    def write_next():
+        path, arcname, reused, result = pending.popleft()
+        if reused is not None:
+            _write_raw(zfile, *reused)
+            return
+        zinfo, data = result.get()
+        if data is None:
+            _write_file(zfile, path, arcname, policy)
+        else:
+            _write_raw(zfile, zinfo, [data])
+
+    try:
+        for path, arcname in members:
+            reused = reuse and reuse(path)
+            result = None
+            if reused is None:
+                result = pool.apply_async(
+                    _compress_file,
+                    (path, arcname, compression, level, policy))
+            pending.append((path, arcname, reused, result))
+            if len(pending) > workers * 2:
+                write_next()
+        while pending:
+            write_next()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def write_dir(rootpath, zfile, include=ALL, exclude=NONE, subdir=None,
+              workers=0, policy=None):
     """
     Zip all files under ``rootpath`` to a zip stream.
     See :func:`zip_dir` for arguments.
 
     :type zfile: zipfile.ZipFile
     """
-    write_files(
-        osutils.iter_files(rootpath), zfile, include, exclude, subdir, rootpath)
+    write_files(osutils.iter_files(rootpath), zfile, include, exclude,
+                subdir, rootpath, workers, policy)
 
 
-def zip_dir(rootdir, outfile, include=ALL, exclude=NONE, subdir=None):
+def zip_dir(rootdir, outfile, include=ALL, exclude=NONE, subdir=None,
+            workers=0, policy=None):
     """Zip all files under the root directory to a zip file at ``outfile``.
 
     :param outfile: Path to zipfile, or :class:`ZipFile` stream.
@@ -83,12 +315,134 @@ def zip_dir(rootdir, outfile, include=ALL, exclude=NONE, subdir=None):
       the archive. For example, zipping the directory ``spam`` with the files
       ``/spam/eggs/ham.txt`` and ``subdir`` of ``foo``
       would yield the archive file ``foo/eggs/ham.txt``.
+    :param workers: If greater than 1, compress files in parallel on
+      this many threads. Files are still written in the same order,
+      and the archive is the same as if compressed serially.
+      Files larger than :data:`PARALLEL_MAX_FILE_SIZE`
+      are compressed serially.
+      Before Python 3.6, :mod:`zipfile` does not provide what is needed
+      to write compressed data directly,
+      so this is ignored and all files are compressed serially.
+    :param policy: A :class:`CompressionPolicy` to choose how each file
+      is compressed. If None, all files are deflated.
     """
     outdir = _os.path.dirname(outfile)
     if not _os.path.exists(outdir):
         _os.makedirs(outdir)
     with ZipFile(outfile, 'w', _zipfile.ZIP_DEFLATED) as zfile:
-        write_dir(rootdir, zfile, include, exclude, subdir)
+        write_dir(rootdir, zfile, include, exclude, subdir, workers, policy)
+
+
+def update_zip(rootdir, outfile, include=ALL, exclude=NONE, subdir=None,
+               workers=0, policy=None, checkcrc=False):
+    """Like :func:`zip_dir`, but only compresses files that changed
+    since ``outfile`` was last written.
+    The compressed data of unchanged files is copied from the
+    existing archive, and members for files that no longer exist are
+    removed. The new archive replaces ``outfile`` atomically,
+    and is not rewritten at all if nothing changed.
+
+    See :func:`zip_dir` for arguments.
+
+    :param checkcrc: If False, a file is unchanged if its size and
+      modification time match the archive's.
+      If True, a file is unchanged if its size and CRC match,
+      which reads every file but is not fooled by mtimes
+      (for example, from a fresh checkout).
+    :return: List of archive names that were compressed
+      because they are new or changed.
+
+    Before Python 3.6, :mod:`zipfile` does not provide what is needed
+    to copy compressed data, so the archive is always rebuilt
+    with :func:`zip_dir`, and every name in it is returned.
+    """
+    members = list(_iter_members(
+        osutils.iter_files(rootdir), include, exclude, subdir, rootdir))
+    if _os.path.exists(outfile):
+        with ZipFile(outfile) as zin:
+            if _supports_raw(zin):
+                return _update_members(
+                    zin, members, outfile, workers, policy, checkcrc)
+    zip_dir(rootdir, outfile, include, exclude, subdir, workers, policy)
+    with ZipFile(outfile) as zfile:
+        return zfile.namelist()
+
+
+def _update_members(zin, members, outfile, workers, policy, checkcrc):
+    """Write ``members`` over ``outfile``,
+    copying unchanged ones from ``zin``. See :func:`update_zip`."""
+    old = dict((zi.filename, zi) for zi in zin.infolist())
+    reusable = {}
+    changed = []
+    names = []
+    touched = False
+    for path, arcname in members:
+        zinfo = _zipfile.ZipInfo.from_file(path, arcname)
+        names.append(zinfo.filename)
+        oldinfo = old.get(zinfo.filename)
+        if _is_unchanged(path, zinfo, oldinfo, checkcrc):
+            reusable[path] = zinfo, oldinfo
+            touched = touched or (
+                _dos_time(zinfo.date_time) != oldinfo.date_time)
+        else:
+            changed.append(zinfo.filename)
+    if not changed and not touched and names == zin.namelist():
+        return changed
+
+    def reuse(path):
+        infos = reusable.get(path)
+        if infos is None:
+            return None
+        zinfo, oldinfo = infos
+        # The same compressed data needs the same header fields.
+        zinfo.compress_type = oldinfo.compress_type
+        zinfo.flag_bits |= oldinfo.flag_bits & 0x06
+        zinfo.CRC = oldinfo.CRC
+        zinfo.compress_size = oldinfo.compress_size
+        return zinfo, _read_raw(zin, oldinfo)
+
+    with osutils.atomic_write(outfile, 'wb', fsync=osutils.FSYNC_NONE) as f:
+        with ZipFile(f, 'w', _zipfile.ZIP_DEFLATED) as zout:
+            _write_members(members, zout, workers, policy, reuse)
+        # Windows can't replace a file that is open.
+        zin.close()
+    return changed
+
+
+def _is_unchanged(path, zinfo, oldinfo, checkcrc):
+    if (oldinfo is None or oldinfo.file_size != zinfo.file_size or
+            oldinfo.flag_bits & 0x01):  # Encrypted
+        return False
+    if checkcrc:
+        return osutils.crc_from_filename(path) == oldinfo.CRC
+    return _dos_time(zinfo.date_time) == oldinfo.date_time
+
+
+def _dos_time(date_time):
+    """Archives store seconds divided by 2, so round ``date_time`` down
+    to what would be read back from an archive."""
+    return tuple(date_time[:5]) + (date_time[5] // 2 * 2,)
+
+
+def _read_raw(zfile, zinfo, blocksize=1024 * 1024):
+    """Yield the compressed data of the ``zinfo`` member of ``zfile``,
+    skipping its local file header."""
+    fp = zfile.fp
+    fp.seek(zinfo.header_offset)
+    header = _struct.unpack(_zipfile.structFileHeader,
+                            fp.read(_zipfile.sizeFileHeader))
+    if header[_zipfile._FH_SIGNATURE] != _zipfile.stringFileHeader:
+        raise _zipfile.BadZipfile(
+            'Bad magic number for file header of %s' % zinfo.filename)
+    fp.seek(header[_zipfile._FH_FILENAME_LENGTH] +
+            header[_zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    remaining = zinfo.compress_size
+    while remaining:
+        block = fp.read(min(blocksize, remaining))
+        if not block:
+            raise _zipfile.BadZipfile('Truncated member %s' % zinfo.filename)
+        remaining -= len(block)
+        yield block
 
 
 def is_inside_zipfile(filepath):
@@ -0,0 +1,168 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from brennivin import dirwatcher, osutils
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def assertCoalesced(self, kinds, ideal):
+        pending = {}
+        for kind in kinds:
+            dirwatcher._coalesce(pending, kind, 'p')
+        self.assertEqual(pending.get('p'), ideal)
+
+    def testCoalesce(self):
+        c, m, d = dirwatcher.CREATED, dirwatcher.MODIFIED, dirwatcher.DELETED
+        self.assertCoalesced([c, m, m], c)
+        self.assertCoalesced([c, m, d], None)
+        self.assertCoalesced([m, m], m)
+        self.assertCoalesced([m, d], d)
+        self.assertCoalesced([d, c], m)
+        self.assertCoalesced([d, c, d], d)
+
+
+class BackendTests(object):
+    """Tests run against each backend. Subclasses set ``backend``."""
+    backend = None
+    timeout = 0
+
+    def setUp(self):
+        if not self.backend.is_supported():
+            raise unittest.SkipTest('%s not supported.' % self.backend)
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        self.existing = self.write('existing.txt', 'a')
+        self.events = []
+        self.watcher = self.createWatcher()
+
+    def createWatcher(self, **kwargs):
+        watcher = dirwatcher.DirWatcher(
+            self.root, backend=self.backend, **kwargs)
+        self.addCleanup(watcher.stop)
+        for kind in dirwatcher.CREATED, dirwatcher.MODIFIED, dirwatcher.DELETED:
+            getattr(watcher, kind).connect(
+                lambda path, kind=kind: self.events.append((kind, path)))
+        return watcher
+
+    def write(self, relpath, data):
+        path = os.path.join(self.root, relpath)
+        osutils.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def poll(self):
+        self.watcher.poll(self.timeout)
+        return sorted(set(self.events))
+
+    def testNothingChanged(self):
+        self.assertEqual(self.poll(), [])
+
+    def testCreated(self):
+        path = self.write('new.txt', 'new')
+        self.assertEqual(self.poll(), [(dirwatcher.CREATED, path)])
+
+    def testModified(self):
+        self.write('existing.txt', 'much longer')
+        self.assertEqual(self.poll(), [(dirwatcher.MODIFIED, self.existing)])
+
+    def testDeleted(self):
+        os.remove(self.existing)
+        self.assertEqual(self.poll(), [(dirwatcher.DELETED, self.existing)])
+
+    def testNewSubdirectory(self):
+        path = self.write(os.path.join('sub', 'dir', 'new.txt'), 'new')
+        self.poll()
+        self.assertIn((dirwatcher.CREATED, path), self.poll())
+
+    def testPattern(self):
+        self.watcher = self.createWatcher(pattern='*.log')
+        self.write('new.txt', 'new')
+        log = self.write('new.log', 'new')
+        self.assertEqual(self.poll(), [(dirwatcher.CREATED, log)])
+
+    def testDebounce(self):
+        now = [0]
+        self.watcher = self.createWatcher(debounce=5, clock=lambda: now[0])
+        path = self.write('new.txt', 'new')
+        self.poll()
+        self.write('new.txt', 'newer')
+        now[0] = 4
+        self.assertEqual(self.poll(), [])
+        now[0] = 10
+        self.assertEqual(self.poll(), [(dirwatcher.CREATED, path)])
+
+    def testThreaded(self):
+        self.watcher = self.createWatcher(interval=0.01)
+        self.watcher.start()
+        self.assertRaises(RuntimeError, self.watcher.start)
+        path = self.write('new.txt', 'new')
+        deadline = time.time() + 5
+        while not self.events and time.time() < deadline:
+            time.sleep(0.01)
+        self.watcher.stop()
+        self.assertIn((dirwatcher.CREATED, path), self.events)
+
+
+class TestSnapshotBackend(BackendTests, unittest.TestCase):
+    backend = dirwatcher.SnapshotBackend
+
+
+class TestInotifyBackend(BackendTests, unittest.TestCase):
+    backend = dirwatcher.InotifyBackend
+    timeout = 0.1
+
+    def testIsDefault(self):
+        watcher = dirwatcher.DirWatcher(self.root)
+        self.addCleanup(watcher.stop)
+        self.assertIsInstance(watcher.backend, dirwatcher.InotifyBackend)
+
+    def testSubdirectoryMovedOut(self):
+        path = self.write(os.path.join('sub', 'a.txt'), 'a')
+        self.poll()
+        del self.events[:]
+        elsewhere = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, elsewhere)
+        moved = os.path.join(elsewhere, 'sub')
+        os.rename(os.path.join(self.root, 'sub'), moved)
+        self.assertEqual(self.poll(), [(dirwatcher.DELETED, path)])
+        self.assertNotIn(os.path.dirname(path),
+                         self.watcher.backend._dirs.values())
+        del self.events[:]
+        with open(os.path.join(moved, 'b.txt'), 'w') as f:
+            f.write('b')
+        self.assertEqual(self.poll(), [])
+
+    def testSubdirectoryDeleted(self):
+        path = self.write(os.path.join('sub', 'a.txt'), 'a')
+        self.poll()
+        del self.events[:]
+        shutil.rmtree(os.path.join(self.root, 'sub'))
+        self.assertEqual(self.poll(), [(dirwatcher.DELETED, path)])
+        self.assertEqual(list(self.watcher.backend._known), [self.existing])
+
+    def overflow(self):
+        """Pretend the kernel's queue overflowed,
+        so all changes so far were lost."""
+        backend = self.watcher.backend
+        events = []
+        backend._handle(-1, backend.IN_Q_OVERFLOW, '', events)
+        return sorted(events)
+
+    def testOverflowRescans(self):
+        created = self.write(os.path.join('sub', 'new.txt'), 'new')
+        os.remove(self.existing)
+        self.assertEqual(self.overflow(), [(dirwatcher.CREATED, created),
+                                           (dirwatcher.DELETED, self.existing)])
+        self.assertIn(os.path.dirname(created),
+                      self.watcher.backend._dirs.values())
+        self.assertEqual(self.overflow(), [])
+
+    def testOverflowReportsModified(self):
+        self.write('existing.txt', 'much longer')
+        self.assertEqual(self.overflow(),
+                         [(dirwatcher.MODIFIED, self.existing)])
@@ -1,9 +1,10 @@
 import mock
 import socket
+import threading
 import time
 import unittest
 
-from brennivin import ioutils, testhelpers
+from brennivin import compat, ioutils, testhelpers
 
 
 class TestRetry(unittest.TestCase):
@@ -178,3 +179,275 @@ class TestIsLocalPortOpen(unittest.TestCase):
         finally:
             sock.close()
         self.assertTrue(ioutils.is_local_port_open(found))
+
+
+class TestPortAllocator(unittest.TestCase):
+
+    def setUp(self):
+        self.alloc = ioutils.PortAllocator()
+        self.addCleanup(self.alloc.close)
+
+    def testReservedPortsAreUniqueAndHeld(self):
+        ports = self.alloc.reserve(5)
+        self.assertEqual(len(set(ports)), 5)
+        self.assertEqual(self.alloc.reserved(), sorted(ports))
+        for port in ports:
+            self.assertFalse(ioutils.is_local_port_open(port))
+
+    def testReleaseOpensPort(self):
+        port, = self.alloc.reserve()
+        self.assertEqual(self.alloc.release(port), port)
+        self.assertTrue(ioutils.is_local_port_open(port))
+        self.assertEqual(self.alloc.reserved(), [])
+
+    def testTakeReturnsBoundSocket(self):
+        port, = self.alloc.reserve()
+        sock = self.alloc.take(port)
+        try:
+            self.assertEqual(sock.getsockname()[1], port)
+        finally:
+            sock.close()
+
+    def testUnreservedPortRaises(self):
+        self.assertRaises(KeyError, self.alloc.release, 1)
+
+    def testNegativeCountRaises(self):
+        self.assertRaises(ValueError, self.alloc.reserve, -1)
+
+    def testCloseReleasesAll(self):
+        ports = self.alloc.reserve(3)
+        self.alloc.close()
+        self.assertEqual(self.alloc.reserved(), [])
+        for port in ports:
+            self.assertTrue(ioutils.is_local_port_open(port))
+
+    def testHandedOutPortsAreNotReused(self):
+        handedout = []
+        for _ in range(20):
+            port, = self.alloc.reserve()
+            handedout.append(self.alloc.release(port))
+        self.assertEqual(len(set(handedout)), 20)
+
+    def testHandedOutPortsExpire(self):
+        clock = FakeClock()
+        alloc = ioutils.PortAllocator(grace=10, clock=clock)
+        first = alloc.release(alloc.reserve()[0])
+        clock.now = 5
+        second = alloc.release(alloc.reserve()[0])
+        self.assertEqual(sorted(alloc._handedout), sorted([first, second]))
+        clock.now = 12
+        alloc.reserve(0)
+        self.assertEqual(list(alloc._handedout), [second])
+
+    def testHandedOutPortsAreCapped(self):
+        alloc = ioutils.PortAllocator(maxhandedout=5)
+        handedout = [alloc.release(alloc.reserve()[0]) for _ in range(10)]
+        self.assertEqual(sorted(alloc._handedout), sorted(handedout[-5:]))
+
+    def testThreadsGetUniquePorts(self):
+        results = []
+
+        def reserve():
+            results.extend(self.alloc.reserve(10))
+        threads = [threading.Thread(target=reserve) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(results)), 40)
+
+    def testFindOpenLocalPorts(self):
+        ports = ioutils.find_open_local_ports(3)
+        self.assertEqual(len(set(ports)), 3)
+        for port in ports:
+            self.assertTrue(ioutils.is_local_port_open(port))
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.slept.append(secs)
+        self.now += secs
+
+
+class RateLimiterTests(object):
+    """Mixin for tests common to all rate limiters.
+    Subclasses implement ``create(block)``, which should return a limiter
+    that allows 2 calls per second."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def testBurstDoesNotSleep(self):
+        limiter = self.create()
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(self.clock.slept, [])
+
+    def testBlocksWhenExhausted(self):
+        limiter = self.create()
+        for _ in range(3):
+            limiter.acquire()
+        self.assertEqual(len(self.clock.slept), 1)
+        self.assertGreater(self.clock.slept[0], 0)
+
+    def testNonBlockingRaises(self):
+        limiter = self.create(block=False)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertRaises(ioutils.RateLimited, limiter.acquire)
+        self.assertEqual(self.clock.slept, [])
+
+    def testAcquireBlockingOverridesDefault(self):
+        limiter = self.create()
+        limiter.acquire()
+        limiter.acquire()
+        self.assertRaises(ioutils.RateLimited, limiter.acquire, False)
+
+    def testTryAcquire(self):
+        limiter = self.create()
+        self.assertTrue(limiter.try_acquire())
+        self.assertTrue(limiter.try_acquire())
+        self.assertFalse(limiter.try_acquire())
+        self.clock.now += 1
+        self.assertTrue(limiter.try_acquire())
+
+    def testDecorator(self):
+        limiter = self.create(block=False)
+
+        @limiter
+        def wrapped(a, b=1):
+            return a + b
+        self.assertEqual(wrapped.__name__, 'wrapped')
+        self.assertEqual(wrapped(1, b=2), 3)
+        self.assertEqual(wrapped(1), 2)
+        self.assertRaises(ioutils.RateLimited, wrapped, 1)
+
+    def testContextManager(self):
+        limiter = self.create(block=False)
+        with limiter:
+            with limiter:
+                pass
+        self.assertRaises(ioutils.RateLimited, limiter.__enter__)
+
+    def skipIfNoAsync(self):
+        if compat.throttle_coro is None:
+            raise unittest.SkipTest('asyncio coroutines not available')
+
+    def runAsync(self, awaitable):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        return loop.run_until_complete(awaitable)
+
+    def testAsyncDecorator(self):
+        self.skipIfNoAsync()
+        limiter = self.create(block=False)
+        ns = {}
+        exec('async def coro(x):\n    return x * 2', ns)
+        throttled = limiter(ns['coro'])
+        import asyncio
+        self.assertTrue(asyncio.iscoroutinefunction(throttled))
+        self.assertEqual(throttled.__name__, 'coro')
+        # Permits are taken when the coroutine runs, not when it is created.
+        for _ in range(3):
+            throttled(2).close()
+        self.assertEqual(self.runAsync(throttled(2)), 4)
+        self.runAsync(limiter.acquire_async())
+        coro = throttled(2)
+        self.assertRaises(ioutils.RateLimited, self.runAsync, coro)
+
+    def testAsyncContextManagerReturnsLimiter(self):
+        self.skipIfNoAsync()
+        limiter = self.create(block=False)
+        with limiter as entered:
+            self.assertIs(entered, limiter)
+        ns = {}
+        exec('async def use(limiter):\n'
+             '    async with limiter as entered:\n'
+             '        return entered', ns)
+        self.assertIs(self.runAsync(ns['use'](limiter)), limiter)
+        self.assertRaises(ioutils.RateLimited, self.runAsync,
+                          ns['use'](limiter))
+
+    def testAsyncSleepsOnEventLoop(self):
+        self.skipIfNoAsync()
+        limiter = self.create()
+        waits = []
+
+        def sleep(secs):
+            waits.append(secs)
+            return ioutils._nowait
+        with mock.patch('asyncio.sleep', sleep):
+            for _ in range(3):
+                self.runAsync(limiter.acquire_async())
+        self.assertEqual(len(waits), 1)
+        self.assertEqual(self.clock.slept, [])
+
+    def testThreadSafe(self):
+        limiter = self.create(block=False)
+        taken = []
+
+        def take():
+            for _ in range(50):
+                taken.append(limiter.try_acquire())
+        threads = [threading.Thread(target=take) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(taken.count(True), 2)
+
+
+class TestTokenBucket(RateLimiterTests, unittest.TestCase):
+
+    def create(self, block=True):
+        return ioutils.TokenBucket(
+            2, block=block, clock=self.clock, sleepfunc=self.clock.sleep)
+
+    def testSleepsForDebt(self):
+        limiter = self.create()
+        for _ in range(4):
+            limiter.acquire()
+        self.assertEqual(self.clock.slept, [.5, .5])
+
+    def testRefillIsCappedAtCapacity(self):
+        limiter = ioutils.TokenBucket(
+            1, 3, clock=self.clock, sleepfunc=self.clock.sleep)
+        self.clock.now += 100
+        for _ in range(3):
+            limiter.acquire()
+        self.assertEqual(self.clock.slept, [])
+        limiter.acquire()
+        self.assertEqual(self.clock.slept, [1])
+
+    def testArgsValue(self):
+        self.assertRaises(ValueError, ioutils.TokenBucket, 0)
+        self.assertRaises(ValueError, ioutils.TokenBucket, 1, 0)
+
+
+class TestSlidingWindow(RateLimiterTests, unittest.TestCase):
+
+    def create(self, block=True):
+        return ioutils.SlidingWindow(
+            2, 1, block=block, clock=self.clock, sleepfunc=self.clock.sleep)
+
+    def testWaitsForOldestToExpire(self):
+        limiter = self.create()
+        limiter.acquire()
+        self.clock.now = .25
+        limiter.acquire()
+        self.clock.now = .5
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(self.clock.slept, [.5, .25])
+
+    def testArgsValue(self):
+        self.assertRaises(ValueError, ioutils.SlidingWindow, 0)
+        self.assertRaises(ValueError, ioutils.SlidingWindow, 1, 0)
@@ -1,6 +1,13 @@
+import gzip
+import json
 import logging
+import mock
 import os
+import shutil
+import sys
 import tempfile
+import threading
+import time
 import unittest
 
 from brennivin import itertoolsext, osutils, logutils
@@ -29,6 +36,212 @@ class TestMultiLineIndentFormatter(unittest.TestCase):
         ideal = 'loggername Line one\n           Line two sits directly beneath line one'
         self.assertEqual(s, ideal)
 
+    def testMessageWithArgs(self):
+        fmtr = logutils.MultiLineIndentFormatter('%(name)s: %(message)s')
+        rec = logging.LogRecord(
+            'name', 30, 'f.py', 1, 'a %s\nb', ('x',), None)
+        self.assertEqual(fmtr.format(rec), 'name: a x\n      b')
+
+    def testNonStringMessage(self):
+        fmtr = logutils.MultiLineIndentFormatter('%(name)s %(message)s')
+        rec = logging.LogRecord('name', 30, 'f.py', 1, ValueError, (), None)
+        self.assertEqual(fmtr.format(rec), 'name ' + str(ValueError))
+
+    def testMessageRepeatedInHeader(self):
+        fmtr = logutils.MultiLineIndentFormatter('%(name)s %(message)s')
+        rec = self.createRecord('name\nx')
+        rec.name = 'name'
+        self.assertEqual(fmtr.format(rec), 'name name\n     x')
+
+    def testConstantHeader(self):
+        fmtr = logutils.MultiLineIndentFormatter('100%% > %(message)s', sep='.')
+        self.assertEqual(fmtr.format(self.createRecord('a\nb')),
+                         '100% > a\n.......b')
+
+    def testSingleLineIsUnchanged(self):
+        fmtr = logutils.MultiLineIndentFormatter(logutils.Fmt.NTLM)
+        rec = self.createRecord('one line')
+        self.assertEqual(fmtr.format(rec),
+                         logging.Formatter(logutils.Fmt.NTLM).format(rec))
+
+
+class TestJsonFormatter(unittest.TestCase):
+    def createRecord(self, msg='hello %s', args=('world',), exc_info=None,
+                     **extra):
+        rec = logging.LogRecord(
+            'loggername', logging.WARNING, 'f.py', 12, msg, args, exc_info)
+        rec.__dict__.update(extra)
+        return rec
+
+    def format(self, rec, **kwargs):
+        s = logutils.JsonFormatter(**kwargs).format(rec)
+        self.assertNotIn('\n', s)
+        return json.loads(s)
+
+    def testDefaultFields(self):
+        rec = self.createRecord()
+        self.assertEqual(self.format(rec), {
+            'created': rec.created, 'name': 'loggername',
+            'levelname': 'WARNING', 'message': 'hello world'})
+
+    def testRenamedFieldsAndAsctime(self):
+        d = self.format(self.createRecord(), datefmt='%Y',
+                        fields=[('lvl', 'levelno'), 'asctime',
+                                ('msg', 'message')])
+        self.assertEqual(sorted(d), ['asctime', 'lvl', 'msg'])
+        self.assertEqual(d['lvl'], logging.WARNING)
+        self.assertEqual(len(d['asctime']), 4)
+        self.assertEqual(d['msg'], 'hello world')
+
+    def testExtraAndStatic(self):
+        obj = object()
+        d = self.format(self.createRecord(user='bob', obj=obj),
+                        static={'app': 'spam'})
+        self.assertEqual(d['user'], 'bob')
+        self.assertEqual(d['obj'], repr(obj))
+        self.assertEqual(d['app'], 'spam')
+        d = self.format(self.createRecord(user='bob'), extra=False)
+        self.assertNotIn('user', d)
+
+    def testException(self):
+        try:
+            secret = 'eggs'
+            raise ValueError(secret)
+        except ValueError:
+            rec = self.createRecord(exc_info=sys.exc_info())
+        exc = self.format(rec)['exc_info']
+        self.assertTrue(exc.startswith('Traceback'))
+        self.assertTrue(exc.endswith('ValueError: eggs'))
+        self.assertNotIn("secret = 'eggs'", exc)
+        exc = self.format(rec, show_locals=1)['exc_info']
+        self.assertIn("secret = 'eggs'", exc)
+
+
+class TestRateLimitFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.logger = logging.getLogger('TestRateLimitFilter%s' % id(self))
+        self.logger.propagate = False
+        self.logged = []
+        handler = logging.Handler()
+        handler.emit = lambda r: self.logged.append(r.getMessage())
+        self.logger.addHandler(handler)
+
+    def create(self, **kwargs):
+        f = logutils.RateLimitFilter(clock=lambda: self.now, **kwargs)
+        self.logger.addFilter(f)
+        return f
+
+    def testRateLimitsSimilarRecords(self):
+        f = self.create(rate=2)
+        for i in range(5):
+            self.logger.warning('spam %s', i)
+        self.logger.warning('eggs')
+        self.logger.error('spam %s', 9)
+        self.assertEqual(self.logged, ['spam 0', 'spam 1', 'eggs', 'spam 9'])
+        self.assertEqual(f.suppressed, 3)
+
+    def testTokensRefill(self):
+        self.create(rate=1)
+        self.logger.warning('spam')
+        self.logger.warning('spam')
+        self.now += 1
+        self.logger.warning('spam')
+        self.assertEqual(self.logged, ['spam', 'spam'])
+
+    def testSample(self):
+        f = self.create(rate=1, sample=3)
+        for i in range(8):
+            self.logger.warning('spam %s', i)
+        self.assertEqual(self.logged, ['spam 0', 'spam 3', 'spam 6'])
+        self.assertEqual(f.suppressed, 5)
+        f.flush_summaries()
+        self.assertEqual(self.logged[-1],
+                         "Suppressed 5 similar messages in 0 seconds: "
+                         "'spam %s'")
+
+    def testSummaryAfterInterval(self):
+        self.create(rate=1, interval=10)
+        for i in range(4):
+            self.logger.warning('spam %s', i)
+        self.now = 10
+        self.logger.warning('spam %s', 4)
+        self.assertEqual(self.logged, [
+            'spam 0',
+            "Suppressed 3 similar messages in 10 seconds: 'spam %s'",
+            'spam 4'])
+
+    def testFlushSummaries(self):
+        f = self.create(rate=1)
+        self.logger.warning('spam')
+        self.logger.warning('spam')
+        self.now = 5
+        f.flush_summaries()
+        f.flush_summaries()
+        self.assertEqual(self.logged, [
+            'spam', "Suppressed 1 similar messages in 5 seconds: 'spam'"])
+
+    def testMaxKeysForgetsLeastRecentlyUsed(self):
+        f = self.create(rate=1, maxkeys=2)
+        self.logger.warning('a')
+        self.logger.warning('b')
+        self.logger.warning('a')
+        self.logger.warning('c')
+        self.assertEqual(len(f._states), 2)
+        self.logger.warning('a')
+        self.logger.warning('b')
+        self.assertEqual(self.logged, ['a', 'b', 'c', 'b'])
+
+    def testManyKeysStayBounded(self):
+        f = self.create(rate=1, maxkeys=3)
+        for i in range(200):
+            self.logger.warning('spam')
+            self.logger.warning(str(i))
+        self.assertEqual(len(f._states), 3)
+        self.assertLessEqual(len(f._order), 2 * 3 + 16)
+        self.assertEqual(self.logged.count('spam'), 1)
+
+
+class TestCachedTimestamp(unittest.TestCase):
+    times = [0, 0.999, 1.0, -0.5, -1.0, 1234567890.25, 1234567890.75,
+             1234567891.0, 2000000000.5]
+
+    def testSameAsStrftime(self):
+        for fmt in ['%Y-%m-%d-%H-%M-%S', '%c', '%H:%M']:
+            ts = logutils.CachedTimestamp(fmt)
+            for t in self.times + list(reversed(self.times)):
+                self.assertEqual(ts(t), time.strftime(fmt, time.gmtime(t)))
+
+    def testOnlyFormatsWhenSecondChanges(self):
+        ts = logutils.CachedTimestamp('%S')
+        with mock.patch('time.strftime', return_value='x') as m:
+            ts(10.1), ts(10.9), ts(11.0), ts(11.5)
+        self.assertEqual(m.call_count, 2)
+
+    def testConverter(self):
+        ts = logutils.CachedTimestamp('%H', time.localtime)
+        t = 1234567890
+        self.assertEqual(ts(t), time.strftime('%H', time.localtime(t)))
+
+    def testTimestampDefaultsToNow(self):
+        self.assertEqual(logutils.timestamp('%Y'),
+                         time.strftime('%Y', time.gmtime()))
+
+
+class TestCachedTimeFormatter(unittest.TestCase):
+    def testSameAsFormatter(self):
+        for datefmt in [None, '%H:%M:%S']:
+            fmt = '%(asctime)s %(message)s'
+            ideal = logging.Formatter(fmt, datefmt)
+            fmtr = logutils.CachedTimeFormatter(fmt, datefmt)
+            for t in [1234567890.25, 1234567890.75, 1234567891.5]:
+                rec = logging.LogRecord(
+                    'name', 30, 'f.py', 1, 'msg', (), None)
+                rec.created = t
+                rec.msecs = (t - int(t)) * 1000
+                self.assertEqual(fmtr.format(rec), ideal.format(rec))
+
 
 class TestGetTimestampedFilename(unittest.TestCase):
 
@@ -191,6 +404,477 @@ class TestRemoveFiles(unittest.TestCase):
         logutils.remove_old_files(self.root, maxfiles=0)
         self.assertRootContents([])
 
+    def testKeepsNewestRegardlessOfListingOrder(self):
+        files = [self.mk() for _ in range(20)]
+        for i, f in enumerate(files):
+            t = (i * 7) % 20
+            os.utime(f, (t, t))
+        newest = sorted(files, key=os.path.getmtime)[-5:]
+        logutils.remove_old_files(self.root, maxfiles=5)
+        self.assertRootContents(newest)
+
+    def testIgnoresDirectories(self):
+        f1, f2 = self.mk(), self.mk()
+        subdir = os.path.join(self.root, 'subdir')
+        os.mkdir(subdir)
+        logutils.remove_old_files(self.root, maxfiles=1)
+        self.assertRootContents([f2, subdir])
+
+    def testBackground(self):
+        f1, f2, f3 = self.mk(), self.mk(), self.mk()
+        thread = logutils.remove_old_files(
+            self.root, maxfiles=1, background=True)
+        thread.join()
+        self.assertRootContents([f3])
+
+    def testBackgroundIgnoresErrors(self):
+        subdir = os.path.join(self.root, 'subdir')
+        logutils.remove_old_files(subdir, background=True).join()
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.batches = []
+        self.records = []
+        self.closed = False
+
+    def handle_batch(self, records):
+        self.records.extend(records)
+        self.batches.append([r.getMessage() for r in records])
+
+    def close(self):
+        self.closed = True
+        logging.Handler.close(self)
+
+
+class TestQueueHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('TestQueueHandler%s' % id(self))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def addQueueHandler(self, target, **kwargs):
+        h = logutils.QueueHandler(target, **kwargs)
+        self.logger.addHandler(h)
+        self.addCleanup(self.logger.removeHandler, h)
+        self.addCleanup(h.close)
+        return h
+
+    def stalledHandler(self, **kwargs):
+        """Return a QueueHandler whose writer thread is not running,
+        and a function to start it."""
+        threads = []
+        with mock.patch.object(logutils.QueueHandler, 'start_thread',
+                               lambda target, name: threads.append(target)):
+            h = logutils.QueueHandler(RecordingHandler(), **kwargs)
+        self.logger.addHandler(h)
+        self.addCleanup(self.logger.removeHandler, h)
+
+        def start():
+            h.thread = threading.Thread(target=threads[0])
+            h.thread.start()
+            return h
+        return h, start
+
+    def testWritesToFileInOrder(self):
+        fn = osutils.mktemp()
+        self.addCleanup(os.remove, fn)
+        target = logutils.BatchFileHandler(fn)
+        target.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        h = self.addQueueHandler(target)
+        for i in range(100):
+            self.logger.info('line %s', i)
+        h.flush()
+        with open(fn) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, ['INFO line %s' % i for i in range(100)])
+
+    def testArgsAreFormattedWhenLogged(self):
+        h, start = self.stalledHandler()
+        arg = ['a']
+        self.logger.info('%s', arg)
+        arg.append('b')
+        start().close()
+        self.assertEqual(h.target.batches, [["['a']"]])
+
+    def testOriginalRecordIsNotChanged(self):
+        h, start = self.stalledHandler()
+        other = RecordingHandler()
+        other.handle = mock.Mock()
+        self.logger.addHandler(other)
+        self.addCleanup(self.logger.removeHandler, other)
+        try:
+            raise ValueError('spam')
+        except ValueError:
+            self.logger.exception('%s', 'eggs')
+        record = other.handle.call_args[0][0]
+        self.assertEqual((record.msg, record.args), ('%s', ('eggs',)))
+        self.assertIsNotNone(record.exc_info)
+        start().close()
+        queued = h.target.records[0]
+        self.assertIsNot(queued, record)
+        self.assertIsNone(queued.exc_info)
+        self.assertIn('ValueError: spam', queued.exc_text)
+
+    def testBatches(self):
+        h, start = self.stalledHandler(batchsize=3)
+        for i in range(7):
+            self.logger.info(str(i))
+        self.assertEqual(h.qsize(), 7)
+        start().close()
+        self.assertEqual(h.target.batches,
+                         [['0', '1', '2'], ['3', '4', '5'], ['6']])
+        self.assertEqual(h.highwater, 7)
+        self.assertTrue(h.target.closed)
+
+    def testDropOldest(self):
+        h, start = self.stalledHandler(
+            maxsize=2, overflow=logutils.OVERFLOW_DROP_OLDEST)
+        for i in range(5):
+            self.logger.info(str(i))
+        self.assertEqual(h.dropped, 3)
+        start().close()
+        self.assertEqual(h.target.batches, [['3', '4']])
+
+    def testDrop(self):
+        h, start = self.stalledHandler(
+            maxsize=2, overflow=logutils.OVERFLOW_DROP)
+        for i in range(5):
+            self.logger.info(str(i))
+        self.assertEqual(h.dropped, 3)
+        start().close()
+        self.assertEqual(h.target.batches, [['0', '1']])
+
+    def testBlockWaitsForWriter(self):
+        h, start = self.stalledHandler(maxsize=1, batchsize=1)
+        self.logger.info('0')
+        logged = threading.Event()
+
+        def log():
+            self.logger.info('1')
+            logged.set()
+        t = threading.Thread(target=log)
+        t.start()
+        self.assertFalse(logged.wait(0.1))
+        start()
+        t.join(5)
+        h.close()
+        self.assertEqual(h.target.batches, [['0'], ['1']])
+        self.assertEqual(h.dropped, 0)
+
+    def testPlainTargetIsCalledPerRecord(self):
+        target = mock.Mock(spec=logging.Handler)
+        h = self.addQueueHandler(target)
+        self.logger.info('a')
+        self.logger.info('b')
+        h.flush()
+        self.assertEqual(target.handle.call_count, 2)
+
+    def testInvalidOverflowRaises(self):
+        self.assertRaises(ValueError, logutils.QueueHandler,
+                          RecordingHandler(), overflow='spam')
+
+
+class TestTimestampedRotatingFileHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def create(self, **kwargs):
+        h = logutils.TimestampedRotatingFileHandler(
+            os.path.join(self.root, 'logs'), 'app', **kwargs)
+        self.addCleanup(h.close)
+        h.setFormatter(logging.Formatter('%(message)s'))
+        return h
+
+    def record(self, msg, created=None):
+        rec = logging.LogRecord('name', logging.INFO, 'f.py', 1, msg, (), None)
+        if created is not None:
+            rec.created = created
+        return rec
+
+    def joinCleanup(self):
+        for t in threading.enumerate():
+            if t.name in ('RemoveOldFiles', 'ApplyRetention'):
+                t.join()
+
+    def contents(self):
+        self.joinCleanup()
+        folder = os.path.join(self.root, 'logs')
+        result = []
+        for f in os.listdir(folder):
+            with open(os.path.join(folder, f)) as fd:
+                result.append(fd.read())
+        return result
+
+    def testRollsOverBySize(self):
+        h = self.create(maxbytes=10)
+        for i in range(4):
+            h.handle(self.record('%s23456789' % i))
+        h.close()
+        self.assertEqual(sorted(self.contents()),
+                         ['%s23456789\n' % i for i in range(4)])
+
+    def testRollsOverByTime(self):
+        h = self.create(interval=60)
+        now = time.time()
+        h.handle(self.record('a', now))
+        h.handle(self.record('b', now + 30))
+        h.handle(self.record('c', now + 61))
+        h.handle(self.record('d', now + 100))
+        h.handle(self.record('e', now + 122))
+        h.close()
+        self.assertEqual(sorted(self.contents()), ['a\nb\n', 'c\nd\n', 'e\n'])
+
+    def testAppliesRetention(self):
+        h = self.create(maxbytes=1, maxfiles=2)
+        for i in range(5):
+            h.handle(self.record(str(i)))
+        h.close()
+        self.assertEqual(len(self.contents()), 2)
+
+    def testWithQueueHandler(self):
+        h = logutils.QueueHandler(self.create(maxbytes=10))
+        for i in range(3):
+            h.handle(self.record('%s23456789' % i))
+            h.flush()
+        h.close()
+        self.assertEqual(sorted(self.contents()),
+                         ['%s23456789\n' % i for i in range(3)])
+
+
+class TestLogReader(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.filename = os.path.join(self.root, 'a.log')
+
+    def append(self, text, filename=None):
+        with open(filename or self.filename, 'ab') as f:
+            f.write(text.encode('utf-8'))
+
+    def texts(self, reader, filenames=None):
+        return [e.text for e in reader.read(filenames or [self.filename])]
+
+    def testOnlyReadsNewRecords(self):
+        reader = logutils.LogReader(blocksize=4)
+        self.append('one\ntwo\n')
+        self.assertEqual(self.texts(reader), ['one', 'two'])
+        self.assertEqual(self.texts(reader), [])
+        self.append('three\n')
+        self.assertEqual(self.texts(reader), ['three'])
+
+    def testJoinsContinuationLines(self):
+        reader = logutils.LogReader()
+        self.append('one\n  more\n\tand more\ntwo\n')
+        entries = list(reader.read([self.filename]))
+        self.assertEqual([e.text for e in entries],
+                         ['one\n  more\n\tand more', 'two'])
+        self.assertEqual([e.offset for e in entries], [0, 21])
+        self.assertEqual(entries[0].path, os.path.abspath(self.filename))
+
+    def testWaitsForPartialLine(self):
+        reader = logutils.LogReader()
+        self.append('one\ntw')
+        self.assertEqual(self.texts(reader), ['one'])
+        self.append('o\n')
+        self.assertEqual(self.texts(reader), ['two'])
+
+    def testPattern(self):
+        reader = logutils.LogReader(pattern=r'(?P<level>[A-Z]+): ')
+        self.append('INFO: hi\nTraceback:\nValueError\nERROR: bye\n')
+        entries = list(reader.read([self.filename]))
+        self.assertEqual([e.text for e in entries],
+                         ['INFO: hi\nTraceback:\nValueError', 'ERROR: bye'])
+        self.assertEqual(entries[1].fields, {'level': 'ERROR'})
+
+    def testReplacedFileIsReadFromStart(self):
+        reader = logutils.LogReader()
+        self.append('one\ntwo\n')
+        self.texts(reader)
+        other = os.path.join(self.root, 'b.log')
+        self.append('three\n', other)
+        os.remove(self.filename)
+        os.rename(other, self.filename)
+        self.assertEqual(self.texts(reader), ['three'])
+
+    def testRotatedFileIsFinishedFirst(self):
+        reader = logutils.LogReader()
+        self.append('one\n')
+        self.texts(reader)
+        self.append('two\nthree\n')
+        rotated = self.filename + '.1'
+        os.rename(self.filename, rotated)
+        self.append('four\n')
+        entries = list(reader.read([self.filename]))
+        self.assertEqual([e.text for e in entries], ['two', 'three', 'four'])
+        self.assertEqual([e.path for e in entries],
+                         [os.path.abspath(rotated)] * 2 +
+                         [os.path.abspath(self.filename)])
+        self.assertEqual(self.texts(reader), [])
+
+    def testStoppingEarlyInRotatedFileResumes(self):
+        reader = logutils.LogReader()
+        self.append('one\n')
+        self.texts(reader)
+        self.append('two\nthree\n')
+        os.rename(self.filename, self.filename + '.1')
+        self.append('four\n')
+        gen = reader.read([self.filename])
+        self.assertEqual(next(gen).text, 'two')
+        gen.close()
+        self.assertEqual(self.texts(reader), ['three', 'four'])
+
+    def testTruncatedFileIsReadFromStart(self):
+        reader = logutils.LogReader()
+        self.append('one\ntwo\n')
+        self.texts(reader)
+        with open(self.filename, 'wb') as f:
+            f.write(b'x\n')
+        self.assertEqual(self.texts(reader), ['x'])
+
+    def testStoppingEarlyResumes(self):
+        reader = logutils.LogReader()
+        self.append('one\ntwo\nthree\n')
+        gen = reader.read([self.filename])
+        self.assertEqual(next(gen).text, 'one')
+        gen.close()
+        self.assertEqual(self.texts(reader), ['two', 'three'])
+
+    def testMissingFileIsSkipped(self):
+        reader = logutils.LogReader()
+        self.assertEqual(self.texts(reader, [self.filename + 'x']), [])
+
+    def testStateFile(self):
+        statefile = os.path.join(self.root, 'state.json')
+        self.append('one\n')
+        reader = logutils.LogReader(statefile)
+        self.texts(reader)
+        reader.save()
+        self.append('two\n')
+        self.assertEqual(self.texts(logutils.LogReader(statefile)), ['two'])
+
+    def testDefaultsToFilenamesFromLoggers(self):
+        self.append('one\n')
+        with mock.patch.object(logutils, 'get_filenames_from_loggers',
+                               return_value=(self.filename,)):
+            self.assertEqual([e.text for e in logutils.LogReader().read()],
+                             ['one'])
+
+
+class TestApplyRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.now = time.time()
+
+    def mk(self, name, age, size=10):
+        """Create file ``name`` modified ``age`` seconds ago."""
+        f = os.path.join(self.root, name)
+        with open(f, 'wb') as fd:
+            fd.write(b'x' * size)
+        mtime = self.now - age
+        os.utime(f, (mtime, mtime))
+        return f
+
+    def assertRootContents(self, ideal):
+        self.assertEqual(sorted(os.listdir(self.root)), sorted(ideal))
+
+    def testMaxFiles(self):
+        for i in range(4):
+            self.mk('%s.log' % i, 100 - i)
+        kept = logutils.apply_retention(
+            self.root, logutils.RetentionPolicy(maxfiles=2))
+        self.assertRootContents(['2.log', '3.log'])
+        self.assertEqual(sorted(kept), [os.path.join(self.root, f)
+                                        for f in ['2.log', '3.log']])
+
+    def testMaxBytesRemovesOldestFirst(self):
+        self.mk('a.log', 30, 50)
+        self.mk('b.log', 20, 50)
+        self.mk('c.log', 10, 50)
+        logutils.apply_retention(
+            self.root, logutils.RetentionPolicy(maxbytes=120))
+        self.assertRootContents(['b.log', 'c.log'])
+
+    def testMaxAge(self):
+        self.mk('old.log', 1000)
+        self.mk('new.log', 10)
+        logutils.apply_retention(
+            self.root, logutils.RetentionPolicy(maxage=100))
+        self.assertRootContents(['new.log'])
+
+    def testPerPatternQuotas(self):
+        self.mk('a.dmp', 30)
+        self.mk('b.dmp', 20)
+        self.mk('a.log', 30)
+        self.mk('b.log', 20)
+        self.mk('other', 50)
+        logutils.apply_retention(self.root, [
+            logutils.RetentionPolicy('*.dmp', maxfiles=1),
+            logutils.RetentionPolicy('*.log', maxfiles=2),
+        ])
+        self.assertRootContents(['a.log', 'b.log', 'b.dmp', 'other'])
+
+    def testFirstMatchingPolicyWins(self):
+        self.mk('a.log', 30)
+        self.mk('b.log', 20)
+        logutils.apply_retention(self.root, [
+            logutils.RetentionPolicy('a.*', maxfiles=1),
+            logutils.RetentionPolicy('*', maxfiles=0),
+        ])
+        self.assertRootContents(['a.log'])
+
+    def testCompress(self):
+        data = b'spam' * 1000
+        f = self.mk('old.log', 1000)
+        with open(f, 'wb') as fd:
+            fd.write(data)
+        os.utime(f, (self.now - 1000, self.now - 1000))
+        self.mk('new.log', 1)
+        logutils.apply_retention(
+            self.root, logutils.RetentionPolicy(compress=60))
+        self.assertRootContents(['new.log', 'old.log.gz'])
+        with gzip.open(f + '.gz') as fd:
+            self.assertEqual(fd.read(), data)
+        self.assertAlmostEqual(
+            os.path.getmtime(f + '.gz'), self.now - 1000, places=0)
+
+    def testCompressedFilesCountTowardsPolicy(self):
+        self.mk('a.log', 300)
+        self.mk('b.log', 200)
+        logutils.apply_retention(
+            self.root, logutils.RetentionPolicy('*.log', compress=60))
+        self.mk('c.log', 100)
+        logutils.apply_retention(
+            self.root, logutils.RetentionPolicy('*.log', maxfiles=2))
+        self.assertRootContents(['b.log.gz', 'c.log'])
+
+    def testBackground(self):
+        self.mk('a.log', 30)
+        self.mk('b.log', 20)
+        thread = logutils.apply_retention(
+            self.root, logutils.RetentionPolicy(maxfiles=1), background=True)
+        thread.join()
+        self.assertRootContents(['b.log'])
+
+    def testNegativeLimitRaises(self):
+        self.assertRaises(ValueError, logutils.RetentionPolicy, maxbytes=-1)
+
+    def testFromGetTimestampedLogfilename(self):
+        self.mk('foo_1_pid1.log', 30, 100)
+        self.mk('foo_2_pid1.log', 20, 100)
+        self.mk('bar_1_pid1.log', 30, 100)
+        logutils.get_timestamped_logfilename(
+            self.root, 'foo',
+            retention=logutils.RetentionPolicy(maxbytes=150))
+        self.assertRootContents(['bar_1_pid1.log', 'foo_2_pid1.log'])
+
 
 class TestGetTimestampedLogfileName(unittest.TestCase):
     def setUp(self):
@@ -204,6 +888,21 @@ class TestGetTimestampedLogfileName(unittest.TestCase):
             'bar/foo', timestruct=self.timestruct, _getpid=self.getpidmock)
         self.assertEqual(ideal, os.path.basename(result))
 
+    def testRemovesOldFiles(self):
+        folder = tempfile.mkdtemp()
+        for i in range(3):
+            fn = os.path.join(folder, 'foo_%s_pid1.log' % i)
+            open(fn, 'w').close()
+            os.utime(fn, (i, i))
+        result = logutils.get_timestamped_logfilename(
+            folder, 'foo', maxfiles=1, background=True,
+            timestruct=self.timestruct, _getpid=self.getpidmock)
+        for t in threading.enumerate():
+            if t.name == 'RemoveOldFiles':
+                t.join()
+        self.assertEqual(os.listdir(folder), ['foo_2_pid1.log'])
+        self.assertEqual(os.path.dirname(result), folder)
+
 
 class TestWrapLine(unittest.TestCase):
 
@@ -1,12 +1,16 @@
+import errno
+import hashlib
 import inspect
+import mock
 import os
 from os.path import join
 import shutil
 import stat
 import tempfile
 import unittest
+import zlib
 
-from brennivin import osutils
+from brennivin import osutils, testhelpers
 
 ROOT = '/'
 if os.name == 'nt':
@@ -34,6 +38,32 @@ class TestAbsPathEx(unittest.TestCase):
         self.assertRaises(ArithmeticError, osutils.abspathex, 'path.py', ROOT, True)
         self.assertEqual(cwd, os.getcwd())
 
+    def testDoesNotChangeCwd(self):
+        def chdir(_):
+            raise AssertionError('chdir called')
+        with testhelpers.Patcher(os, 'chdir', chdir):
+            result = osutils.abspathex(join('..', 'spam'), THISDIR)
+        self.assertEqual(result, join(os.path.dirname(THISDIR), 'spam'))
+
+    def testAbsolutePathIsNormalized(self):
+        path = join(ROOT, 'foo', '..', 'bar')
+        self.assertEqual(osutils.abspathex(path, THISDIR), join(ROOT, 'bar'))
+
+    def testSameAsChangingCwd(self):
+        if not hasattr(os, 'symlink'):
+            raise unittest.SkipTest('symlinks not supported.')
+        tempd = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, tempd)
+        real = osutils.makedirs(join(tempd, 'real', 'sub'))
+        link = join(tempd, 'link')
+        os.symlink(real, link)
+        with osutils.change_cwd(link):
+            ideal = os.path.abspath(join('..', 'x'))
+        self.assertEqual(osutils.abspathex(join('..', 'x'), link), ideal)
+
+    def testNotADirectoryRaises(self):
+        self.assertRaises(OSError, osutils.abspathex, 'foo', __file__)
+
 
 class ChangeCwdTests(unittest.TestCase):
     def setUp(self):
@@ -58,6 +88,136 @@ class ChangeCwdTests(unittest.TestCase):
             self.assertEqual(self.oldcwd, os.getcwd())
 
 
+class WorkingDirTests(unittest.TestCase):
+
+    def setUp(self):
+        self.oldcwd = os.getcwd()
+        self.wd = osutils.WorkingDir(THISDIR)
+
+    def testAbsPath(self):
+        self.assertEqual(self.wd.abspath('spam.py'), join(THISDIR, 'spam.py'))
+        self.assertEqual(self.wd.abspath(join('..', 'spam')),
+                         join(os.path.dirname(THISDIR), 'spam'))
+        self.assertEqual(self.wd.abspath(ROOT), ROOT)
+
+    def testPathIsMadeAbsolute(self):
+        self.assertEqual(osutils.WorkingDir('.').path, self.oldcwd)
+
+    def testFileOperations(self):
+        thisfile = os.path.basename(__file__).replace('.pyc', '.py')
+        self.assertTrue(self.wd.isfile(thisfile))
+        self.assertTrue(self.wd.exists(thisfile))
+        self.assertTrue(self.wd.isdir('zipfileutilstests'))
+        self.assertIn(thisfile, self.wd.listdir())
+        with self.wd.open(thisfile) as f:
+            self.assertTrue(f.read())
+        self.assertEqual(self.oldcwd, os.getcwd())
+
+    def testSub(self):
+        sub = self.wd.sub('zipfileutilstests')
+        self.assertEqual(sub.path, join(THISDIR, 'zipfileutilstests'))
+        self.assertTrue(sub.isdir('testroot'))
+
+    def testSubprocessUsesPath(self):
+        import sys
+        with self.wd as wd:
+            out = wd.check_output(
+                [sys.executable, '-c', 'import os; print(os.getcwd())'])
+        self.assertEqual(out.decode().strip(), os.path.realpath(THISDIR))
+        self.assertEqual(self.oldcwd, os.getcwd())
+
+
+class AtomicWriteTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = join(self.root, 'file.txt')
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def testWrites(self):
+        for fsync in osutils.FSYNC_NONE, osutils.FSYNC_FILE, osutils.FSYNC_DIR:
+            with osutils.atomic_write(self.path, fsync=fsync) as f:
+                f.write(fsync)
+            self.assertEqual(self.read(), fsync)
+        self.assertEqual(os.listdir(self.root), ['file.txt'])
+
+    def testBinary(self):
+        with osutils.atomic_write(self.path, 'wb') as f:
+            f.write(b'\x00\x01')
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'\x00\x01')
+
+    def testErrorLeavesOriginal(self):
+        with open(self.path, 'w') as f:
+            f.write('original')
+        try:
+            with osutils.atomic_write(self.path) as f:
+                f.write('partial')
+                raise SystemError
+        except SystemError:
+            pass
+        self.assertEqual(self.read(), 'original')
+        self.assertEqual(os.listdir(self.root), ['file.txt'])
+
+    def testNotVisibleUntilExit(self):
+        with osutils.atomic_write(self.path) as f:
+            f.write('spam')
+            self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.read(), 'spam')
+
+    def testKeepsPermissions(self):
+        with open(self.path, 'w'):
+            pass
+        os.chmod(self.path, 0o640)
+        with osutils.atomic_write(self.path) as f:
+            f.write('spam')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+
+    def testNewFileUsesUmask(self):
+        oldmask = os.umask(0o027)
+        try:
+            with osutils.atomic_write(self.path) as f:
+                f.write('spam')
+        finally:
+            os.umask(oldmask)
+        if os.name != 'nt':
+            self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+
+    def testPartialFilesAreUnique(self):
+        paths = [osutils._make_partial(self.root) for _ in range(3)]
+        self.assertEqual(len(set(paths)), 3)
+        for path in paths:
+            name = os.path.basename(path)
+            self.assertTrue(name.startswith('.brennivin-'))
+            self.assertTrue(name.endswith('.partial'))
+            self.assertEqual(os.path.getsize(path), 0)
+
+    def testFollowsSymlink(self):
+        if not hasattr(os, 'symlink'):
+            raise unittest.SkipTest('symlinks not supported.')
+        real = join(self.root, 'real.txt')
+        with open(real, 'w') as f:
+            f.write('original')
+        os.symlink(real, self.path)
+        with osutils.atomic_write(self.path) as f:
+            f.write('spam')
+        self.assertTrue(os.path.islink(self.path))
+        self.assertEqual(self.read(), 'spam')
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         ['file.txt', 'real.txt'])
+
+    def testInvalidArgs(self):
+        def write(**kwargs):
+            with osutils.atomic_write(self.path, **kwargs):
+                pass
+        self.assertRaises(ValueError, write, mode='a')
+        self.assertRaises(ValueError, write, fsync='always')
+
+
 class TestChangeEnviron(unittest.TestCase):
     def setUp(self):
         os.environ['TESTVALUE'] = 'ABC'
@@ -172,6 +332,202 @@ class TestCopy(unittest.TestCase):
         self.assertRaises(IOError, lambda: osutils.copy(src, self.getRandomTempPath('spam.eggs')))
 
 
+class CopyFilesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.dst = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.src)
+        self.addCleanup(shutil.rmtree, self.dst)
+        self.relpaths = ['a.txt', join('b', 'c.txt'), join('b', 'd', 'e.txt'),
+                         join('skip', 'f.txt')]
+        for i, relpath in enumerate(self.relpaths):
+            path = join(self.src, relpath)
+            osutils.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(b'x' * (i * 1000))
+            os.utime(path, (1000 + i, 1000 + i))
+
+    def pairs(self):
+        return [(join(self.src, r), join(self.dst, 'out', r))
+                for r in self.relpaths]
+
+    def assertCopied(self, pairs):
+        for src, dst in pairs:
+            with open(src, 'rb') as f1:
+                with open(dst, 'rb') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+            self.assertEqual(int(os.stat(src).st_mtime),
+                             int(os.stat(dst).st_mtime))
+
+    def testCopies(self):
+        for workers in 1, 4:
+            stats = osutils.copy_files(self.pairs(), workers=workers,
+                                       skip_unchanged=False)
+            self.assertCopied(self.pairs())
+            self.assertEqual(stats.files, 4)
+            self.assertEqual(stats.bytes, 6000)
+            self.assertEqual(stats.skipped, 0)
+
+    def testSkipsUnchanged(self):
+        osutils.copy_files(self.pairs())
+        src, dst = self.pairs()[1]
+        with open(src, 'wb') as f:
+            f.write(b'changed')
+        stats = osutils.copy_files(self.pairs())
+        self.assertEqual((stats.files, stats.skipped), (1, 3))
+        self.assertCopied(self.pairs())
+
+    def testCopiesChangeWithinSameSecond(self):
+        if not hasattr(os.stat(self.src), 'st_mtime_ns'):
+            raise unittest.SkipTest('No nanosecond mtimes.')
+        src, dst = self.pairs()[1]
+        os.utime(src, ns=(1001250000001, 1001250000001))
+        osutils.copy_files(self.pairs())
+        with open(src, 'wb') as f:
+            f.write(b'y' * 1000)
+        os.utime(src, ns=(1001500000001, 1001500000001))
+        stats = osutils.copy_files(self.pairs())
+        self.assertEqual((stats.files, stats.skipped), (1, 3))
+        self.assertCopied(self.pairs())
+
+    def testSameMtimeToDestinationPrecision(self):
+        def same(src, dst, ns=True):
+            if ns:
+                stats = [mock.Mock(st_mtime_ns=t) for t in (src, dst)]
+            else:
+                stats = [mock.Mock(spec=['st_mtime'], st_mtime=t / 1e9)
+                         for t in (src, dst)]
+            return osutils._same_mtime(*stats)
+        # Exact where nanoseconds are kept.
+        self.assertTrue(same(1000123456789, 1000123456789))
+        self.assertFalse(same(1000123456789, 1000123456788))
+        # Rounded by the destination filesystem.
+        self.assertTrue(same(1000123456789, 1000123456700))
+        self.assertTrue(same(1000123456789, 1000000000000))
+        self.assertTrue(same(1001123456789, 1002000000000))
+        self.assertFalse(same(1004123456789, 1002000000000))
+        # Python 2 only keeps microseconds.
+        self.assertTrue(same(1000123456789, 1000123457000, ns=False))
+        self.assertFalse(same(1000123456789, 1000123459000, ns=False))
+
+    def testFallsBackIfZeroCopyUnsupported(self):
+        def unsupported(*_):
+            raise OSError(errno.EXDEV, 'nope')
+        with testhelpers.Patcher(osutils, '_copy_file_range', unsupported):
+            with testhelpers.Patcher(osutils, '_sendfile', None):
+                osutils.copy_files(self.pairs())
+        self.assertCopied(self.pairs())
+
+    def testStats(self):
+        stats = osutils.CopyStats(files=10, bytes=1000, elapsed=2)
+        self.assertEqual(stats.files_per_sec, 5)
+        self.assertEqual(stats.bytes_per_sec, 500)
+        self.assertEqual(osutils.CopyStats().bytes_per_sec, 0)
+        self.assertIn('files=10', repr(stats))
+
+    def testCopyTree(self):
+        stats = osutils.copy_tree(self.src, self.dst, prune='skip')
+        self.assertEqual(stats.files, 3)
+        self.assertCopied([(join(self.src, r), join(self.dst, r))
+                           for r in self.relpaths[:3]])
+        self.assertFalse(os.path.exists(join(self.dst, 'skip')))
+
+
+class SyncTreeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.dst = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.src)
+        self.addCleanup(shutil.rmtree, self.dst)
+        for relpath in ['a.txt', join('b', 'c.txt'), join('b', 'd', 'e.txt')]:
+            self.write(self.src, relpath, relpath)
+
+    def write(self, root, relpath, data, mtime=1000):
+        path = join(root, relpath)
+        osutils.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def assertInSync(self):
+        src = sorted(os.path.relpath(p, self.src)
+                     for p in osutils.iter_files(self.src))
+        dst = sorted(os.path.relpath(p, self.dst)
+                     for p in osutils.iter_files(self.dst))
+        self.assertEqual(src, dst)
+        for relpath in src:
+            with open(join(self.src, relpath)) as f1:
+                with open(join(self.dst, relpath)) as f2:
+                    self.assertEqual(f1.read(), f2.read())
+
+    def testInitialSyncCopiesAll(self):
+        plan = osutils.sync_tree(self.src, self.dst)
+        self.assertEqual(len(plan.copies), 3)
+        self.assertEqual(plan.stats.files, 3)
+        self.assertInSync()
+
+    def testOnlyChangesCopied(self):
+        osutils.sync_tree(self.src, self.dst)
+        self.write(self.src, 'a.txt', 'new contents', 2000)
+        self.write(self.src, 'new.txt', 'new')
+        plan = osutils.sync_tree(self.src, self.dst)
+        self.assertEqual(plan.copies, [
+            (join(self.src, 'a.txt'), join(self.dst, 'a.txt')),
+            (join(self.src, 'new.txt'), join(self.dst, 'new.txt'))])
+        self.assertEqual(plan.unchanged, 2)
+        self.assertInSync()
+
+    def testChangeWithinSameSecondCopied(self):
+        if not hasattr(os.stat(self.src), 'st_mtime_ns'):
+            raise unittest.SkipTest('No nanosecond mtimes.')
+        path = join(self.src, 'a.txt')
+        os.utime(path, ns=(1000250000001, 1000250000001))
+        osutils.sync_tree(self.src, self.dst)
+        self.write(self.src, 'a.txt', 'A.TXT')
+        os.utime(path, ns=(1000500000001, 1000500000001))
+        plan = osutils.sync_tree(self.src, self.dst)
+        self.assertEqual(plan.copies, [(path, join(self.dst, 'a.txt'))])
+        self.assertInSync()
+        self.assertEqual(osutils.sync_tree(self.src, self.dst).copies, [])
+
+    def testDryRunChangesNothing(self):
+        plan = osutils.sync_tree(self.src, self.dst, dry_run=True)
+        self.assertEqual(len(plan.copies), 3)
+        self.assertIsNone(plan.stats)
+        self.assertEqual(os.listdir(self.dst), [])
+
+    def testDeleteExtras(self):
+        osutils.sync_tree(self.src, self.dst)
+        extra = self.write(self.dst, join('x', 'y', 'extra.txt'), 'extra')
+        plan = osutils.sync_tree(self.src, self.dst)
+        self.assertEqual(plan.deletes, [])
+        self.assertTrue(os.path.exists(extra))
+        plan = osutils.sync_tree(self.src, self.dst, delete=True)
+        self.assertEqual(plan.deletes, [extra])
+        self.assertInSync()
+        self.assertFalse(os.path.exists(join(self.dst, 'x')))
+
+    def testChecksumOnlyTouchesSameContents(self):
+        osutils.sync_tree(self.src, self.dst)
+        self.write(self.src, 'a.txt', 'a.txt', 5000)
+        plan = osutils.sync_tree(self.src, self.dst, checksum=True)
+        self.assertEqual(plan.copies, [])
+        self.assertEqual(len(plan.touches), 1)
+        self.assertEqual(os.stat(join(self.dst, 'a.txt')).st_mtime, 5000)
+
+    def testRestartRemovesPartials(self):
+        osutils.sync_tree(self.src, self.dst)
+        partial = osutils.mktemp(prefix='.brennivin-', suffix='.partial',
+                                 dir=self.dst)
+        plan = osutils.sync_tree(self.src, self.dst, delete=True)
+        self.assertEqual(plan.deletes, [])
+        self.assertFalse(os.path.exists(partial))
+        self.assertInSync()
+
+
 class CrcFromFilenameTests(unittest.TestCase):
 
     def testKnown(self):
@@ -183,6 +539,131 @@ class CrcFromFilenameTests(unittest.TestCase):
         self.assertEqual(osutils.crc_from_filename(f), 907060870)
 
 
+class HashFilenameTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = b'hello world' * 1000
+        self.path = osutils.mktemp()
+        self.addCleanup(os.remove, self.path)
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def testSingleAlgorithm(self):
+        self.assertEqual(osutils.hash_filename(self.path, 'sha1'),
+                         hashlib.sha1(self.data).hexdigest())
+        self.assertEqual(osutils.hash_filename(self.path),
+                         zlib.crc32(self.data) & 0xffffffff)
+
+    def testManyAlgorithmsInOnePass(self):
+        got = osutils.hash_filename(
+            self.path, ['crc32', 'adler32', 'md5', 'sha256'], bufsize=7)
+        self.assertEqual(got, {
+            'crc32': zlib.crc32(self.data) & 0xffffffff,
+            'adler32': zlib.adler32(self.data) & 0xffffffff,
+            'md5': hashlib.md5(self.data).hexdigest(),
+            'sha256': hashlib.sha256(self.data).hexdigest()})
+
+    def testMemoryviewOnlyUsedIfHashersAcceptIt(self):
+        view = osutils._get_memoryview()
+        if view is not None:
+            zlib.crc32(view(b'a'))
+            hashlib.sha1(view(b'a'))
+        self.assertEqual(osutils.hash_filename(self.path, bufsize=7),
+                         zlib.crc32(self.data) & 0xffffffff)
+
+    def testWithoutMemoryview(self):
+        with mock.patch.object(osutils, '_memoryview', None):
+            got = osutils.hash_filename(self.path, ['crc32', 'md5'], bufsize=7)
+        self.assertEqual(got, {
+            'crc32': zlib.crc32(self.data) & 0xffffffff,
+            'md5': hashlib.md5(self.data).hexdigest()})
+
+    def testBlake2Alias(self):
+        if not hasattr(hashlib, 'blake2b'):
+            raise unittest.SkipTest('blake2 not available')
+        self.assertEqual(osutils.hash_filename(self.path, 'blake2'),
+                         hashlib.blake2b(self.data).hexdigest())
+
+    def testUnknownAlgorithmRaises(self):
+        self.assertRaises(ValueError, osutils.hash_filename, self.path, 'spam')
+
+
+class HashFilesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.files = []
+        for i in range(20):
+            path = join(self.root, '%s.txt' % i)
+            with open(path, 'w') as f:
+                f.write(str(i))
+            self.files.append(path)
+        self.cachefile = join(self.root, 'cache', 'hashes.json')
+
+    def ideal(self):
+        return dict((f, osutils.crc_from_filename(f)) for f in self.files)
+
+    def countHashes(self):
+        counter = testhelpers.CallCounter(
+            lambda c, *args: c.incr() and orig(*args))
+        orig = osutils.hash_filename
+        testhelpers.patch(self, osutils, 'hash_filename', counter)
+        return counter
+
+    def testHashesAll(self):
+        self.assertEqual(osutils.hash_files(self.files), self.ideal())
+        self.assertEqual(osutils.hash_files(self.files, workers=1),
+                         self.ideal())
+
+    def testCachedFilesNotRead(self):
+        cache = osutils.HashCache()
+        osutils.hash_files(self.files, cache=cache)
+        self.assertEqual(len(cache), 20)
+        ideal = self.ideal()
+        counter = self.countHashes()
+        got = osutils.hash_files(self.files, cache=cache)
+        self.assertEqual(got, ideal)
+        self.assertEqual(counter.count, 0)
+
+    def testChangedFileIsRehashed(self):
+        cache = osutils.HashCache()
+        osutils.hash_files(self.files, cache=cache)
+        with open(self.files[0], 'w') as f:
+            f.write('changed!')
+        ideal = self.ideal()
+        counter = self.countHashes()
+        got = osutils.hash_files(self.files, cache=cache)
+        self.assertEqual(got, ideal)
+        self.assertEqual(counter.count, 1)
+
+    def testPersisted(self):
+        cache = osutils.HashCache(self.cachefile)
+        osutils.hash_files(self.files, cache=cache)
+        cache.save()
+        cache = osutils.HashCache(self.cachefile)
+        self.assertEqual(len(cache), 20)
+        counter = self.countHashes()
+        osutils.hash_files(self.files, cache=cache)
+        self.assertEqual(counter.count, 0)
+
+    def testOtherAlgorithmEntriesDiscarded(self):
+        cache = osutils.HashCache(self.cachefile)
+        osutils.hash_files(self.files, cache=cache)
+        cache.save()
+        self.assertEqual(len(osutils.HashCache(self.cachefile, 'md5')), 0)
+
+    def testCorruptCacheIsEmpty(self):
+        osutils.makedirs(os.path.dirname(self.cachefile))
+        with open(self.cachefile, 'w') as f:
+            f.write('{not json')
+        self.assertEqual(len(osutils.HashCache(self.cachefile)), 0)
+
+    def testAlgorithmMismatchRaises(self):
+        self.assertRaises(ValueError, osutils.hash_files, self.files,
+                          'md5', cache=osutils.HashCache())
+
+
 class IterFilesTests(unittest.TestCase):
 
     def testReturnsGenerator(self):
@@ -202,6 +683,147 @@ class IterFilesTests(unittest.TestCase):
         self.assertTrue(thispy in files)
 
 
+class ScanFilesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.files = []
+        for dirname in ['', 'a', join('a', 'b'), 'c']:
+            d = osutils.makedirs(join(self.root, dirname))
+            for basename in ['x.py', 'y.txt', 'z.rst']:
+                path = join(d, basename)
+                with open(path, 'w'):
+                    pass
+                self.files.append(path)
+
+    def ideal(self, *exts):
+        return sorted(f for f in self.files if f.endswith(exts))
+
+    def testMatchesIterFiles(self):
+        self.assertEqual(
+            list(osutils.scan_files(self.root, '*.py')),
+            list(osutils.iter_files(self.root, '*.py')))
+
+    def testMultiplePatterns(self):
+        got = sorted(osutils.scan_files(self.root, ['*.py', '*.rst']))
+        self.assertEqual(got, self.ideal('.py', '.rst'))
+
+    def testNoPatternsMatchesNothing(self):
+        self.assertEqual(list(osutils.scan_files(self.root, [])), [])
+
+    def testParallel(self):
+        got = sorted(osutils.scan_files(self.root, '*.txt', workers=3))
+        self.assertEqual(got, self.ideal('.txt'))
+
+    def testParallelCanBeAbandoned(self):
+        gen = osutils.scan_files(self.root, workers=3)
+        self.assertTrue(next(gen))
+        gen.close()
+
+    def testDirEntries(self):
+        entries = list(osutils.scan_files(self.root, '*.py', direntries=True))
+        self.assertEqual(sorted(e.path for e in entries), self.ideal('.py'))
+        for e in entries:
+            self.assertEqual(e.stat().st_size, 0)
+
+    def testWithoutScandir(self):
+        with testhelpers.Patcher(osutils, '_scandir', None):
+            got = list(osutils.scan_files(self.root, direntries=True))
+        self.assertEqual(sorted(e.path for e in got), sorted(self.files))
+        self.assertTrue(all(e.is_file() for e in got))
+
+    def testExclude(self):
+        got = sorted(osutils.scan_files(self.root, exclude=['*.py', 'y.*']))
+        self.assertEqual(got, self.ideal('.rst'))
+
+    def testPruneNeverListsDirectory(self):
+        listed = []
+
+        def scandir(path):
+            listed.append(path)
+            return osutils._listdir_entries(path)
+        with testhelpers.Patcher(osutils, '_scandir', scandir):
+            got = list(osutils.iter_files(self.root, '*.py', prune='a'))
+        self.assertEqual(sorted(got),
+                         [join(self.root, 'c', 'x.py'), join(self.root, 'x.py')])
+        self.assertEqual(sorted(listed), [self.root, join(self.root, 'c')])
+
+    def testMaxDepth(self):
+        got = list(osutils.scan_files(self.root, '*.py', maxdepth=0))
+        self.assertEqual(got, [join(self.root, 'x.py')])
+        got = sorted(osutils.scan_files(self.root, '*.py', maxdepth=1))
+        self.assertEqual(got, [join(self.root, 'a', 'x.py'),
+                               join(self.root, 'c', 'x.py'),
+                               join(self.root, 'x.py')])
+
+    def testIgnoreRules(self):
+        rules = ['*.txt', '/x.py', 'b/', '!c/y.txt']
+        for workers in 0, 2:
+            got = sorted(osutils.scan_files(
+                self.root, ignore=rules, workers=workers))
+            self.assertEqual(got, [
+                join(self.root, 'a', 'x.py'),
+                join(self.root, 'a', 'z.rst'),
+                join(self.root, 'c', 'x.py'),
+                join(self.root, 'c', 'y.txt'),
+                join(self.root, 'c', 'z.rst'),
+                join(self.root, 'z.rst')])
+
+    def testMissingDirectoryYieldsNothing(self):
+        missing = join(self.root, 'missing')
+        self.assertEqual(list(osutils.scan_files(missing)), [])
+        self.assertEqual(list(osutils.scan_files(missing, workers=2)), [])
+
+
+class GitIgnoreTests(unittest.TestCase):
+
+    def assertIgnored(self, rules, relpath, isdir=False, ignored=True):
+        gi = osutils.GitIgnore(rules)
+        self.assertEqual(gi.match(relpath, isdir), ignored,
+                         '%r with %r' % (relpath, rules))
+
+    def testCommentsAndBlanksIgnored(self):
+        self.assertEqual(osutils.GitIgnore(['# *.py', '', '  ']).rules, [])
+
+    def testUnanchoredMatchesAnyLevel(self):
+        self.assertIgnored(['*.log'], 'x.log')
+        self.assertIgnored(['*.log'], 'a/b/x.log')
+
+    def testAnchored(self):
+        self.assertIgnored(['/top.txt'], 'top.txt')
+        self.assertIgnored(['/top.txt'], 'a/top.txt', ignored=False)
+        self.assertIgnored(['a/*.txt'], 'a/b.txt')
+        self.assertIgnored(['a/*.txt'], 'a/b/c.txt', ignored=False)
+
+    def testDirOnly(self):
+        self.assertIgnored(['build/'], 'x/build', isdir=True)
+        self.assertIgnored(['build/'], 'x/build', ignored=False)
+
+    def testDoubleStar(self):
+        self.assertIgnored(['**/tmp'], 'tmp')
+        self.assertIgnored(['**/tmp'], 'a/b/tmp')
+        self.assertIgnored(['docs/**/*.tmp'], 'docs/x.tmp')
+        self.assertIgnored(['docs/**/*.tmp'], 'docs/a/b/x.tmp')
+        self.assertIgnored(['docs/**'], 'docs/a/b')
+
+    def testLastMatchWins(self):
+        self.assertIgnored(['*.log', '!keep.log'], 'keep.log', ignored=False)
+        self.assertIgnored(['!keep.log', '*.log'], 'keep.log')
+
+    def testCharacterClasses(self):
+        self.assertIgnored(['[!x]y.c'], 'zy.c')
+        self.assertIgnored(['[!x]y.c'], 'xy.c', ignored=False)
+        self.assertIgnored(['[ab].c'], 'a.c')
+
+    def testFromFile(self):
+        f = osutils.mktemp()
+        self.addCleanup(os.remove, f)
+        with open(f, 'w') as fd:
+            fd.write('*.pyc\n')
+        self.assertTrue(osutils.GitIgnore.from_file(f).match('a/b.pyc'))
+
+
 class ListDirExTests(unittest.TestCase):
     def testGivenPatternFindsOnlyMatches(self):
         files = list(osutils.listdirex(THISDIR, '*osutils.py'))
@@ -216,6 +838,94 @@ class ListDirExTests(unittest.TestCase):
         self.assertFalse(thispy in files)
 
 
+class DirIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(join(self.root, 'sub'))
+        for f in ['a.py', 'b.txt', join('sub', 'c.py'), join('sub', 'd.PY')]:
+            with open(join(self.root, f), 'w'):
+                pass
+        self.age()
+
+    def age(self):
+        """Set dir mtimes into the past so listings are not racy."""
+        for d in [self.root, join(self.root, 'sub')]:
+            if os.path.isdir(d):
+                os.utime(d, (1000000000, 1000000000))
+
+    def testMatchesIterFiles(self):
+        idx = osutils.DirIndex(self.root)
+        for pat in ['*', '*.py', ['*.py', '*.txt']]:
+            self.assertEqual(sorted(idx.files(pat)),
+                             sorted(osutils.iter_files(self.root, pat)))
+
+    def testListdirMatchesListdirex(self):
+        idx = osutils.DirIndex(self.root)
+        os.makedirs(join(self.root, 'pkg.d'))
+        for pat in ['*.py', '*.*', '*']:
+            self.assertEqual(idx.listdir(self.root, pat),
+                             sorted(osutils.listdirex(self.root, pat)))
+        self.assertIn(join(self.root, 'pkg.d'), idx.listdir(self.root))
+        self.assertRaises(OSError, idx.listdir, 'nope')
+
+    def testRegexAndExt(self):
+        idx = osutils.DirIndex(self.root)
+        self.assertEqual(idx.match(r'[ab]\.'), [join(self.root, 'a.py'),
+                                                join(self.root, 'b.txt')])
+        self.assertEqual(sorted(idx.with_ext('.py', 'sub')),
+                         [join(self.root, 'sub', 'c.py'),
+                          join(self.root, 'sub', 'd.PY')])
+
+    def testUsesCacheUntilMtimeChanges(self):
+        idx = osutils.DirIndex(self.root)
+        idx.files()
+        with mock.patch.object(idx, '_list', wraps=idx._list) as m:
+            idx.files('*.py')
+            self.assertEqual(m.call_count, 0)
+            with open(join(self.root, 'sub', 'e.py'), 'w'):
+                pass
+            self.assertIn(join(self.root, 'sub', 'e.py'), idx.files('*.py'))
+            self.assertEqual(m.call_count, 1)
+
+    def testRacyDirsAreRelisted(self):
+        idx = osutils.DirIndex(self.root)
+        with open(join(self.root, 'new.py'), 'w'):
+            pass
+        idx.files()
+        with mock.patch.object(idx, '_list', wraps=idx._list) as m:
+            idx.files()
+            self.assertEqual(m.call_count, 1)
+
+    def testRemovedDirIsForgotten(self):
+        idx = osutils.DirIndex(self.root)
+        idx.files()
+        shutil.rmtree(join(self.root, 'sub'))
+        self.assertEqual(idx.files(), [join(self.root, 'a.py'),
+                                       join(self.root, 'b.txt')])
+        self.assertEqual(idx.files(directory='sub'), [])
+
+    def testSnapshotStartsWarm(self):
+        snap = osutils.mktemp()
+        self.addCleanup(os.remove, snap)
+        idx = osutils.DirIndex(self.root, snap)
+        expected = idx.files()
+        idx.save()
+        idx2 = osutils.DirIndex(self.root, snap)
+        with mock.patch.object(idx2, '_list') as m:
+            self.assertEqual(idx2.files(), expected)
+            self.assertEqual(m.call_count, 0)
+
+    def testSnapshotForOtherRootIgnored(self):
+        snap = osutils.mktemp()
+        self.addCleanup(os.remove, snap)
+        idx = osutils.DirIndex(self.root, snap)
+        idx.files()
+        idx.save()
+        other = osutils.DirIndex(join(self.root, 'sub'), snap)
+        self.assertEqual(other._dirs, {})
+
+
 class MakeDirsTests(unittest.TestCase):
     thisdir = os.path.dirname(__file__)
 
@@ -383,3 +1093,40 @@ class TestSplitPath(unittest.TestCase):
 
     def testEmpty(self):
         self.assertSplit('', ('', '', ''))
+
+
+class BatchPathTests(unittest.TestCase):
+    paths = ['', '/', 'foo', 'foo/', 'foo\\bar.baz', 'c:', 'c:/', 'c:foo',
+             'c:\\users\\mary major\\f.txt', 'res:/foo/bar.red', '.txt',
+             '.spam.eggs.ham', '..a.b', '...', 'a/.b.c', 'a.b/c', 'a/../b',
+             join(ROOT, 'foo', 'spam', 'eggs.ham'),
+             join(ROOT, 'foo', 'spam', 'ham.eggs')]
+
+    def assertBatchMatches(self, batchfunc, func, *args):
+        for paths in self.paths, [p.encode('ascii') for p in self.paths]:
+            self.assertEqual(batchfunc(iter(paths), *args),
+                             [func(p, *args) for p in paths])
+
+    def testPathComponents(self):
+        self.assertBatchMatches(
+            osutils.path_components_many,
+            lambda p: tuple(osutils.path_components(p)))
+
+    def testPathComponentsShareStrings(self):
+        a, b = osutils.path_components_many(['x/dir/a', 'y/dir/b'])
+        self.assertIs(a[1], b[1])
+
+    def testSplit3(self):
+        self.assertBatchMatches(osutils.split3_many, osutils.split3)
+
+    def testPurename(self):
+        self.assertBatchMatches(osutils.purename_many, osutils.purename)
+
+    def testPurenameFailsForNone(self):
+        self.assertRaises(TypeError, osutils.purename_many, ['a', None])
+
+    def testChangeExt(self):
+        self.assertEqual(osutils.change_ext_many(self.paths, '.x'),
+                         [osutils.change_ext(p, '.x') for p in self.paths])
+        self.assertEqual(osutils.change_ext_many([b'a.b', b'c'], b'.x'),
+                         [b'a.x', b'c.x'])
@@ -52,6 +52,16 @@ class PreferencesTests(unittest.TestCase):
         self.assertEqual(7, p.setdefault('test', 'test', 7))
         self.assertEqual(7, p.get('test', 'test', 0))
 
+    def testFailedSaveKeepsOldFile(self):
+        fn = osutils.mktemp()
+        p = self.create(fn)
+        p.set('a', 'b', 1)
+        with mock.patch.object(p, 'dumper', side_effect=SystemError):
+            self.assertRaises(SystemError, p.set, 'a', 'b', 2)
+        self.assertEqual(self.create(fn).get('a', 'b', None), 1)
+        self.assertEqual(os.listdir(os.path.dirname(fn)).count(
+            os.path.basename(fn)), 1)
+
     def testOnErrorCalledForLoadFailure(self):
         # Invoke one of the 'invalid' tests and ensure onerror was called.
         p = self.testCorruptData()
@@ -27,6 +27,11 @@ class ZipFileUtilsTests(unittest.TestCase):
     def assertZip(self, ideal):
         testhelpers.assertZipEqual(self.zippath, ideal)
 
+    def assertSameBytes(self, path1, path2):
+        with open(path1, 'rb') as f1:
+            with open(path2, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
     def testZipDirAll(self):
         zu.zip_dir(TESTROOT, self.zippath)
         self.assertZip(IDEAL_ALL)
@@ -46,6 +51,187 @@ class ZipFileUtilsTests(unittest.TestCase):
             zu.write_dir(TESTROOT, zfile, makeinclude('b'), subdir='nested2')
         self.assertZip(IDEAL_SUBDIR)
 
+    def testZipDirParallelIsSameAsSerial(self):
+        zu.zip_dir(TESTROOT, self.zippath, workers=4)
+        self.assertZip(IDEAL_ALL)
+        serial = os.path.join(self.tempd, 'serial.zip')
+        zu.zip_dir(TESTROOT, serial)
+        self.assertSameBytes(serial, self.zippath)
+
+    def testParallelManyFiles(self):
+        srcdir = os.path.join(self.tempd, 'src')
+        os.mkdir(srcdir)
+        for i in range(40):
+            with open(os.path.join(srcdir, '%s.txt' % i), 'wb') as f:
+                f.write(('spam %d ' % i).encode() * (i * 100))
+        zu.zip_dir(srcdir, self.zippath, workers=3)
+        with zipfile.ZipFile(self.zippath) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual([zi.filename for zi in z.infolist()],
+                             [os.path.relpath(p, srcdir).replace(os.sep, '/')
+                              for p in osutils.iter_files(srcdir)])
+            self.assertEqual(z.read('7.txt'), b'spam 7 ' * 700)
+
+    def testParallelLargeFilesWrittenNormally(self):
+        with mock.patch.object(zu, 'PARALLEL_MAX_FILE_SIZE', 0):
+            zu.zip_dir(TESTROOT, self.zippath, workers=2)
+        self.assertZip(IDEAL_ALL)
+
+    def makePolicyTree(self):
+        srcdir = os.path.join(self.tempd, 'src')
+        os.mkdir(srcdir)
+        files = {
+            'text.txt': b'spam and eggs ' * 1000,
+            'image.PNG': b'not really a png ' * 1000,
+            'small.txt': b'spam',
+            'noise.bin': os.urandom(20000),
+            'data.xml': b'<spam/>' * 1000,
+            'data.log': b'eggs\n' * 1000,
+        }
+        for name, data in files.items():
+            with open(os.path.join(srcdir, name), 'wb') as f:
+                f.write(data)
+        return srcdir, files
+
+    def assertCompressTypes(self, files, expected):
+        with zipfile.ZipFile(self.zippath) as z:
+            self.assertIsNone(z.testzip())
+            for name, data in files.items():
+                self.assertEqual(z.read(name), data)
+            got = dict((zi.filename, zi.compress_type) for zi in z.infolist())
+        self.assertEqual(got, expected)
+
+    def skipIfNoBzip2OrLzma(self):
+        if not hasattr(zipfile, 'ZIP_LZMA'):
+            raise unittest.SkipTest('zipfile has no bzip2 or lzma support.')
+
+    def testPolicy(self):
+        self.skipIfNoBzip2OrLzma()
+        srcdir, files = self.makePolicyTree()
+        policy = zu.CompressionPolicy(extensions={
+            '.xml': zipfile.ZIP_BZIP2, '.LOG': (zipfile.ZIP_LZMA, 9)})
+        expected = {
+            'text.txt': zipfile.ZIP_DEFLATED,
+            'image.PNG': zipfile.ZIP_STORED,
+            'small.txt': zipfile.ZIP_STORED,
+            'noise.bin': zipfile.ZIP_STORED,
+            'data.xml': zipfile.ZIP_BZIP2,
+            'data.log': zipfile.ZIP_LZMA,
+        }
+        zu.zip_dir(srcdir, self.zippath, policy=policy)
+        self.assertCompressTypes(files, expected)
+        serial = os.path.join(self.tempd, 'serial.zip')
+        os.rename(self.zippath, serial)
+        zu.zip_dir(srcdir, self.zippath, workers=3, policy=policy)
+        self.assertCompressTypes(files, expected)
+        self.assertSameBytes(serial, self.zippath)
+
+    def testPolicyWithoutTrialCompressesNoise(self):
+        self.skipIfNoBzip2OrLzma()
+        srcdir, files = self.makePolicyTree()
+        policy = zu.CompressionPolicy(
+            zipfile.ZIP_BZIP2, stored_extensions=(), minsize=0, trialsize=0)
+        zu.zip_dir(srcdir, self.zippath, policy=policy)
+        self.assertCompressTypes(
+            files, dict((name, zipfile.ZIP_BZIP2) for name in files))
+
+    def testPolicyChoose(self):
+        policy = zu.CompressionPolicy(level=3, minsize=10, trialsize=100)
+        self.assertEqual(policy.choose('a.txt', 9),
+                         (zipfile.ZIP_STORED, None))
+        self.assertEqual(policy.choose('a.txt', 1000),
+                         (zipfile.ZIP_DEFLATED, 3))
+        self.assertEqual(policy.choose('a.txt', 1000, b'a' * 1000),
+                         (zipfile.ZIP_DEFLATED, 3))
+        self.assertEqual(policy.choose('a.txt', 1000, os.urandom(1000)),
+                         (zipfile.ZIP_STORED, None))
+        self.assertEqual(policy.choose('a.Zip', 1000, b'a' * 1000),
+                         (zipfile.ZIP_STORED, None))
+
+    def makeUpdateTree(self):
+        srcdir = os.path.join(self.tempd, 'src')
+        for i in range(10):
+            path = os.path.join(srcdir, 'd%s' % (i % 3), '%s.txt' % i)
+            osutils.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(('spam %d ' % i).encode() * 500)
+            os.utime(path, (1400000001, 1400000001))
+        return srcdir
+
+    def assertSameAsZipDir(self, srcdir, **kwargs):
+        fresh = os.path.join(self.tempd, 'fresh.zip')
+        zu.zip_dir(srcdir, fresh, **kwargs)
+        self.assertSameBytes(fresh, self.zippath)
+
+    def skipIfNoRawCopy(self):
+        if not hasattr(zipfile.ZipInfo, 'from_file'):
+            raise unittest.SkipTest('update_zip always rebuilds here.')
+
+    def testUpdateZip(self):
+        self.skipIfNoRawCopy()
+        srcdir = self.makeUpdateTree()
+        zu.zip_dir(srcdir, self.zippath)
+        with open(os.path.join(srcdir, 'd1', '4.txt'), 'wb') as f:
+            f.write(b'changed')
+        with open(os.path.join(srcdir, 'd2', 'new.txt'), 'wb') as f:
+            f.write(b'new' * 100)
+        os.remove(os.path.join(srcdir, 'd0', '3.txt'))
+        with mock.patch.object(zu, '_write_file',
+                               wraps=zu._write_file) as write_file:
+            changed = zu.update_zip(srcdir, self.zippath)
+        self.assertEqual(sorted(changed), ['d1/4.txt', 'd2/new.txt'])
+        self.assertEqual(write_file.call_count, 2)
+        self.assertSameAsZipDir(srcdir)
+
+    def testUpdateZipParallelWithPolicy(self):
+        self.skipIfNoRawCopy()
+        self.skipIfNoBzip2OrLzma()
+        srcdir = self.makeUpdateTree()
+        policy = zu.CompressionPolicy(zipfile.ZIP_LZMA)
+        zu.zip_dir(srcdir, self.zippath, policy=policy)
+        with open(os.path.join(srcdir, 'd2', '5.txt'), 'wb') as f:
+            f.write(b'changed' * 100)
+        changed = zu.update_zip(srcdir, self.zippath, workers=3,
+                                policy=policy)
+        self.assertEqual(changed, ['d2/5.txt'])
+        with zipfile.ZipFile(self.zippath) as z:
+            self.assertIsNone(z.testzip())
+        self.assertSameAsZipDir(srcdir, policy=policy)
+
+    def testUpdateZipUnchangedIsNotRewritten(self):
+        self.skipIfNoRawCopy()
+        srcdir = self.makeUpdateTree()
+        zu.zip_dir(srcdir, self.zippath)
+        with mock.patch.object(osutils, 'atomic_write') as atomic_write:
+            self.assertEqual(zu.update_zip(srcdir, self.zippath), [])
+        self.assertFalse(atomic_write.called)
+
+    def testUpdateZipCheckCrc(self):
+        self.skipIfNoRawCopy()
+        srcdir = self.makeUpdateTree()
+        zu.zip_dir(srcdir, self.zippath)
+        touched = os.path.join(srcdir, 'd0', '6.txt')
+        os.utime(touched, (1500000001, 1500000001))
+        self.assertEqual(
+            zu.update_zip(srcdir, self.zippath, checkcrc=True), [])
+        self.assertSameAsZipDir(srcdir)
+        os.utime(touched, (1600000000, 1600000000))
+        self.assertEqual(zu.update_zip(srcdir, self.zippath), ['d0/6.txt'])
+
+    def testUpdateZipWithoutArchive(self):
+        srcdir = self.makeUpdateTree()
+        changed = zu.update_zip(srcdir, self.zippath)
+        self.assertEqual(len(changed), 10)
+        self.assertSameAsZipDir(srcdir)
+
+    def testUpdateZipRebuildsWithoutRawCopy(self):
+        srcdir = self.makeUpdateTree()
+        zu.zip_dir(srcdir, self.zippath)
+        with mock.patch.object(zu, '_supports_raw', return_value=False):
+            changed = zu.update_zip(srcdir, self.zippath)
+        self.assertEqual(len(changed), 10)
+        self.assertSameAsZipDir(srcdir)
+
     def testIsInsideZipfile(self):
         test_path = os.path.join(IDEAL_ALL, "testdir", "testfile.txt")
         self.assertTrue(zu.is_inside_zipfile(test_path))